@@ -14,6 +14,8 @@ def pytest_addoption(parser):
         "--runslow", action="store_true", help="run slow tests")
     parser.addoption(
         "--runsystem", action="store_true", help="run system tests")
+    parser.addoption(
+        "--runbenchmark", action="store_true", help="run benchmarks")
 
 
 def pytest_collection_modifyitems(config, items):
@@ -27,6 +29,12 @@ def pytest_collection_modifyitems(config, items):
         for item in items:
             if "system" in item.keywords:
                 item.add_marker(skip_system)
+    if not config.getoption('--runbenchmark'):
+        skip_benchmark = pytest.mark.skip(
+            reason='need --runbenchmark option to run')
+        for item in items:
+            if "benchmark" in item.keywords:
+                item.add_marker(skip_benchmark)
 
 
 def is_responsive(baseurl):
@@ -14,5 +14,8 @@ setup(
     install_requires=[
         'ConcurrentLogHandler',
         'requests'
-    ]
+    ],
+    extras_require={
+        'async': ['aiohttp'],
+    }
 )
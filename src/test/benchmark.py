@@ -0,0 +1,280 @@
+"""Throughput benchmark of the worker against the in-process fake jobs api.
+
+The fake api runs in its own process so that the CPU time of this process
+is that of the worker. The worker runs with a job command that waits and
+writes output, and the benchmark measures:
+
+  - jobs per second from the start of the worker until the last job is done
+  - api calls per job, by route
+  - percentiles of the seconds that fetch, claim, status, output uploads
+    and whole jobs take, from the tracing spans of the worker
+  - CPU seconds of the worker and of the job processes
+
+Example usage:
+
+  cd src && python -m test.benchmark --jobs 200 --slots 4 --latency 0.01
+
+or from Python:
+
+>>> result = run_benchmark(jobs=100, job_duration=.1, output_bytes=10000)
+>>> print(format_result(result))
+"""
+import argparse
+from collections import Counter
+import json
+import logging
+import math
+import multiprocessing
+import os
+import resource
+import sys
+from threading import Thread
+from time import sleep, time
+
+from test.fakeapi import FakeMicroqAPI
+from test.testbase import TEST_DATA_DIR
+from utils import tracing
+from uworker import uworker
+
+PROJECT = 'benchmark'
+JOB_COMMAND = 'sh ' + os.path.join(TEST_DATA_DIR, 'benchmark_job.sh')
+# Spans that the percentiles are reported for
+SPANS = ['fetch', 'claim', 'status', 'output_upload', 'job']
+PERCENTILES = [50, 90, 99]
+
+
+class MemoryExporter:
+    """Keep finished spans in memory"""
+
+    def __init__(self):
+        self.spans = []
+
+    def export(self, span):
+        self.spans.append(span)
+
+    def close(self):
+        pass
+
+
+def percentile(values, percent):
+    """Return the nearest-rank percentile of values, None if empty"""
+    if not values:
+        return None
+    values = sorted(values)
+    rank = max(1, int(math.ceil(percent / 100. * len(values))))
+    return values[rank - 1]
+
+
+def _serve_api(conn, jobs, latency, failure_rate, failure_status):
+    """Run the fake api in a child process until asked for the stats"""
+    api = FakeMicroqAPI(seed=0)
+    if latency:
+        api.set_latency(latency)
+    if failure_rate:
+        api.set_failures(failure_rate, status_code=failure_status)
+    for job_id in range(jobs):
+        api.add_job(PROJECT, str(job_id))
+    api.start()
+    conn.send(api.root)
+    while True:
+        command = conn.recv()
+        if command == 'done':
+            conn.send(sum(
+                1 for job in api.jobs.values()
+                if job['status'] in ('FINISHED', 'FAILED')))
+        elif command == 'stats':
+            conn.send({
+                'calls': dict(Counter(r.route for r in api.requests)),
+                'injected_failures': sum(r.injected for r in api.requests),
+                'statuses': dict(Counter(
+                    job['status'] for job in api.jobs.values())),
+            })
+            break
+    api.stop()
+
+
+def run_benchmark(jobs=100, job_duration=0., output_bytes=0, slots=1,
+                  prefetch=0, latency=0., failure_rate=0.,
+                  failure_status=503, error_sleep=1., timeout=600.):
+    """Run a worker until it has processed all jobs of the fake api.
+
+    Args:
+      jobs (int): Number of jobs.
+      job_duration (float): Seconds that each job takes.
+      output_bytes (int): Bytes of output of each job.
+      slots (int): Job slots of the worker.
+      prefetch (int): Jobs that the worker fetches in advance.
+      latency (float): Seconds that each api call is delayed.
+      failure_rate (float): Share of the api calls that fail.
+      failure_status (int): Status code of the failed calls, None to drop
+        the connections.
+      error_sleep (float): Seconds that the worker sleeps after errors.
+      timeout (float): Give up after this many seconds.
+    Returns:
+      dict: The measurements, see `format_result`.
+    """
+    conn, child_conn = multiprocessing.Pipe()
+    api_process = multiprocessing.Process(
+        target=_serve_api,
+        args=(child_conn, jobs, latency, failure_rate, failure_status))
+    api_process.start()
+    root = conn.recv()
+    environment = {
+        'UWORKER_JOB_API_ROOT': root,
+        'UWORKER_JOB_API_USERNAME': 'worker',
+        'UWORKER_JOB_API_PASSWORD': 'sqrrl',
+        'UWORKER_JOB_API_PROJECT': PROJECT,
+        'UWORKER_JOB_CMD': JOB_COMMAND,
+        'BENCHMARK_JOB_DURATION': str(job_duration),
+        'BENCHMARK_JOB_OUTPUT': str(int(output_bytes)),
+    }
+    saved_environment = {key: os.environ.get(key) for key in environment}
+    os.environ.update(environment)
+    exporter = MemoryExporter()
+    saved_exporter = tracing.TRACER.exporter
+    tracing.TRACER.exporter = exporter
+    try:
+        worker = uworker.UWorker(
+            slots=slots, prefetch=prefetch, idle_sleep=1.,
+            min_idle_sleep=.1, error_sleep=error_sleep)
+        worker.alive = True
+        thread = Thread(target=worker.run, name='benchmark-worker')
+        self_start = resource.getrusage(resource.RUSAGE_SELF)
+        children_start = resource.getrusage(resource.RUSAGE_CHILDREN)
+        start = time()
+        thread.start()
+        done = 0
+        while done < jobs and time() - start < timeout:
+            sleep(.02)
+            conn.send('done')
+            done = conn.recv()
+        elapsed = time() - start
+        worker.stop(None, None)
+        thread.join()
+        self_end = resource.getrusage(resource.RUSAGE_SELF)
+        children_end = resource.getrusage(resource.RUSAGE_CHILDREN)
+    finally:
+        tracing.TRACER.exporter = saved_exporter
+        for key, value in saved_environment.items():
+            if value is None:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = value
+        conn.send('stats')
+        stats = conn.recv()
+        api_process.join()
+
+    durations = {name: [] for name in SPANS}
+    for span in exporter.spans:
+        if span.name in durations:
+            durations[span.name].append(span.duration)
+    calls = sum(stats['calls'].values())
+    return {
+        'jobs': jobs,
+        'job_duration': job_duration,
+        'output_bytes': output_bytes,
+        'slots': slots,
+        'prefetch': prefetch,
+        'latency': latency,
+        'failure_rate': failure_rate,
+        'done': done,
+        'statuses': stats['statuses'],
+        'elapsed': elapsed,
+        'jobs_per_second': done / elapsed if elapsed else None,
+        'api_calls': stats['calls'],
+        'api_calls_per_job': calls / done if done else None,
+        'injected_failures': stats['injected_failures'],
+        'percentiles': {
+            name: {p: percentile(values, p) for p in PERCENTILES}
+            for name, values in durations.items()},
+        'worker_cpu': {
+            'user': self_end.ru_utime - self_start.ru_utime,
+            'system': self_end.ru_stime - self_start.ru_stime,
+        },
+        'job_cpu': {
+            'user': children_end.ru_utime - children_start.ru_utime,
+            'system': children_end.ru_stime - children_start.ru_stime,
+        },
+    }
+
+
+def format_result(result):
+    """Return the result of a benchmark as a text report"""
+    worker_cpu = result['worker_cpu']['user'] + result['worker_cpu']['system']
+    lines = [
+        'Jobs:              {done}/{jobs} {statuses}'.format(**result),
+        'Job duration:      {job_duration} s, {output_bytes} bytes of '
+        'output'.format(**result),
+        'Worker:            {slots} slots, prefetch {prefetch}'.format(
+            **result),
+        'Api:               {latency} s latency, {failure_rate} failure '
+        'rate, {injected_failures} injected failures'.format(**result),
+        'Elapsed:           {:.2f} s'.format(result['elapsed']),
+        'Throughput:        {:.2f} jobs/s'.format(
+            result['jobs_per_second'] or 0),
+        'Api calls per job: {:.2f} {}'.format(
+            result['api_calls_per_job'] or 0,
+            json.dumps(result['api_calls'], sort_keys=True)),
+        'Worker CPU:        {:.2f} s user, {:.2f} s system, {:.1f} ms per '
+        'job'.format(
+            result['worker_cpu']['user'], result['worker_cpu']['system'],
+            1000 * worker_cpu / max(result['done'], 1)),
+        'Job process CPU:   {:.2f} s user, {:.2f} s system'.format(
+            result['job_cpu']['user'], result['job_cpu']['system']),
+        'Latency (ms)       ' + ''.join(
+            'p{:<8}'.format(p) for p in PERCENTILES),
+    ]
+    for name in SPANS:
+        values = result['percentiles'][name]
+        lines.append('  {:<17}'.format(name) + ''.join(
+            '{:<9}'.format('-' if values[p] is None else '%.1f' % (
+                1000 * values[p])) for p in PERCENTILES))
+    return '\n'.join(lines)
+
+
+def get_argparser():
+    parser = argparse.ArgumentParser(
+        description='Measure the throughput of the worker against a fake '
+                    'jobs api.')
+    parser.add_argument('--jobs', type=int, default=100)
+    parser.add_argument(
+        '--job-duration', type=float, default=0., metavar='SECONDS')
+    parser.add_argument(
+        '--output-bytes', type=int, default=0, metavar='BYTES')
+    parser.add_argument('--slots', type=int, default=1)
+    parser.add_argument('--prefetch', type=int, default=0)
+    parser.add_argument(
+        '--latency', type=float, default=0., metavar='SECONDS',
+        help='Delay of each api call.')
+    parser.add_argument(
+        '--failure-rate', type=float, default=0., metavar='RATE',
+        help='Share of the api calls that fail.')
+    parser.add_argument(
+        '--failure-status', type=int, default=503,
+        help='Status code of the failed calls, 0 to drop the connections.')
+    parser.add_argument(
+        '--verbose', action='store_true', help='Show the worker log.')
+    parser.add_argument(
+        '--json', action='store_true', help='Print the result as json.')
+    return parser
+
+
+def main(args=None):
+    args = get_argparser().parse_args(args)
+    if not args.verbose:
+        logging.disable(logging.WARNING)
+    result = run_benchmark(
+        jobs=args.jobs, job_duration=args.job_duration,
+        output_bytes=args.output_bytes, slots=args.slots,
+        prefetch=args.prefetch, latency=args.latency,
+        failure_rate=args.failure_rate,
+        failure_status=args.failure_status or None)
+    if args.json:
+        print(json.dumps(result, indent=2, sort_keys=True))
+    else:
+        print(format_result(result))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
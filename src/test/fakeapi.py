@@ -0,0 +1,342 @@
+"""In-process stand-in for the jobs api of the microq service.
+
+Only the parts of the api that the worker uses are implemented. The server
+runs in a thread and records every request so that tests can inspect how
+the client talks to the api.
+
+Latency and failures can be injected, for all routes or per route, to see
+how the worker copes with a slow or unreliable api:
+
+>>> api.set_latency(.05)                         # 50 ms for every call
+>>> api.set_failures(.1, route='claim')          # 10% of claims get 503
+>>> api.set_failures(.01, status_code=None)      # 1% of connections drop
+"""
+import base64
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import random
+import re
+import threading
+from time import sleep, time
+from urllib.parse import parse_qsl
+import uuid
+
+from utils.defs import JOB_STATES
+
+JOB_URL = r'/rest_api/v4/(?P<project>\w+)/jobs/(?P<job_id>[^/]+)'
+ROUTES = [
+    ('GET', r'/rest_api/token$', 'token'),
+    ('GET', r'/rest_api/v4/projects/jobs/fetch$', 'fetch'),
+    ('GET', r'/rest_api/v4/(?P<project>\w+)/jobs/fetch$', 'fetch'),
+    ('GET', r'/rest_api/v4/(?P<project>\w+)/jobs$', 'job_list'),
+    ('PUT', JOB_URL + r'/claim$', 'claim'),
+    ('DELETE', JOB_URL + r'/claim$', 'unclaim'),
+    ('PUT', JOB_URL + r'/status$', 'status'),
+    ('PUT', JOB_URL + r'/output$', 'output'),
+    ('PATCH', JOB_URL + r'/output$', 'append_output'),
+]
+
+
+class FakeRequest:
+
+    def __init__(self, method, path, query, headers, body, client_port):
+        self.method = method
+        self.path = path
+        self.query = query
+        self.headers = headers
+        self.body = body
+        self.client_port = client_port
+        self.route = None
+        # Status code of the response, None if the connection was dropped
+        self.status_code = None
+        self.injected = False
+        # Retry-After header of an injected failure
+        self.retry_after = None
+
+    @property
+    def json(self):
+        return json.loads(self.body.decode()) if self.body else None
+
+    @property
+    def username(self):
+        auth = self.headers.get('Authorization', '')
+        if not auth.startswith('Basic '):
+            return None
+        return base64.b64decode(auth[6:]).decode().split(':', 1)[0]
+
+    @property
+    def password(self):
+        auth = self.headers.get('Authorization', '')
+        if not auth.startswith('Basic '):
+            return None
+        return base64.b64decode(auth[6:]).decode().split(':', 1)[1]
+
+
+class FakeMicroqAPI:
+    """Fake jobs api.
+
+    Example usage:
+
+    >>> api = FakeMicroqAPI()
+    >>> api.start()
+    >>> api.add_job('project', '42', source_url='http://example.com')
+    >>> client = UClient(api.root, username='worker', password='sqrrl')
+    >>> api.stop()
+    """
+
+    def __init__(self, username='worker', password='sqrrl', host='localhost',
+                 supports_append=True, supports_batch=True, seed=None,
+                 token_lifetime=None):
+        self.username = username
+        self.password = password
+        self.host = host
+        self.supports_append = supports_append
+        # Respond to fetch with a limit with a list of jobs
+        self.supports_batch = supports_batch
+        # Route (None for all routes) -> seconds or function that returns
+        # seconds, and route -> (failure rate, status code)
+        self.latency = {}
+        self.failures = {}
+        self.random = random.Random(seed)
+        self.jobs = {}
+        # Token -> time when it expires, None if never
+        self.tokens = {}
+        self.token_lifetime = token_lifetime
+        self.requests = []
+        self.lock = threading.Lock()
+        self.server = None
+        self.thread = None
+
+    @property
+    def root(self):
+        return 'http://{}:{}/rest_api'.format(
+            self.host, self.server.server_port)
+
+    def start(self):
+        api = self
+
+        class Handler(_FakeHandler):
+            fake_api = api
+
+        self.server = ThreadingHTTPServer((self.host, 0), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def add_job(self, project, job_id, source_url='http://example.com/src',
+                target_url='http://example.com/target', job_type='test',
+                image_url=None, environment=None):
+        with self.lock:
+            self.jobs[(project, job_id)] = {
+                'project': project, 'id': job_id, 'type': job_type,
+                'source_url': source_url, 'target_url': target_url,
+                'image_url': image_url, 'environment': environment or {},
+                'status': JOB_STATES.available, 'worker': None,
+                'output': '', 'processing_time': None,
+                'resource_usage': None,
+            }
+
+    def job(self, project, job_id):
+        return self.jobs[(project, job_id)]
+
+    def set_latency(self, seconds, route=None):
+        """Delay the responses of a route, or of all routes.
+
+        Args:
+          seconds (float or function): The delay, or a function that
+            returns a delay for each request.
+          route (str): Name of the route, e.g. 'fetch', None for all.
+        """
+        self.latency[route] = seconds
+
+    def set_failures(self, rate, route=None, status_code=503,
+                     retry_after=None):
+        """Fail a share of the calls to a route, or to all routes.
+
+        Args:
+          rate (float): Share of the calls that fail, 0 to 1.
+          route (str): Name of the route, e.g. 'claim', None for all.
+          status_code (int): Status code of the failures, None to drop the
+            connection without a response.
+          retry_after (str): Retry-After header of the failures.
+        """
+        self.failures[route] = (rate, status_code, retry_after)
+
+    def expire_tokens(self):
+        with self.lock:
+            self.tokens.clear()
+
+    def requests_to(self, name):
+        """Return the recorded requests that were routed to `name`"""
+        return [r for r in self.requests if r.route == name]
+
+    def handle(self, request):
+        """Return (status code, json data) for a request"""
+        with self.lock:
+            self.requests.append(request)
+        path_found = False
+        for method, pattern, name in ROUTES:
+            match = re.match(pattern, request.path)
+            path_found = path_found or bool(match)
+            if name == 'append_output' and not self.supports_append:
+                continue
+            if match and method == request.method:
+                request.route = name
+                if self._inject(request):
+                    return request.status_code, {'error': 'Injected failure'}
+                if name == 'token':
+                    if (request.username, request.password) != (
+                            self.username, self.password):
+                        return 401, {'error': 'Unauthorized'}
+                elif not self._valid_token(request.username):
+                    return 401, {'error': 'Unauthorized'}
+                with self.lock:
+                    return getattr(self, '_' + name)(
+                        request, **match.groupdict())
+        if path_found:
+            return 405, {'error': 'Method not allowed'}
+        return 404, {'error': 'Not found'}
+
+    def _inject(self, request):
+        """Delay the request and return True if it should fail"""
+        delay = self.latency.get(request.route, self.latency.get(None))
+        if callable(delay):
+            delay = delay()
+        if delay:
+            sleep(delay)
+        rate, status_code, retry_after = self.failures.get(
+            request.route, self.failures.get(None, (0, None, None)))
+        with self.lock:
+            failed = bool(rate) and self.random.random() < rate
+        if failed:
+            request.injected = True
+            request.status_code = status_code
+            request.retry_after = retry_after
+        return failed
+
+    def _valid_token(self, token):
+        with self.lock:
+            if token not in self.tokens:
+                return False
+            expires = self.tokens[token]
+        return expires is None or time() < expires
+
+    def _token(self, request):
+        token = uuid.uuid4().hex
+        self.tokens[token] = (
+            time() + self.token_lifetime if self.token_lifetime else None)
+        return 200, {'token': token}
+
+    def _job_list(self, request, project):
+        return 200, {'Jobs': [
+            self._job_data(job) for job in self.jobs.values()
+            if job['project'] == project]}
+
+    def _fetch(self, request, project=None):
+        job_type = request.query.get('type')
+        limit = int(request.query.get('limit') or 0)
+        jobs = []
+        for job in self.jobs.values():
+            if job['status'] != JOB_STATES.available:
+                continue
+            if project and job['project'] != project:
+                continue
+            if job_type and job['type'] != job_type:
+                continue
+            if not (limit and self.supports_batch):
+                return 200, self._job_data(job)
+            jobs.append(self._job_data(job))
+            if len(jobs) == limit:
+                break
+        if jobs:
+            return 200, {'Jobs': jobs}
+        return 404, {'error': 'No unclaimed jobs available'}
+
+    def _claim(self, request, project, job_id):
+        job = self.jobs[(project, job_id)]
+        if job['status'] != JOB_STATES.available:
+            return 409, {'error': 'Job already claimed'}
+        job['status'] = JOB_STATES.claimed
+        job['worker'] = (request.json or {}).get('Worker')
+        return 200, {}
+
+    def _unclaim(self, request, project, job_id):
+        job = self.jobs[(project, job_id)]
+        job['status'] = JOB_STATES.available
+        job['worker'] = None
+        return 200, {}
+
+    def _status(self, request, project, job_id):
+        job = self.jobs[(project, job_id)]
+        data = request.json
+        job['status'] = data['Status']
+        job['processing_time'] = data.get('ProcessingTime')
+        job['resource_usage'] = data.get('ResourceUsage')
+        return 200, {}
+
+    def _output(self, request, project, job_id):
+        self.jobs[(project, job_id)]['output'] = request.json['Output']
+        return 200, {}
+
+    def _append_output(self, request, project, job_id):
+        job = self.jobs[(project, job_id)]
+        data = request.json
+        if data['Offset'] != len(job['output']):
+            return 409, {'error': 'Offset does not match output length'}
+        job['output'] += data['Output']
+        return 200, {}
+
+    def _job_data(self, job):
+        job_url = '{}/v4/{}/jobs/{}'.format(
+            self.root, job['project'], job['id'])
+        return {'Job': {
+            'JobID': job['id'],
+            'Environment': job['environment'],
+            'URLS': {
+                'URL-claim': job_url + '/claim',
+                'URL-status': job_url + '/status',
+                'URL-output': job_url + '/output',
+                'URL-source': job['source_url'],
+                'URL-target': job['target_url'],
+                'URL-image': job['image_url'],
+            }}}
+
+
+class _FakeHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # The headers and the body are sent separately, without TCP_NODELAY
+    # each response would wait for the delayed ACK of the client
+    disable_nagle_algorithm = True
+    fake_api = None
+
+    def _handle(self):
+        path, _, query = self.path.partition('?')
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        request = FakeRequest(
+            self.command, path, dict(parse_qsl(query)), self.headers, body,
+            self.client_address[1])
+        status_code, data = self.fake_api.handle(request)
+        request.status_code = status_code
+        if status_code is None:
+            self.close_connection = True
+            return
+        payload = json.dumps(data).encode()
+        self.send_response(status_code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        if request.retry_after is not None:
+            self.send_header('Retry-After', request.retry_after)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    do_GET = do_PUT = do_DELETE = do_POST = do_PATCH = _handle
+
+    def log_message(self, *args):
+        """Suppress request logging"""
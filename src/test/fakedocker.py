@@ -0,0 +1,332 @@
+"""In-process stand-in for the Docker Engine API on a unix socket.
+
+Only the parts of the api that the worker uses are implemented. Containers
+do not run anything, the output and exit code of a container is decided by
+its command:
+
+  echo ARGS..  writes ARGS to stdout and exits with 0
+  env          writes the environment to stdout and exits with 0
+  fail ARGS..  writes ARGS to stderr and exits with 1
+  sleep N      exits with 0 after N seconds, or with 143 if stopped
+  sh ARGS..    waits until stopped, like the keep-alive of pooled
+               containers
+
+The same commands can be run in a container with exec.
+"""
+from http.server import BaseHTTPRequestHandler
+import json
+import re
+import socketserver
+import struct
+import threading
+from urllib.parse import parse_qsl, unquote
+import uuid
+
+ROUTES = [
+    ('GET', r'/_ping$', 'ping'),
+    ('GET', r'/system/df$', 'disk_usage'),
+    ('GET', r'/images/json$', 'list_images'),
+    ('GET', r'/images/(?P<name>.+)/json$', 'inspect_image'),
+    ('POST', r'/images/create$', 'pull'),
+    ('DELETE', r'/images/(?P<name>.+)$', 'remove_image'),
+    ('GET', r'/containers/json$', 'list_containers'),
+    ('POST', r'/containers/create$', 'create'),
+    ('POST', r'/containers/(?P<cid>\w+)/start$', 'start'),
+    ('POST', r'/containers/(?P<cid>\w+)/stop$', 'stop'),
+    ('POST', r'/containers/(?P<cid>\w+)/kill$', 'stop'),
+    ('POST', r'/containers/(?P<cid>\w+)/wait$', 'wait'),
+    ('GET', r'/containers/(?P<cid>\w+)/logs$', 'logs'),
+    ('GET', r'/containers/(?P<cid>\w+)/json$', 'inspect_container'),
+    ('GET', r'/containers/(?P<cid>\w+)/stats$', 'stats'),
+    ('DELETE', r'/containers/(?P<cid>\w+)$', 'remove_container'),
+    ('POST', r'/containers/(?P<cid>\w+)/exec$', 'exec_create'),
+    ('POST', r'/exec/(?P<exec_id>\w+)/start$', 'exec_start'),
+    ('GET', r'/exec/(?P<exec_id>\w+)/json$', 'exec_inspect'),
+]
+
+
+def run_command(cmd, env, stopped):
+    """Return (output frames, exit code) of a fake command"""
+    program, args = cmd[0], cmd[1:]
+    if program == 'echo':
+        return [(1, ' '.join(args) + '\n')], 0
+    if program == 'env':
+        return [(1, line + '\n') for line in env], 0
+    if program == 'fail':
+        return [(2, ' '.join(args) + '\n')], 1
+    if program == 'sleep':
+        return [], 143 if stopped.wait(float(args[0])) else 0
+    if program == 'sh':
+        stopped.wait()
+        return [], 0
+    return [(2, 'unknown command %s\n' % program)], 127
+
+
+class FakeContainer:
+
+    def __init__(self, image, cmd, env):
+        self.id = uuid.uuid4().hex
+        self.image = image
+        self.cmd = cmd
+        self.env = env
+        self.execs = 0
+        # Docker stats samples of the container
+        self.stats = [{
+            'cpu_stats': {'cpu_usage': {
+                'total_usage': 3000000000, 'usage_in_usermode': 2000000000,
+                'usage_in_kernelmode': 1000000000}},
+            'memory_stats': {'usage': 50000000, 'max_usage': 60000000},
+            'blkio_stats': {'io_service_bytes_recursive': [
+                {'op': 'Read', 'value': 4096},
+                {'op': 'Write', 'value': 8192}]},
+        }]
+        self.frames = []
+        self.exit_code = None
+        self.started = False
+        self.stopped = threading.Event()
+        self.exited = threading.Event()
+
+    def run(self):
+        self.frames, self.exit_code = run_command(
+            self.cmd, self.env, self.stopped)
+        self.exited.set()
+
+
+class FakeDockerDaemon:
+    """Fake docker daemon.
+
+    Example usage:
+
+    >>> daemon = FakeDockerDaemon(socket_path)
+    >>> daemon.registry['alpine:3.4'] = 'sha256:1234'
+    >>> daemon.start()
+    >>> docker = DockerAPI(socket_path)
+    >>> daemon.stop()
+    """
+
+    def __init__(self, socket_path):
+        self.socket_path = socket_path
+        # Images that can be pulled and images that exist on the host
+        self.registry = {}
+        self.images = {}
+        # Image id -> size in bytes and image config, like Labels and
+        # Entrypoint
+        self.sizes = {}
+        self.configs = {}
+        self.execs = {}
+        self.containers = {}
+        self.requests = []
+        self.lock = threading.Lock()
+        self.server = None
+        self.thread = None
+
+    def start(self):
+        daemon = self
+
+        class Handler(_FakeHandler):
+            fake_daemon = daemon
+
+        self.server = socketserver.ThreadingUnixStreamServer(
+            self.socket_path, Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        for container in list(self.containers.values()):
+            container.stopped.set()
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def requests_to(self, name):
+        return [r for r in self.requests if r[1] == name]
+
+    def handle(self, method, path, query, body):
+        """Return (status code, json data or a function that waits for and
+        returns the output frames)"""
+        path = re.sub(r'^/v[\d.]+', '', path)
+        for route_method, pattern, name in ROUTES:
+            match = re.match(pattern, path)
+            if match and method == route_method:
+                with self.lock:
+                    self.requests.append((method, name, query, body))
+                return getattr(self, '_' + name)(
+                    query, body, **{
+                        k: unquote(v) for k, v in match.groupdict().items()})
+        return 404, {'message': 'page not found'}
+
+    def _ping(self, query, body):
+        return 200, 'OK'
+
+    def _disk_usage(self, query, body):
+        image_ids = set(self.images.values())
+        return 200, {
+            'LayersSize': sum(self.sizes.get(i, 0) for i in image_ids),
+            'Images': [
+                {'Id': image_id, 'Size': self.sizes.get(image_id, 0),
+                 'SharedSize': 0, 'Created': 0,
+                 'RepoTags': [name for name, i in self.images.items()
+                              if i == image_id]}
+                for image_id in image_ids]}
+
+    def _list_images(self, query, body):
+        return 200, [{'Id': image_id, 'RepoTags': [name]}
+                     for name, image_id in self.images.items()]
+
+    def _inspect_image(self, query, body, name):
+        if name not in self.images:
+            return 404, {'message': 'No such image: ' + name}
+        image_id = self.images[name]
+        return 200, {'Id': image_id, 'Config': self.configs.get(image_id, {})}
+
+    def _pull(self, query, body):
+        name = '{}:{}'.format(query['fromImage'], query['tag'])
+        if name not in self.registry:
+            return 200, [
+                {'status': 'Pulling from ' + query['fromImage']},
+                {'error': 'manifest for {} not found'.format(name)}]
+        self.images[name] = self.registry[name]
+        return 200, [
+            {'status': 'Pulling from ' + query['fromImage']},
+            {'id': 'layer1', 'status': 'Downloading',
+             'progress': '[=>    ] 1MB/5MB'},
+            {'id': 'layer1', 'status': 'Pull complete'},
+            {'status': 'Downloaded newer image for ' + name}]
+
+    def _remove_image(self, query, body, name):
+        for ref, image_id in list(self.images.items()):
+            if name in (ref, image_id):
+                del self.images[ref]
+        return 200, []
+
+    def _list_containers(self, query, body):
+        return 200, [
+            {'Id': c.id, 'Image': c.image,
+             'ImageID': self.images.get(c.image),
+             'State': 'exited' if c.exited.is_set() else 'running'}
+            for c in self.containers.values()
+            if query.get('all') == '1' or not c.exited.is_set()]
+
+    def _create(self, query, body):
+        if body['Image'] not in self.images:
+            return 404, {'message': 'No such image: ' + body['Image']}
+        cmd = body.get('Cmd') or []
+        entrypoint = body.get('Entrypoint') or self.configs.get(
+            self.images[body['Image']], {}).get('Entrypoint') or []
+        container = FakeContainer(body['Image'], entrypoint + cmd, body['Env'])
+        self.containers[container.id] = container
+        return 201, {'Id': container.id}
+
+    def _start(self, query, body, cid):
+        container = self.containers[cid]
+        container.started = True
+        thread = threading.Thread(target=container.run)
+        thread.daemon = True
+        thread.start()
+        return 204, None
+
+    def _stop(self, query, body, cid):
+        self.containers[cid].stopped.set()
+        return 204, None
+
+    def _wait(self, query, body, cid):
+        container = self.containers[cid]
+        container.exited.wait()
+        return 200, {'StatusCode': container.exit_code}
+
+    def _logs(self, query, body, cid):
+        container = self.containers[cid]
+
+        def frames():
+            if query.get('follow') == '1':
+                container.exited.wait()
+            return container.frames
+        return 200, frames
+
+    def _inspect_container(self, query, body, cid):
+        if cid not in self.containers:
+            return 404, {'message': 'No such container: ' + cid}
+        container = self.containers[cid]
+        return 200, {'Id': cid, 'State': {
+            'Running': container.started and not container.exited.is_set(),
+            'ExitCode': container.exit_code}}
+
+    def _exec_create(self, query, body, cid):
+        container = self.containers[cid]
+        if container.exited.is_set():
+            return 409, {'message': 'Container is not running'}
+        container.execs += 1
+        exec_id = uuid.uuid4().hex
+        self.execs[exec_id] = {
+            'container': container, 'cmd': body['Cmd'], 'env': body['Env'],
+            'exit_code': None}
+        return 201, {'Id': exec_id}
+
+    def _exec_start(self, query, body, exec_id):
+        instance = self.execs[exec_id]
+
+        def frames():
+            output, instance['exit_code'] = run_command(
+                instance['cmd'], instance['env'],
+                instance['container'].stopped)
+            return output
+        return 200, frames
+
+    def _exec_inspect(self, query, body, exec_id):
+        instance = self.execs[exec_id]
+        return 200, {'ID': exec_id, 'ExitCode': instance['exit_code'],
+                     'Running': instance['exit_code'] is None}
+
+    def _stats(self, query, body, cid):
+        return 200, self.containers[cid].stats
+
+    def _remove_container(self, query, body, cid):
+        if cid not in self.containers:
+            return 404, {'message': 'No such container: ' + cid}
+        self.containers.pop(cid).stopped.set()
+        return 204, None
+
+
+class _FakeHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    fake_daemon = None
+
+    def _handle(self):
+        path, _, query = self.path.partition('?')
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        status_code, data = self.fake_daemon.handle(
+            self.command, path, dict(parse_qsl(query)),
+            json.loads(body.decode()) if body else None)
+        if callable(data):
+            # Like docker, send the headers before the output of the
+            # container and close the connection after it
+            self.send_response(status_code)
+            self.send_header('Content-Type', 'application/json')
+            self.end_headers()
+            self.wfile.write(b''.join(
+                struct.pack('>BxxxL', stream, len(text.encode()))
+                + text.encode() for stream, text in data()))
+            self.close_connection = True
+            return
+        if re.search(r'/(images/create|stats)$', path):
+            payload = b''.join(
+                json.dumps(message).encode() + b'\r\n' for message in data)
+        elif data == 'OK':
+            payload = b'OK'
+        elif data is None:
+            payload = b''
+        else:
+            payload = json.dumps(data).encode()
+        self.send_response(status_code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    do_GET = do_POST = do_DELETE = _handle
+
+    def log_message(self, *args):
+        """Suppress request logging"""
@@ -0,0 +1,52 @@
+import unittest
+
+import pytest
+
+from test.benchmark import format_result, percentile, run_benchmark
+
+
+class TestBenchmark(unittest.TestCase):
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(percentile(values, 50), 50)
+        self.assertEqual(percentile(values, 99), 99)
+        self.assertEqual(percentile([3.], 90), 3.)
+        self.assertIsNone(percentile([], 50))
+
+    def test_small_run(self):
+        """Test that the benchmark processes all jobs and reports them"""
+        result = run_benchmark(jobs=5, output_bytes=1000, timeout=60)
+        self.assertEqual(result['done'], 5)
+        self.assertEqual(result['statuses'], {'FINISHED': 5})
+        self.assertEqual(result['api_calls']['status'], 10)
+        self.assertGreater(result['jobs_per_second'], 0)
+        self.assertIsNotNone(result['percentiles']['claim'][50])
+        self.assertIn('jobs/s', format_result(result))
+
+
+@pytest.mark.benchmark
+class TestThroughput(unittest.TestCase):
+    """Benchmarks, run with `pytest --runbenchmark -s` to see the reports"""
+
+    def run_benchmark(self, **kwargs):
+        result = run_benchmark(**kwargs)
+        print('\n' + format_result(result))
+        self.assertEqual(result['done'], result['jobs'])
+        return result
+
+    def test_short_jobs(self):
+        self.run_benchmark(jobs=200)
+
+    def test_short_jobs_with_slots(self):
+        self.run_benchmark(jobs=200, slots=4, prefetch=2)
+
+    def test_slow_api(self):
+        self.run_benchmark(jobs=100, slots=4, latency=.02)
+
+    def test_output(self):
+        self.run_benchmark(jobs=50, job_duration=.5, output_bytes=1000000)
+
+    def test_unreliable_api(self):
+        self.run_benchmark(
+            jobs=50, failure_rate=.02, failure_status=None)
@@ -0,0 +1,317 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from test.fakedocker import FakeDockerDaemon
+from uworker import uworker
+from uworker.images import (
+    ImageCache, ImageCollector, ImagePrefetcher, ImageUsage)
+from uworker.pool import ContainerPool
+from uworker.resources import Resources
+from utils import logs
+from utils.docker_api import (
+    DockerAPI, DockerAPIError, registry_auth, split_image_reference)
+
+TEST_IMAGE = 'alpine:3.4'
+
+
+class BaseTestWithFakeDocker(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.socket_path = os.path.join(self.tmpdir, 'docker.sock')
+        self.daemon = FakeDockerDaemon(self.socket_path)
+        self.daemon.registry[TEST_IMAGE] = 'sha256:abc'
+        self.daemon.start()
+        self.docker = DockerAPI(
+            self.socket_path, config_file=os.path.join(self.tmpdir, 'none'))
+
+    def tearDown(self):
+        self.daemon.stop()
+        shutil.rmtree(self.tmpdir)
+
+
+class TestDockerAPI(BaseTestWithFakeDocker):
+
+    def test_ping(self):
+        """Test that ping tells if the daemon responds"""
+        self.assertTrue(self.docker.ping())
+        self.assertFalse(DockerAPI(self.socket_path + '.missing').ping())
+
+    def test_pull_and_inspect(self):
+        """Test pull of an image and failed pull of a missing image"""
+        self.assertIsNone(self.docker.inspect_image(TEST_IMAGE))
+        messages = []
+        self.docker.pull_image(TEST_IMAGE, messages.append)
+        self.assertEqual(messages[-1]['status'],
+                         'Downloaded newer image for alpine:3.4')
+        self.assertEqual(
+            self.docker.inspect_image(TEST_IMAGE)['Id'], 'sha256:abc')
+        with self.assertRaises(DockerAPIError):
+            self.docker.pull_image('alpine:missing')
+
+    def test_run_container(self):
+        """Test the life cycle of a container"""
+        self.docker.pull_image(TEST_IMAGE)
+        container = self.docker.create_container(
+            TEST_IMAGE, ['echo', 'hello'], env={'A': '1'})
+        self.docker.start_container(container)
+        self.assertEqual(
+            list(self.docker.container_logs(container)),
+            [('stdout', b'hello\n')])
+        self.assertEqual(self.docker.wait_container(container), 0)
+        self.docker.remove_container(container)
+        with self.assertRaises(DockerAPIError) as cm:
+            self.docker.inspect_container(container)
+        self.assertEqual(cm.exception.status_code, 404)
+
+    def test_exec(self):
+        """Test that a command is started before its output is read"""
+        self.docker.pull_image(TEST_IMAGE)
+        container = self.docker.create_container(TEST_IMAGE, ['sleep', '5'])
+        self.docker.start_container(container)
+        exec_id = self.docker.exec_create(container, ['echo', 'hello'])
+        output = self.docker.exec_start(exec_id)
+        self.assertEqual(len(self.daemon.requests_to('exec_start')), 1)
+        self.assertEqual(list(output), [('stdout', b'hello\n')])
+        self.assertEqual(self.docker.exec_inspect(exec_id)['ExitCode'], 0)
+        self.docker.remove_container(container)
+
+    def test_image_reference(self):
+        """Test splitting of image references"""
+        self.assertEqual(
+            split_image_reference('registry:5000/name:tag'),
+            ('registry:5000/name', 'tag'))
+        self.assertEqual(
+            split_image_reference('registry:5000/name'),
+            ('registry:5000/name', 'latest'))
+        self.assertEqual(split_image_reference('alpine'), ('alpine', 'latest'))
+
+    def test_registry_auth(self):
+        """Test that credentials from `docker login` are used"""
+        config_file = os.path.join(self.tmpdir, 'config.json')
+        with open(config_file, 'w') as out:
+            out.write('{"auths": {"https://registry.com": '
+                      '{"auth": "dXNlcjpwYXNz"}}}')
+        self.assertIsNotNone(
+            registry_auth('registry.com/name:tag', config_file))
+        self.assertIsNone(registry_auth('alpine:3.4', config_file))
+
+
+class BaseExecutorTestWithFakeDocker(BaseTestWithFakeDocker):
+
+    def setUp(self):
+        super(BaseExecutorTestWithFakeDocker, self).setUp()
+        self.log = logs.get_logger('unittest', to_file=False, to_stdout=True)
+        self.orig_cache = uworker.DockerExecutor.image_cache
+        uworker.DockerExecutor.image_cache = ImageCache()
+        self.messages = []
+
+    def tearDown(self):
+        uworker.DockerExecutor.image_cache = self.orig_cache
+        super(BaseExecutorTestWithFakeDocker, self).tearDown()
+
+    def get_executor(self, image=TEST_IMAGE, **kwargs):
+        return uworker.DockerEngineExecutor(
+            'Test', image, self.log, docker=self.docker, **kwargs)
+
+
+class TestDockerEngineExecutor(BaseExecutorTestWithFakeDocker):
+
+    def test_execute_success(self):
+        """Test that the image is pulled and the container is removed"""
+        executor = self.get_executor(environment={'TESTENV': 'test_env'})
+        exit_code, _ = executor.execute(['env'], self.messages.append)
+        self.assertEqual(exit_code, 0)
+        self.assertIn('STDOUT: TESTENV=test_env', self.messages[-1])
+        self.assertIn('PULL: layer1 Pull complete', self.messages[-1])
+        self.assertNotIn('Downloading', self.messages[-1])
+        self.assertEqual(self.daemon.containers, {})
+        self.assertEqual(
+            self.daemon.requests_to('create')[-1][3]['HostConfig'],
+            {'NetworkMode': 'host'})
+        self.assertEqual(len(self.daemon.requests_to('pull')), 1)
+        exit_code, _ = self.get_executor().execute(['echo'], None)
+        self.assertEqual(exit_code, 0)
+        self.assertEqual(len(self.daemon.requests_to('pull')), 1)
+
+    def test_resources(self):
+        """Test that containers get the resource limits of the job"""
+        executor = self.get_executor(resources=Resources(2, 1024 ** 3))
+        exit_code, _ = executor.execute(['echo'], None)
+        self.assertEqual(exit_code, 0)
+        self.assertEqual(
+            self.daemon.requests_to('create')[-1][3]['HostConfig'],
+            {'NetworkMode': 'host', 'NanoCpus': 2000000000,
+             'Memory': 1024 ** 3})
+
+    def test_resource_usage(self):
+        """Test that the usage of a container comes from docker stats"""
+        executor = self.get_executor()
+        exit_code, _ = executor.execute(['sleep', '.5'], None)
+        self.assertEqual(exit_code, 0)
+        usage = executor.usage.as_dict()
+        self.assertEqual(usage['UserTime'], 2.)
+        self.assertEqual(usage['SystemTime'], 1.)
+        self.assertEqual(usage['MaxRss'], 60000000)
+        self.assertEqual(usage['BlockRead'], 4096)
+        self.assertEqual(usage['BlockWrite'], 8192)
+        self.assertEqual(usage['OutputBytes'], executor.output.size)
+
+    def test_execute_failure(self):
+        """Test exit code and stderr of a failing container"""
+        exit_code, _ = self.get_executor().execute(
+            ['fail', 'no such file'], self.messages.append)
+        self.assertEqual(exit_code, 1)
+        self.assertIn('STDERR: no such file', self.messages[-1])
+
+    def test_pull_failure(self):
+        """Test that a failed pull is reported in the output"""
+        exit_code, _ = self.get_executor('alpine:missing').execute(
+            ['echo'], self.messages.append)
+        self.assertEqual(exit_code, 1)
+        self.assertIn('Could not pull image alpine:missing',
+                      self.messages[-1])
+        self.assertEqual(self.daemon.requests_to('create'), [])
+
+    def test_removed_image(self):
+        """Test that an image that was removed after it was cached is
+        pulled again"""
+        exit_code, _ = self.get_executor().execute(['echo'], None)
+        self.assertEqual(exit_code, 0)
+        self.docker.remove_image(TEST_IMAGE)
+        exit_code, _ = self.get_executor().execute(
+            ['echo', 'again'], self.messages.append)
+        self.assertEqual(exit_code, 0)
+        self.assertIn('STDOUT: again', self.messages[-1])
+        self.assertEqual(len(self.daemon.requests_to('pull')), 2)
+        self.assertEqual(len(self.daemon.requests_to('create')), 3)
+
+    def test_timeout(self):
+        """Test that the container is stopped after the timeout"""
+        exit_code, processing_time = self.get_executor().execute(
+            ['sleep', '10'], self.messages.append, timeout=1)
+        self.assertEqual(exit_code, 143)
+        self.assertLess(processing_time, 5)
+        self.assertIn('Killed Test process', self.messages[-1])
+
+
+class TestImageCollector(BaseTestWithFakeDocker):
+
+    def setUp(self):
+        super(TestImageCollector, self).setUp()
+        self.log = logs.get_logger('unittest', to_file=False, to_stdout=True)
+        for name in ('busy', 'old', 'new', 'running'):
+            self.daemon.images[name + ':1'] = 'sha256:' + name
+            self.daemon.sizes['sha256:' + name] = 100
+        self.usage = ImageUsage()
+        self.cache = ImageCache()
+        self.cache.add('old:1', 'sha256:old')
+        container = self.docker.create_container('busy:1', ['sleep', '10'])
+        self.docker.start_container(container)
+
+    def collect(self, budget):
+        collector = ImageCollector(
+            self.docker, budget, self.usage, self.cache, self.log)
+        return collector.collect()
+
+    def test_within_budget(self):
+        """Test that nothing is removed when within the budget"""
+        self.assertEqual(self.collect(400), [])
+        self.assertEqual(len(self.daemon.images), 4)
+
+    def test_least_recently_used(self):
+        """Test that the least recently used images are removed first"""
+        self.usage.touch('old:1')
+        self.usage.touch('new')
+        self.usage.touch('new:1')
+        with self.usage.using('running:1'):
+            self.assertEqual(self.collect(350), ['sha256:old'])
+            self.assertIsNone(self.cache.get('old:1'))
+            self.assertEqual(self.collect(0), ['sha256:new'])
+        self.assertEqual(sorted(self.daemon.images), ['busy:1', 'running:1'])
+
+    def test_prefetched_image(self):
+        """Test that an image that was only prefetched goes first and that
+        the prefetcher forgets it"""
+        self.daemon.registry['prefetched:1'] = 'sha256:prefetched'
+        self.daemon.sizes['sha256:prefetched'] = 100
+        self.usage.touch('old:1')
+        self.usage.touch('new:1')
+        self.usage.touch('running:1')
+        executor = uworker.DockerEngineExecutor(
+            'Prefetch', 'prefetched:1', self.log, docker=self.docker)
+        executor.image_usage = self.usage
+        executor.image_cache = self.cache
+        self.assertEqual(executor.pull_image(None, touch=False), 0)
+        self.assertIsNone(self.usage.last_use(['prefetched:1']))
+        prefetcher = ImagePrefetcher(None, self.log)
+        prefetcher.learn('project', 'prefetched:1')
+        collector = ImageCollector(
+            self.docker, 400, self.usage, self.cache, self.log)
+        collector.on_remove = prefetcher.forget
+        self.assertEqual(collector.collect(), ['sha256:prefetched'])
+        self.assertEqual(prefetcher.pending(), [])
+
+
+class TestContainerPool(BaseExecutorTestWithFakeDocker):
+
+    def setUp(self):
+        super(TestContainerPool, self).setUp()
+        self.daemon.configs['sha256:abc'] = {
+            'Labels': {ContainerPool.LABEL: '2'}}
+        self.pool = ContainerPool(self.docker, self.log)
+
+    def tearDown(self):
+        self.pool.close()
+        super(TestContainerPool, self).tearDown()
+
+    def get_executor(self, image=TEST_IMAGE, **kwargs):
+        return super(TestContainerPool, self).get_executor(
+            image, container_pool=self.pool, **kwargs)
+
+    def run_job(self, *args, **kwargs):
+        return self.get_executor().execute(
+            list(args), self.messages.append, **kwargs)[0]
+
+    def test_reuse(self):
+        """Test that jobs share a container until the job limit"""
+        self.assertEqual(self.run_job('echo', 'job1'), 0)
+        self.assertIn('STDOUT: job1', self.messages[-1])
+        self.assertEqual(self.run_job('echo', 'job2'), 0)
+        self.assertEqual(len(self.daemon.requests_to('create')), 1)
+        self.assertEqual(self.daemon.containers, {})
+        self.assertEqual(self.run_job('echo', 'job3'), 0)
+        self.assertEqual(len(self.daemon.requests_to('create')), 2)
+        self.assertEqual(len(self.daemon.containers), 1)
+        container = list(self.daemon.containers.values())[0]
+        self.assertEqual(container.cmd, ContainerPool.KEEP_ALIVE)
+
+    def test_entrypoint(self):
+        """Test that the entrypoint of the image is called with the args"""
+        self.daemon.configs['sha256:abc']['Entrypoint'] = ['echo', 'args:']
+        self.assertEqual(self.run_job('source', 'target'), 0)
+        self.assertIn('STDOUT: args: source target', self.messages[-1])
+
+    def test_recycle_on_failure(self):
+        """Test that a container is replaced after a failed job"""
+        self.assertEqual(self.run_job('fail', 'error'), 1)
+        self.assertEqual(self.daemon.containers, {})
+        self.assertEqual(self.run_job('echo', 'job'), 0)
+        self.assertEqual(len(self.daemon.requests_to('create')), 2)
+
+    def test_timeout(self):
+        """Test that the container of a job that times out is removed"""
+        self.assertEqual(self.run_job('sleep', '10', timeout=1), 137)
+        self.assertIn('Killed Test process', self.messages[-1])
+        self.assertEqual(self.daemon.containers, {})
+
+    def test_no_opt_in(self):
+        """Test that images without the label get a container per job"""
+        del self.daemon.configs['sha256:abc']
+        self.assertEqual(self.run_job('echo', 'job1'), 0)
+        self.assertEqual(self.run_job('echo', 'job2'), 0)
+        self.assertEqual(len(self.daemon.requests_to('create')), 2)
+        self.assertEqual(self.daemon.requests_to('exec_create'), [])
+        self.assertEqual(self.daemon.containers, {})
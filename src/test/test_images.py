@@ -0,0 +1,221 @@
+import threading
+from time import sleep
+import unittest
+
+from uworker.images import (
+    ImageCache, ImagePrefetcher, ImageUsage, parse_size)
+from uworker import uworker
+from utils import logs
+
+
+class TestImageCache(unittest.TestCase):
+
+    def test_cache(self):
+        """Test add, ttl and invalidation of images"""
+        cache = ImageCache(ttl=0.05)
+        self.assertIsNone(cache.get('alpine:3.4'))
+        cache.add('alpine:3.4', 'sha256:abc')
+        cache.add('alpine:latest', 'sha256:abc')
+        cache.add('ubuntu', 'sha256:def')
+        self.assertEqual(cache.get('alpine:3.4'), 'sha256:abc')
+        cache.invalidate(image_id='sha256:abc')
+        self.assertIsNone(cache.get('alpine:3.4'))
+        self.assertIsNone(cache.get('alpine:latest'))
+        self.assertEqual(cache.get('ubuntu'), 'sha256:def')
+        cache.invalidate('ubuntu')
+        self.assertIsNone(cache.get('ubuntu'))
+        cache.add('ubuntu', 'sha256:def')
+        sleep(0.06)
+        self.assertIsNone(cache.get('ubuntu'))
+
+
+class TestImageUsage(unittest.TestCase):
+
+    def test_usage(self):
+        """Test last use and use of images"""
+        usage = ImageUsage()
+        self.assertIsNone(usage.last_use(['alpine:3.4']))
+        usage.touch('alpine')
+        first = usage.last_use(['alpine:latest'])
+        self.assertIsNotNone(first)
+        with usage.using('alpine:3.4'):
+            with usage.using('alpine:3.4'):
+                self.assertTrue(usage.in_use(['alpine:3.4']))
+            self.assertTrue(usage.in_use(['alpine:3.4']))
+        self.assertFalse(usage.in_use(['alpine:3.4']))
+        self.assertGreaterEqual(
+            usage.last_use(['alpine:3.4', 'alpine:latest']), first)
+
+    def test_parse_size(self):
+        """Test parsing of disk budgets"""
+        self.assertEqual(parse_size('1024'), 1024)
+        self.assertEqual(parse_size('1.5K'), 1536)
+        self.assertEqual(parse_size('20GB'), 20 * 1024 ** 3)
+        self.assertEqual(parse_size('2 TiB'), 2 * 1024 ** 4)
+        with self.assertRaises(ValueError):
+            parse_size('lots')
+
+
+class TestDockerExecutorImageCache(unittest.TestCase):
+
+    def setUp(self):
+        self.log = logs.get_logger('unittest', to_file=False, to_stdout=True)
+        self.orig_cache = uworker.DockerExecutor.image_cache
+        uworker.DockerExecutor.image_cache = ImageCache()
+        self.lookups = []
+        self.local_images = {}
+
+    def tearDown(self):
+        uworker.DockerExecutor.image_cache = self.orig_cache
+
+    def get_executor(self, image):
+        executor = uworker.DockerExecutor('Test', image, self.log)
+
+        def image_id():
+            self.lookups.append(image)
+            return self.local_images.get(image)
+
+        executor._image_id = image_id
+        return executor
+
+    def test_cached_presence(self):
+        """Test that docker is only asked once for an existing image"""
+        self.local_images['alpine:3.4'] = 'sha256:abc'
+        self.assertTrue(self.get_executor('alpine:3.4').image_exists())
+        self.assertTrue(self.get_executor('alpine:3.4').image_exists())
+        self.assertEqual(self.lookups, ['alpine:3.4'])
+        uworker.DockerExecutor.image_cache.invalidate(image_id='sha256:abc')
+        del self.local_images['alpine:3.4']
+        self.assertFalse(self.get_executor('alpine:3.4').image_exists())
+        self.assertFalse(self.get_executor('alpine:3.4').image_exists())
+        self.assertEqual(self.lookups, ['alpine:3.4'] * 3)
+
+    def test_refresh_after_pull(self):
+        """Test that the cache is refreshed after a pull"""
+        executor = self.get_executor('alpine:3.4')
+
+        def pull(command_args, output_callback, timeout=None):
+            self.local_images['alpine:3.4'] = 'sha256:abc'
+            return 0, 0
+
+        pulls = []
+        orig_execute = uworker.CommandExecutor.execute
+
+        def execute(ce, command_args, output_callback, timeout=None):
+            if ce.process_name == 'Pull image':
+                pulls.append(command_args)
+                return pull(command_args, output_callback)
+            return orig_execute(ce, command_args, output_callback, timeout)
+
+        uworker.CommandExecutor.execute = execute
+        try:
+            self.assertEqual(executor.pull_image(None), 0)
+            executor = self.get_executor('alpine:3.4')
+            self.assertEqual(executor.pull_image(None), 0)
+        finally:
+            uworker.CommandExecutor.execute = orig_execute
+        self.assertEqual(pulls, [['alpine:3.4']])
+        self.assertEqual(
+            uworker.DockerExecutor.image_cache.get('alpine:3.4'), 'sha256:abc')
+
+    def test_one_pull_per_image(self):
+        """Test that concurrent executors pull an image only once"""
+        pulls = []
+        release = threading.Event()
+
+        def pull(executor, output_callback):
+            pulls.append(executor.image_url)
+            release.wait(5)
+            self.local_images[executor.image_url] = 'sha256:abc'
+            executor.image_exists(refresh=True)
+            return 0
+
+        orig_pull = uworker.DockerExecutor._pull
+        uworker.DockerExecutor._pull = pull
+        try:
+            results = []
+            threads = [
+                threading.Thread(target=lambda: results.append(
+                    self.get_executor('alpine:3.4').pull_image(None)))
+                for _ in range(3)]
+            for thread in threads:
+                thread.start()
+            sleep(0.1)
+            release.set()
+            for thread in threads:
+                thread.join()
+        finally:
+            uworker.DockerExecutor._pull = orig_pull
+        self.assertEqual(results, [0, 0, 0])
+        self.assertEqual(pulls, ['alpine:3.4'])
+
+
+class FakeExecutor:
+
+    def __init__(self, image_url, local_images, pulls):
+        self.image_url = image_url
+        self.local_images = local_images
+        self.pulls = pulls
+
+    def image_exists(self):
+        return self.image_url in self.local_images
+
+    def pull_image(self, output_callback, touch=True):
+        self.pulls.append(self.image_url)
+        self.local_images.add(self.image_url)
+        return 0
+
+
+class TestImagePrefetcher(unittest.TestCase):
+
+    def setUp(self):
+        self.log = logs.get_logger('unittest', to_file=False, to_stdout=True)
+        self.local_images = set()
+        self.pulls = []
+        self.prefetcher = ImagePrefetcher(
+            lambda url: FakeExecutor(url, self.local_images, self.pulls),
+            self.log, images_per_project=2)
+
+    def test_learn(self):
+        """Test that the most recent images of each project are kept"""
+        self.prefetcher.learn('p1', 'image:1')
+        self.prefetcher.learn('p1', 'image:2')
+        self.prefetcher.learn('p2', 'other:1')
+        self.prefetcher.learn('p1', 'image:1')
+        self.prefetcher.learn('p1', 'image:3')
+        self.prefetcher.want('next:1')
+        self.assertEqual(
+            self.prefetcher.pending(),
+            ['next:1', 'image:3', 'image:1', 'other:1'])
+        self.assertEqual(
+            self.prefetcher.pending(), ['image:3', 'image:1', 'other:1'])
+
+    def test_bounds(self):
+        """Test that at most max_images are kept and that images that no
+        job has used for max_age are forgotten"""
+        self.prefetcher.max_images = 3
+        for project in ('p1', 'p2', 'p3', 'p4'):
+            self.prefetcher.learn(project, project + ':1')
+        self.assertEqual(
+            self.prefetcher.pending(), ['p4:1', 'p3:1', 'p2:1'])
+        self.prefetcher.forget('p3:1')
+        self.assertEqual(self.prefetcher.pending(), ['p4:1', 'p2:1'])
+        self.prefetcher.max_age = 0
+        self.assertEqual(self.prefetcher.pending(), [])
+
+    def test_background_pulls(self):
+        """Test that missing images are pulled in the background"""
+        self.local_images.add('image:1')
+        self.prefetcher.learn('p1', 'image:1')
+        self.prefetcher.learn('p1', 'image:2')
+        self.prefetcher.start()
+        try:
+            self.prefetcher.want('next:1')
+            for _ in range(100):
+                if len(self.pulls) == 2:
+                    break
+                sleep(0.01)
+        finally:
+            self.prefetcher.close()
+        self.assertEqual(sorted(self.pulls), ['image:2', 'next:1'])
+        self.assertFalse(self.prefetcher.thread.is_alive())
@@ -0,0 +1,212 @@
+import os
+import shutil
+import tempfile
+import threading
+from time import time
+import unittest
+
+import pytest
+
+from test.fakeapi import FakeMicroqAPI
+from test.fakedocker import FakeDockerDaemon
+from test.test_uworker import BaseWorkerWithoutApiTest
+from uclient.uclient import Job
+from utils.defs import JOB_STATES
+from utils import logs
+from utils.docker_api import DockerAPI
+from uworker.journal import JobJournal, process_start_time
+from uworker.output import OutputBuffer, OutputUploader
+from uworker import uworker
+
+
+class FakeJob:
+    url_claim = 'http://example.com/jobs/42/claim'
+    url_status = 'http://example.com/jobs/42/status'
+    url_output = 'http://example.com/jobs/42/output'
+    url_source = 'http://example.com/src'
+    project = 'project'
+
+
+class TestJobJournal(unittest.TestCase):
+
+    def test_journal(self):
+        """Test that jobs are recorded until they are removed"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            journal = JobJournal(os.path.join(tmpdir, 'journal'))
+            key = journal.add(FakeJob())
+            journal.update(key, started=1., container='abc')
+            journal.write_spool(key, b'partial output')
+            entries = JobJournal(journal.directory).entries()
+            self.assertEqual(len(entries), 1)
+            self.assertEqual(entries[0]['key'], key)
+            self.assertEqual(entries[0]['url_status'], FakeJob.url_status)
+            self.assertEqual(entries[0]['started'], 1.)
+            self.assertEqual(entries[0]['container'], 'abc')
+            self.assertEqual(entries[0]['pid'], os.getpid())
+            self.assertEqual(
+                entries[0]['pid_start'], process_start_time(os.getpid()))
+            self.assertEqual(journal.read_spool(key), b'partial output')
+            journal.remove(key)
+            journal.remove(key)
+            self.assertEqual(journal.entries(), [])
+            self.assertEqual(journal.read_spool(key), b'')
+            self.assertEqual(os.listdir(journal.directory), [])
+
+    def test_process_start_time(self):
+        """Test that processes are told apart by their start time"""
+        start = process_start_time(os.getpid())
+        if start is None:
+            self.skipTest('No /proc')
+        self.assertEqual(process_start_time(os.getpid()), start)
+        self.assertLessEqual(process_start_time(os.getppid()), start)
+        self.assertIsNone(process_start_time(2 ** 22 + 1))
+
+    def test_spool(self):
+        """Test that the uploader spools the output while the job runs"""
+        spooled = []
+        output = OutputBuffer(100, 100)
+        uploader = OutputUploader(
+            None, None, logs.get_logger('test', to_file=False),
+            spool=spooled.append)
+        uploader.interval = .01
+        uploader.start(output)
+        output.write(b'partial output')
+        while not spooled:
+            uploader.stopped.wait(.01)
+        uploader.close()
+        self.assertEqual(spooled, [b'partial output'])
+
+
+class TestReconcile(BaseWorkerWithoutApiTest):
+    """Test that a restarted worker reports the jobs it left behind"""
+
+    @pytest.fixture(autouse=True)
+    def fake_api(self, environment):
+        self.fake_api = FakeMicroqAPI()
+        self.fake_api.start()
+        self.fake_api.add_job('project', '42')
+        self.monkeypatch.setenv('UWORKER_JOB_API_ROOT', self.fake_api.root)
+        self.monkeypatch.setenv(
+            'UWORKER_JOB_API_USERNAME', self.fake_api.username)
+        self.monkeypatch.setenv(
+            'UWORKER_JOB_API_PASSWORD', self.fake_api.password)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            self.monkeypatch.setenv(
+                'UWORKER_JOURNAL', os.path.join(tmpdir, 'journal'))
+            yield
+        self.fake_api.stop()
+
+    def claim_job(self):
+        """Claim a job like a worker that then dies"""
+        w = uworker.UWorker()
+        job = Job.fetch(w.api, project='project')
+        self.assertTrue(w.claim_job(job))
+        return w.journal, w.journal.key(job.url_claim)
+
+    def test_claimed_job(self):
+        """Test that a job that was not started is released"""
+        journal, key = self.claim_job()
+        self.assertEqual(
+            self.fake_api.job('project', '42')['status'], JOB_STATES.claimed)
+        uworker.UWorker().reconcile_journal()
+        self.assertEqual(
+            self.fake_api.job('project', '42')['status'],
+            JOB_STATES.available)
+        self.assertEqual(journal.entries(), [])
+
+    def test_interrupted_job(self):
+        """Test that a started job is failed with its spooled output"""
+        journal, key = self.claim_job()
+        journal.update(key, started=time() - 10)
+        journal.write_spool(key, b'Processing...')
+        uworker.UWorker().reconcile_journal()
+        job = self.fake_api.job('project', '42')
+        self.assertEqual(job['status'], JOB_STATES.failed)
+        self.assertEqual(
+            job['output'],
+            'Processing...\nJob interrupted, the worker was restarted')
+        self.assertGreaterEqual(job['processing_time'], 10)
+        self.assertEqual(journal.entries(), [])
+
+    def test_gone_container(self):
+        """Test that a job whose container is gone is failed"""
+        self.monkeypatch.setattr(
+            uworker, '_container_exists', lambda container: False)
+        journal, key = self.claim_job()
+        journal.update(key, started=time(), container='abc')
+        uworker.UWorker().reconcile_journal()
+        self.assertEqual(
+            self.fake_api.job('project', '42')['status'], JOB_STATES.failed)
+        self.assertEqual(journal.entries(), [])
+
+    def test_running_worker(self):
+        """Test that the jobs of a worker that is alive are left alone"""
+        journal, key = self.claim_job()
+        journal.update(
+            key, pid=os.getppid(), pid_start=process_start_time(os.getppid()))
+        uworker.UWorker().reconcile_journal()
+        self.assertEqual(
+            self.fake_api.job('project', '42')['status'], JOB_STATES.claimed)
+        self.assertEqual(len(journal.entries()), 1)
+
+    def test_reused_pid(self):
+        """Test that a process that got the pid of a dead worker is not
+        taken for the worker"""
+        if process_start_time(os.getppid()) is None:
+            self.skipTest('No /proc')
+        journal, key = self.claim_job()
+        journal.update(
+            key, pid=os.getppid(),
+            pid_start=process_start_time(os.getppid()) + 1)
+        uworker.UWorker().reconcile_journal()
+        self.assertEqual(
+            self.fake_api.job('project', '42')['status'],
+            JOB_STATES.available)
+        self.assertEqual(journal.entries(), [])
+
+    def test_reattached_container(self):
+        """Test that a job whose container still runs keeps its resources
+        and is stopped at the timeout of the job"""
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        daemon = FakeDockerDaemon(os.path.join(tmpdir, 'docker.sock'))
+        daemon.registry['alpine:latest'] = 'sha256:abc'
+        daemon.start()
+        self.addCleanup(daemon.stop)
+        docker = DockerAPI(
+            daemon.socket_path, config_file=os.path.join(tmpdir, 'none'))
+        docker.pull_image('alpine:latest')
+        container = docker.create_container(
+            'alpine:latest', ['sleep', '10'])
+        docker.start_container(container)
+        self.monkeypatch.setattr(uworker, 'DockerAPI', lambda: docker)
+        self.monkeypatch.setenv('UWORKER_JOB_TIMEOUT', '11')
+
+        journal, key = self.claim_job()
+        journal.update(
+            key, started=time() - 10, container=container,
+            resources={'cpus': 2., 'memory': None})
+        w = uworker.UWorker()
+        w.reconcile_journal()
+        self.assertEqual(w.governor.reserved_cpus, 2.)
+        for thread in threading.enumerate():
+            if thread.name.startswith('reattach-'):
+                thread.join()
+        self.assertEqual(w.governor.reserved_cpus, 0)
+        job = self.fake_api.job('project', '42')
+        self.assertEqual(job['status'], JOB_STATES.failed)
+        self.assertIn('Killed job container after timeout', job['output'])
+        self.assertEqual(journal.entries(), [])
+
+    def test_finished_job(self):
+        """Test that a processed job leaves no trace in the journal"""
+        self.monkeypatch.setenv('UWORKER_JOB_CMD', 'echo')
+        w = uworker.UWorker()
+        job = Job.fetch(w.api, project='project')
+        self.assertTrue(w.claim_job(job))
+        self.assertEqual(len(w.journal.entries()), 1)
+        w._process_job(job, 0)
+        self.assertEqual(
+            self.fake_api.job('project', '42')['status'],
+            JOB_STATES.finished)
+        self.assertEqual(w.journal.entries(), [])
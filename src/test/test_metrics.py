@@ -0,0 +1,171 @@
+import unittest
+
+import requests
+
+from test.test_uworker import BaseWorkerWithoutApiTest
+from uclient.uclient import UClientError
+from utils.metrics import MetricsServer, Registry, parse_address
+from uworker import uworker
+
+
+class TestRegistry(unittest.TestCase):
+
+    def test_counter_and_gauge(self):
+        """Test that counters and gauges are rendered per label value"""
+        registry = Registry()
+        jobs = registry.counter('jobs_total', 'Processed jobs', ['status'])
+        busy = registry.gauge('busy', 'Busy slots')
+        jobs.inc(status='finished')
+        jobs.inc(2, status='failed')
+        busy.inc()
+        busy.inc()
+        busy.dec()
+        self.assertEqual(registry.render(), '\n'.join([
+            '# HELP busy Busy slots',
+            '# TYPE busy gauge',
+            'busy 1',
+            '# HELP jobs_total Processed jobs',
+            '# TYPE jobs_total counter',
+            'jobs_total{status="failed"} 2',
+            'jobs_total{status="finished"} 1',
+        ]) + '\n')
+
+    def test_histogram(self):
+        """Test that the buckets of a histogram are cumulative"""
+        registry = Registry()
+        latency = registry.histogram(
+            'latency_seconds', 'Latency', ['call'], buckets=(.1, 1.))
+        latency.observe(.05, call='fetch')
+        latency.observe(.5, call='fetch')
+        latency.observe(5, call='fetch')
+        self.assertEqual(registry.render().splitlines()[2:], [
+            'latency_seconds_bucket{call="fetch",le="0.1"} 1',
+            'latency_seconds_bucket{call="fetch",le="1"} 2',
+            'latency_seconds_bucket{call="fetch",le="+Inf"} 3',
+            'latency_seconds_count{call="fetch"} 3',
+            'latency_seconds_sum{call="fetch"} 5.55',
+        ])
+
+    def test_labels(self):
+        """Test that metrics must be updated with their labels"""
+        registry = Registry()
+        jobs = registry.counter('jobs_total', 'Processed jobs', ['status'])
+        with self.assertRaises(ValueError):
+            jobs.inc()
+        with self.assertRaises(ValueError):
+            jobs.inc(status='failed', project='p')
+
+    def test_register_twice(self):
+        """Test that a metric is only registered once"""
+        registry = Registry()
+        jobs = registry.counter('jobs_total', 'Processed jobs')
+        self.assertIs(registry.counter('jobs_total', 'Processed jobs'), jobs)
+        with self.assertRaises(ValueError):
+            registry.gauge('jobs_total', 'Processed jobs')
+
+    def test_parse_address(self):
+        self.assertEqual(parse_address('9100'), ('127.0.0.1', 9100))
+        self.assertEqual(parse_address('0.0.0.0:9100'), ('0.0.0.0', 9100))
+        with self.assertRaises(ValueError):
+            parse_address('port')
+
+
+class TestMetricsServer(unittest.TestCase):
+
+    def test_serve(self):
+        """Test that the metrics are served in the Prometheus text format"""
+        registry = Registry()
+        registry.counter('jobs_total', 'Processed jobs').inc()
+        server = MetricsServer(registry, port=0)
+        server.start()
+        try:
+            url = 'http://127.0.0.1:%d' % server.port
+            response = requests.get(url + '/metrics')
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(
+                response.headers['Content-Type'].startswith('text/plain'))
+            self.assertIn('jobs_total 1\n', response.text)
+            self.assertEqual(requests.get(url + '/other').status_code, 404)
+        finally:
+            server.stop()
+
+
+class FakeJob:
+    url_claim = url_source = 'http://example.com/job'
+    url_target = url_output = url_image = None
+    environment = {}
+    project = 'project'
+
+    def __init__(self, claim_status=None):
+        self.claim_status = claim_status
+        self.statuses = []
+
+    def claim(self, worker):
+        if self.claim_status:
+            raise UClientError('Conflict', self.claim_status)
+
+    def send_status(self, status, processing_time=None, resource_usage=None):
+        self.statuses.append(status)
+
+
+class TestWorkerMetrics(BaseWorkerWithoutApiTest):
+
+    def test_bad_port(self):
+        self.monkeypatch.setenv('UWORKER_METRICS_PORT', 'port')
+        with self.assertRaises(uworker.UWorkerError):
+            uworker.UWorker()
+
+    def test_job_metrics(self):
+        """Test that processed jobs are counted and timed"""
+        w = uworker.UWorker()
+        w.do_job = lambda *args, **kwargs: (1, 2.5, None)
+        finished = uworker.JOBS.get(status='failed') or 0
+        statuses = (uworker.API_LATENCY.get(call='status') or [0, 0])[1]
+        durations = uworker.JOB_DURATION.get(status='failed') or [0, 0, 0]
+        job = FakeJob()
+        w._process_job(job, 0)
+        self.assertEqual(job.statuses, ['STARTED', 'FAILED'])
+        self.assertEqual(uworker.JOBS.get(status='failed'), finished + 1)
+        self.assertEqual(
+            uworker.API_LATENCY.get(call='status')[1], statuses + 2)
+        self.assertEqual(
+            uworker.JOB_DURATION.get(status='failed')[2], durations[2] + 2.5)
+        self.assertEqual(uworker.BUSY_SLOTS.get() or 0, 0)
+
+    def test_claim_conflicts(self):
+        """Test that claims that another worker won are counted"""
+        w = uworker.UWorker()
+        conflicts = uworker.CLAIM_CONFLICTS.get() or 0
+        self.assertFalse(w.claim_job(FakeJob(claim_status=409)))
+        self.assertTrue(w.claim_job(FakeJob()))
+        self.assertEqual(uworker.CLAIM_CONFLICTS.get(), conflicts + 1)
+        self.assertAlmostEqual(w.claim_contention.rate('project'), .16)
+        self.assertAlmostEqual(
+            uworker.CLAIM_CONFLICT_RATE.get(project='project'), .16)
+
+    def test_claim_retries(self):
+        """Test that failed claims are retried after short waits"""
+        w = uworker.UWorker(error_sleep=60)
+        sleeps = []
+        w._sleep = sleeps.append
+        self.assertFalse(w.claim_job(FakeJob(claim_status=500)))
+        self.assertEqual(len(sleeps), 2)
+        self.assertTrue(.5 <= sleeps[0] <= 1, sleeps)
+        self.assertTrue(1 <= sleeps[1] <= 2, sleeps)
+        self.assertEqual(w.claim_contention.rate('project'), 0)
+
+    def test_serve_metrics(self):
+        """Test that the worker serves its metrics while it runs"""
+        self.monkeypatch.setenv('UWORKER_METRICS_PORT', '127.0.0.1:0')
+        w = uworker.UWorker()
+        texts = []
+
+        def process_next_job(slot):
+            url = 'http://127.0.0.1:%d/metrics' % w.metrics_server.port
+            texts.append(requests.get(url).text)
+
+        w._process_next_job = process_next_job
+        w.alive = True
+        w.run(only_once=True)
+        self.assertIn('uworker_slots 1\n', texts[0])
+        self.assertIsNone(w.metrics_server.server)
@@ -0,0 +1,248 @@
+import threading
+from time import time
+import unittest
+
+import pytest
+
+from test.fakeapi import FakeMicroqAPI
+from test.test_uworker import BaseWorkerWithoutApiTest
+from uclient.uclient import UClient
+from utils import logs
+from uworker.output import OutputBuffer, OutputUploader
+from uworker import uworker
+
+
+class TestOutputBuffer(unittest.TestCase):
+
+    def test_small_output(self):
+        """Test that output that fits is kept as it is"""
+        output = OutputBuffer(head_size=4, tail_size=4)
+        self.assertEqual(output.write(b'012'), 3)
+        output.write(b'34567')
+        self.assertEqual(output.getvalue(), b'01234567')
+        self.assertEqual(output.dropped, 0)
+        self.assertEqual(output.size, 8)
+
+    def test_head_and_tail(self):
+        """Test that the middle of the output is dropped"""
+        output = OutputBuffer(head_size=4, tail_size=4)
+        for char in b'0123456789abcdefghij':
+            output.write(bytes([char]))
+        self.assertEqual(
+            output.getvalue(),
+            b'0123\n[... 12 bytes of output dropped ...]\nghij')
+        self.assertEqual(output.dropped, 12)
+        self.assertEqual(output.size, 20)
+        self.assertLessEqual(len(output.tail), 8)
+
+    def test_executor_output(self):
+        """Test that an executor keeps the head and tail of the output"""
+        log = logs.get_logger('unittest', to_file=False, to_stdout=True)
+
+        class SmallExecutor(uworker.CommandExecutor):
+            OUTPUT_HEAD_SIZE = 100
+            OUTPUT_TAIL_SIZE = 100
+
+        outputs = []
+        ce = SmallExecutor('Test', ['seq'], log)
+        exit_code, _ = ce.execute(['10000'], outputs.append)
+        self.assertEqual(exit_code, 0)
+        self.assertIn('bytes of output dropped', outputs[-1])
+        self.assertIn('Test process exited with code 0', outputs[-1])
+        self.assertLess(len(outputs[-1]), 300)
+
+
+class BaseOutputTest(unittest.TestCase):
+    supports_append = True
+
+    @pytest.fixture(autouse=True)
+    def fake_api(self):
+        self.fake_api = FakeMicroqAPI(supports_append=self.supports_append)
+        self.fake_api.start()
+        self.fake_api.add_job('project', '42')
+        self.api = UClient(
+            self.fake_api.root, username=self.fake_api.username,
+            password=self.fake_api.password, retries=0)
+        self.url = self.fake_api.root + '/v4/project/jobs/42/output'
+        self.log = logs.get_logger('unittest', to_file=False, to_stdout=True)
+        yield
+        self.fake_api.stop()
+
+    def get_uploader(self, incremental=True, head_size=1000, tail_size=1000):
+        output = OutputBuffer(head_size, tail_size)
+        uploader = OutputUploader(
+            self.api, self.url, self.log, incremental=incremental)
+        uploader.output = output
+        uploader.last_upload = time()
+        return uploader, output
+
+    @property
+    def stored_output(self):
+        return self.fake_api.job('project', '42')['output']
+
+    def uploaded(self):
+        return [
+            (r.route, r.json['Output'], r.json.get('Offset'))
+            for r in self.fake_api.requests
+            if r.route in ('output', 'append_output')]
+
+
+class TestIncrementalUploads(BaseOutputTest):
+
+    def test_append(self):
+        """Test that only new output is sent and that the output is sent in
+        full at the end"""
+        uploader, output = self.get_uploader()
+        output.write(b'line1\n')
+        uploader.upload()
+        uploader.upload()
+        output.write(b'line2\n')
+        uploader.upload()
+        self.assertEqual(self.stored_output, 'line1\nline2\n')
+        uploader.close()
+        self.assertEqual(self.uploaded(), [
+            ('append_output', 'line1\n', 0),
+            ('append_output', 'line2\n', 6),
+            ('output', 'line1\nline2\n', None)])
+
+    def test_offset_mismatch(self):
+        """Test that the whole output is sent if the offsets differ"""
+        uploader, output = self.get_uploader()
+        output.write(b'line1\n')
+        uploader.upload()
+        self.fake_api.job('project', '42')['output'] = ''
+        output.write(b'line2\n')
+        uploader.upload()
+        self.assertEqual(self.stored_output, 'line1\nline2\n')
+        output.write(b'line3\n')
+        uploader.upload()
+        self.assertEqual(self.uploaded()[-1], ('append_output', 'line3\n', 12))
+
+    def test_dropped_output(self):
+        """Test that the whole output is sent if output has been dropped
+        since the last upload"""
+        uploader, output = self.get_uploader(head_size=6, tail_size=6)
+        output.write(b'line1\n')
+        uploader.upload()
+        output.write(b'line2\nline3\nline4\n')
+        uploader.upload()
+        self.assertEqual(
+            self.stored_output,
+            'line1\n\n[... 12 bytes of output dropped ...]\nline4\n')
+        output.write(b'line5\n')
+        uploader.upload()
+        self.assertEqual(self.uploaded()[-1][:2], ('append_output', 'line5\n'))
+        self.assertTrue(self.stored_output.endswith('line4\nline5\n'))
+
+    def test_full_mode(self):
+        """Test that the whole output is sent in full mode"""
+        uploader, output = self.get_uploader(incremental=False)
+        output.write(b'line1\n')
+        uploader.upload()
+        output.write(b'line2\n')
+        uploader.upload()
+        self.assertEqual(self.uploaded(), [
+            ('output', 'line1\n', None),
+            ('output', 'line1\nline2\n', None)])
+
+    def test_no_url(self):
+        """Test that nothing is sent without output url"""
+        uploader = OutputUploader(self.api, None, self.log)
+        output = OutputBuffer(1000, 1000)
+        uploader.start(output)
+        output.write(b'line1\n')
+        uploader.close()
+        self.assertIsNone(uploader.thread)
+        self.assertEqual(self.uploaded(), [])
+
+
+class TestUploadInterval(BaseOutputTest):
+
+    def test_interval(self):
+        """Test that the interval adapts to output rate and latency"""
+        uploader = OutputUploader(self.api, self.url, self.log)
+        uploader.last_upload = time() - 10
+        uploader._update_interval(0, 0)
+        self.assertEqual(uploader.interval, uploader.MAX_INTERVAL)
+        uploader.last_upload = time() - 10
+        uploader._update_interval(10 * 1024 * 1024, 0)
+        self.assertEqual(uploader.interval, uploader.MIN_INTERVAL)
+        uploader.last_upload = time() - 10
+        uploader._update_interval(10 * 1024 * 1024, 2)
+        self.assertAlmostEqual(uploader.interval, 20)
+        uploader.last_upload = time() - 10
+        uploader._update_interval(20 * 1024, 0)
+        self.assertAlmostEqual(uploader.interval, 32, places=1)
+
+    def test_slow_api(self):
+        """Test that a blocked upload does not block the job process"""
+        uploader = OutputUploader(self.api, self.url, self.log)
+        uploader.interval = 0.01
+        blocked = threading.Event()
+        release = threading.Event()
+
+        def append_output(url, output, offset):
+            blocked.set()
+            release.wait(30)
+
+        self.api.append_output = append_output
+        ce = uworker.CommandExecutor('Test', ['sh', '-c'], self.log)
+        ce.write_output('Starting execution')
+        uploader.start(ce.output)
+        try:
+            self.assertTrue(blocked.wait(5))
+            # More output than fits in the pipe to the process
+            start = time()
+            exit_code, _ = ce.execute(['seq 20000'], None)
+            self.assertEqual(exit_code, 0)
+            self.assertLess(time() - start, 20)
+        finally:
+            release.set()
+            uploader.close()
+        self.assertIn('STDOUT: 20000', self.stored_output)
+
+
+class TestAppendUnsupported(BaseOutputTest):
+    supports_append = False
+
+    def test_fallback(self):
+        """Test fallback to full uploads when appending is unsupported"""
+        uploader, output = self.get_uploader()
+        output.write(b'line1\n')
+        uploader.upload()
+        output.write(b'line2\n')
+        uploader.upload()
+        self.assertFalse(uploader.incremental)
+        self.assertEqual(self.stored_output, 'line1\nline2\n')
+        self.assertEqual(self.uploaded(), [
+            ('output', 'line1\n', None),
+            ('output', 'line1\nline2\n', None)])
+
+    def test_fallback_is_remembered(self):
+        """Test that later uploaders do not try to append"""
+        uploader, output = self.get_uploader()
+        output.write(b'line1\n')
+        uploader.upload()
+        uploader, output = self.get_uploader()
+        output.write(b'line2\n')
+        uploader.upload()
+        self.assertFalse(self.api.append_supported)
+        self.assertEqual(
+            [r.method for r in self.fake_api.requests
+             if r.path.endswith('/output')], ['PATCH', 'PUT', 'PUT'])
+
+
+class TestJobOutput(BaseWorkerWithoutApiTest, BaseOutputTest):
+
+    def test_do_job(self):
+        """Test that the output of a job ends up in the api"""
+        self.monkeypatch.setenv('UWORKER_JOB_CMD', 'echo')
+        w = uworker.UWorker()
+        w.api = self.api
+        exit_code, _, usage = w.do_job('test_do_job', url_output=self.url)
+        self.assertEqual(exit_code, 0)
+        self.assertIn('EXECUTOR: Starting execution', self.stored_output)
+        self.assertIn('STDOUT: test_do_job', self.stored_output)
+        self.assertIn('Job process exited with code 0', self.stored_output)
+        self.assertEqual(self.uploaded()[-1][0], 'output')
+        self.assertGreater(usage.output_bytes, 0)
@@ -0,0 +1,157 @@
+from threading import Thread
+from time import sleep
+import unittest
+
+import pytest
+
+from uworker.polling import ClaimContention, IdleBackoff, NegativeCache
+from uworker import uworker
+from test.test_uworker import BaseWorkerWithoutApiTest
+
+
+class TestIdleBackoff(unittest.TestCase):
+
+    def test_growth(self):
+        """Test that the delay doubles up to the max delay"""
+        backoff = IdleBackoff(1, 10, jitter=0)
+        delays = [backoff.next_delay() for _ in range(6)]
+        self.assertEqual(delays, [1, 2, 4, 8, 10, 10])
+        backoff.reset()
+        self.assertEqual(backoff.next_delay(), 1)
+
+    def test_jitter(self):
+        """Test that the delays are jittered below the nominal delay"""
+        delays = set()
+        for _ in range(20):
+            backoff = IdleBackoff(4, 600)
+            delay = backoff.next_delay()
+            self.assertTrue(2 <= delay <= 4, delay)
+            delays.add(delay)
+        self.assertGreater(len(delays), 1)
+
+    def test_min_above_max(self):
+        """Test that the max delay is never exceeded"""
+        backoff = IdleBackoff(5, 0.01, jitter=0)
+        self.assertEqual(backoff.next_delay(), 0.01)
+
+
+class TestNegativeCache(unittest.TestCase):
+
+    def test_cache(self):
+        """Test that keys expire and that the ttl grows"""
+        cache = NegativeCache(0.05, 10)
+        self.assertNotIn('a', cache)
+        cache.add('a')
+        self.assertIn('a', cache)
+        self.assertLessEqual(cache.time_left(['a', 'b']), 0)
+        self.assertGreater(cache.time_left(['a']), 0)
+        sleep(0.06)
+        self.assertNotIn('a', cache)
+        cache.add('a')
+        self.assertGreater(cache.time_left(['a']), 0.05)
+        cache.discard('a')
+        self.assertNotIn('a', cache)
+
+
+class TestClaimContention(unittest.TestCase):
+
+    def test_rate(self):
+        """Test that the conflict rate is a moving average per project"""
+        contention = ClaimContention(weight=.5)
+        self.assertEqual(contention.rate('p1'), 0)
+        self.assertEqual(contention.spread('p1'), 1)
+        self.assertEqual(contention.delay('p1'), 0)
+        contention.record('p1', conflict=True)
+        contention.record('p1', conflict=True)
+        contention.record('p2', conflict=False)
+        self.assertEqual(contention.rate('p1'), .75)
+        self.assertEqual(contention.rate('p2'), 0)
+        self.assertEqual(contention.rate(), .375)
+        contention.record('p1', conflict=False)
+        self.assertEqual(contention.rate('p1'), .375)
+
+    def test_spread_and_delay(self):
+        """Test that full contention spreads the claims over the most jobs
+        and gives the longest waits"""
+        contention = ClaimContention(weight=1, max_spread=8, max_delay=2)
+        contention.record('p', conflict=True)
+        self.assertEqual(contention.spread('p'), 8)
+        for _ in range(20):
+            self.assertTrue(0 <= contention.delay('p') <= 2)
+
+
+class FakeJob:
+    url_image = None
+    environment = {}
+
+    def __init__(self, project):
+        self.project = project
+        self.url_claim = self.url_source = 'http://example.com/' + project
+
+
+class TestFetchTargets(BaseWorkerWithoutApiTest):
+
+    @pytest.fixture(autouse=True)
+    def fake_fetch(self, environment):
+        self.fetched = []
+        self.has_jobs = set()
+
+        def fetch(api, job_type=None, project=None):
+            self.fetched.append((project, job_type))
+            if (project, job_type) in self.has_jobs:
+                return FakeJob(project)
+
+        self.monkeypatch.setattr(uworker.Job, 'fetch', staticmethod(fetch))
+
+    def test_with_command(self):
+        """Test that a worker with command fetches from its project"""
+        w = uworker.UWorker(idle_sleep=0.01)
+        self.assertIsNone(w.fetch_job())
+        self.assertIsNone(w.fetch_job())
+        self.assertEqual(self.fetched, [('project', None)] * 2)
+
+    def test_negative_cache(self):
+        """Test that recently empty projects and types are skipped"""
+        self.monkeypatch.setenv('UWORKER_JOB_API_PROJECTS', 'p1, p2')
+        self.monkeypatch.setenv('UWORKER_JOB_TYPES', 't1')
+        w = uworker.UWorker(with_command=False, idle_sleep=600)
+        self.assertEqual(w.fetch_targets, [('p1', 't1'), ('p2', 't1')])
+        self.has_jobs.add(('p2', 't1'))
+        self.assertEqual(w.fetch_job().project, 'p2')
+        self.assertEqual(w.fetch_job().project, 'p2')
+        self.assertEqual(
+            self.fetched, [('p1', 't1'), ('p2', 't1'), ('p2', 't1')])
+        self.has_jobs.clear()
+        self.assertIsNone(w.fetch_job())
+        self.assertIsNone(w.fetch_job())
+        self.assertEqual(len(self.fetched), 4)
+
+    def test_idle_reset(self):
+        """Test that the idle sleep is reset when a job is found"""
+        w = uworker.UWorker(idle_sleep=600, min_idle_sleep=0.01)
+        w.claim_job = lambda job: True
+        self.assertIsNone(w.next_job())
+        self.assertIsNone(w.next_job())
+        self.assertEqual(w.idle_backoff.attempts, 2)
+        self.has_jobs.add(('project', None))
+        self.assertTrue(w.next_job())
+        self.assertEqual(w.idle_backoff.attempts, 0)
+
+    def test_idle_poll(self):
+        """Test that only one slot polls while the worker is idle"""
+        w = uworker.UWorker(idle_sleep=600, min_idle_sleep=0.01)
+        w.claim_job = lambda job: True
+        self.assertIsNone(w.next_job())
+        # Another slot is polling
+        w.idle_poll.acquire()
+        waiter = Thread(target=w.next_job)
+        waiter.start()
+        waiter.join(.1)
+        self.assertTrue(waiter.is_alive())
+        self.assertEqual(len(self.fetched), 1)
+        w.idle_poll.release()
+        self.has_jobs.add(('project', None))
+        self.assertTrue(w.next_job())
+        waiter.join(1)
+        self.assertFalse(waiter.is_alive())
+        self.assertEqual(len(self.fetched), 2)
@@ -0,0 +1,200 @@
+import sys
+from threading import Event
+from time import sleep, time
+import unittest
+
+from test.test_uworker import BaseWorkerWithoutApiTest
+from uworker import uworker
+from uworker.resources import (
+    ContainerStatsSampler, ResourceGovernor, Resources,
+    parse_project_resources)
+from utils import logs
+
+
+class TestResources(unittest.TestCase):
+
+    def test_parse(self):
+        """Test parsing of resources from config and job environment"""
+        resources = Resources.parse('1.5', '4G')
+        self.assertEqual(resources.cpus, 1.5)
+        self.assertEqual(resources.memory, 4 * 1024 ** 3)
+        self.assertFalse(Resources.parse())
+        self.assertIsNone(Resources.from_environment({'OTHER': '1'}))
+        self.assertEqual(
+            Resources.from_environment({'UWORKER_JOB_MEMORY': '100M'}),
+            Resources(memory=100 * 1024 ** 2))
+        with self.assertRaises(ValueError):
+            Resources.parse('0')
+        with self.assertRaises(ValueError):
+            Resources.parse(memory='lots')
+
+    def test_limits(self):
+        """Test the docker limits of resources"""
+        resources = Resources(cpus=0.5, memory=1024)
+        self.assertEqual(
+            resources.docker_args(), ['--cpus=0.5', '--memory=1024b'])
+        self.assertEqual(
+            resources.host_config(),
+            {'NanoCpus': 500000000, 'Memory': 1024})
+
+    def test_project_resources(self):
+        """Test parsing of project defaults"""
+        self.assertEqual(
+            parse_project_resources('qsmr:2:8G, inversion::4G'), {
+                'qsmr': Resources(2., 8 * 1024 ** 3),
+                'inversion': Resources(memory=4 * 1024 ** 3)})
+        self.assertEqual(parse_project_resources(None), {})
+        with self.assertRaises(ValueError):
+            parse_project_resources('qsmr:2')
+
+
+class TestResourceGovernor(unittest.TestCase):
+
+    def setUp(self):
+        self.log = logs.get_logger('unittest', to_file=False, to_stdout=True)
+        self.load = 0.
+        self.available = 8000
+        self.governor = ResourceGovernor(
+            self.log, cpus=4, load=lambda: (self.load, 0, 0),
+            memory_info=lambda: (8000, self.available))
+
+    def test_reservations(self):
+        """Test that jobs are admitted while there are free resources"""
+        self.assertTrue(self.governor.reserve('a', Resources(3, 1000)))
+        self.assertFalse(self.governor.reserve('b', Resources(2, 1000)))
+        self.assertTrue(self.governor.reserve('b', Resources(1, 7000)))
+        self.assertFalse(self.governor.reserve('c', Resources(memory=1)))
+        self.assertTrue(self.governor.reserve('c', None))
+        self.governor.release('a')
+        self.governor.release('a')
+        self.assertTrue(self.governor.reserve('d', Resources(3, 1000)))
+
+    def test_host_usage(self):
+        """Test that the load and used memory of the host are considered"""
+        self.assertTrue(self.governor.reserve('a', None))
+        self.load = 3.5
+        self.assertFalse(self.governor.reserve('b', Resources(cpus=1)))
+        self.available = 500
+        self.assertFalse(self.governor.reserve('b', Resources(memory=1000)))
+
+    def test_first_job(self):
+        """Test that a job is admitted when no other job is running"""
+        self.assertTrue(self.governor.reserve('a', Resources(cpus=16)))
+
+
+class FakeJob:
+    url_source = 'http://example.com/source'
+
+    def __init__(self, project, environment):
+        self.project = project
+        self.environment = environment
+
+
+class TestWorkerResources(BaseWorkerWithoutApiTest):
+
+    def test_job_resources(self):
+        """Test that job, project and worker resources are used in order"""
+        self.monkeypatch.setenv('UWORKER_JOB_MEMORY', '1G')
+        self.monkeypatch.setenv('UWORKER_PROJECT_RESOURCES', 'big:4:16G')
+        w = uworker.UWorker()
+        self.assertEqual(
+            w.job_resources(FakeJob('big', {'UWORKER_JOB_CPUS': '1'})),
+            Resources(cpus=1.))
+        self.assertEqual(
+            w.job_resources(FakeJob('big', {})),
+            Resources(4., 16 * 1024 ** 3))
+        self.assertEqual(
+            w.job_resources(FakeJob('small', {})),
+            Resources(memory=1024 ** 3))
+
+    def test_bad_resources(self):
+        """Test that bad resource config is refused"""
+        self.monkeypatch.setenv('UWORKER_JOB_CPUS', 'many')
+        with self.assertRaises(uworker.UWorkerError):
+            uworker.UWorker()
+
+
+class TestCommandExecutorLimits(unittest.TestCase):
+
+    def test_memory_limit(self):
+        """Test that processes cannot allocate more than their memory"""
+        log = logs.get_logger('unittest', to_file=False, to_stdout=True)
+        allocate = [sys.executable, '-c', 'x = bytearray(200 * 1024 ** 2)']
+        executor = uworker.CommandExecutor('Test', allocate, log)
+        self.assertEqual(executor.execute([], None)[0], 0)
+        executor = uworker.CommandExecutor(
+            'Test', allocate, log, resources=Resources(memory=100 * 1024 ** 2))
+        exit_code, _ = executor.execute([], None)
+        self.assertNotEqual(exit_code, 0)
+        self.assertIn('MemoryError', executor.get_output())
+
+
+def stats_sample(cpu, usage, max_usage=None):
+    memory = {'usage': usage}
+    if max_usage is not None:
+        memory['max_usage'] = max_usage
+    return {
+        'cpu_stats': {'cpu_usage': {
+            'total_usage': cpu, 'usage_in_usermode': cpu,
+            'usage_in_kernelmode': 0}},
+        'memory_stats': memory,
+    }
+
+
+class FakeStatsDocker:
+    """Stream the given stats samples, then block until released"""
+
+    def __init__(self, samples):
+        self.samples = samples
+        self.release = Event()
+
+    def container_stats(self, container):
+        for sample in self.samples:
+            yield sample
+        self.release.wait(5)
+
+
+class TestContainerStatsSampler(unittest.TestCase):
+
+    def setUp(self):
+        self.log = logs.get_logger('unittest', to_file=False, to_stdout=True)
+
+    def sample(self, samples, new_container=True):
+        docker = FakeStatsDocker(samples)
+        sampler = ContainerStatsSampler(
+            docker, 'container', self.log, new_container=new_container)
+        sampler.start()
+        while samples and sampler.last is None:
+            sleep(.01)
+        sleep(.05)
+        start = time()
+        usage = sampler.stop()
+        self.assertLess(time() - start, .1)
+        docker.release.set()
+        return usage
+
+    def test_new_container(self):
+        """Test that a new container reports the peak of its cgroup"""
+        usage = self.sample([
+            stats_sample(1e9, 50, 80), stats_sample(3e9, 40, 90)])
+        self.assertEqual(usage.user_time, 3.)
+        self.assertEqual(usage.max_rss, 90)
+
+    def test_reused_container(self):
+        """Test that a job in a reused container reports the usage that was
+        sampled while it ran, not the peak of the container"""
+        usage = self.sample([
+            stats_sample(1e9, 50, 900), stats_sample(3e9, 70, 900)],
+            new_container=False)
+        self.assertEqual(usage.user_time, 2.)
+        self.assertEqual(usage.max_rss, 70)
+
+    def test_cgroup_v2(self):
+        """Test that the peak memory is unknown without max_usage"""
+        usage = self.sample([stats_sample(1e9, 50)])
+        self.assertEqual(usage.user_time, 1.)
+        self.assertIsNone(usage.max_rss)
+
+    def test_no_samples(self):
+        """Test that stop does not wait for a first sample"""
+        self.assertEqual(self.sample([]).as_dict(), {})
@@ -0,0 +1,130 @@
+import os
+import tempfile
+import threading
+import unittest
+
+from test.test_metrics import FakeJob
+from test.test_uworker import BaseWorkerWithoutApiTest
+from utils import tracing
+from utils.tracing import JsonlFileExporter, Tracer, read_spans
+from uworker import uworker
+
+
+class ListExporter:
+
+    def __init__(self):
+        self.spans = []
+
+    def export(self, span):
+        self.spans.append(span.as_dict())
+
+
+class TestTracer(unittest.TestCase):
+
+    def test_disabled(self):
+        """Test that nothing is recorded without an exporter"""
+        tracer = Tracer()
+        with tracer.span('fetch', project='p') as span:
+            span.set(found=True)
+            self.assertIsNone(tracer.current())
+        self.assertIs(span, tracing.NO_SPAN)
+
+    def test_nested_spans(self):
+        """Test that children inherit the trace and the attributes of their
+        parent"""
+        exporter = ListExporter()
+        tracer = Tracer(exporter)
+        with tracer.span('job', job='42', project='p') as job:
+            with tracer.span('status', status='STARTED') as status:
+                self.assertIs(tracer.current(), status)
+        self.assertIsNone(tracer.current())
+        status, job = exporter.spans
+        self.assertEqual(status['name'], 'status')
+        self.assertEqual(status['parent_id'], job['span_id'])
+        self.assertEqual(status['trace_id'], job['trace_id'])
+        self.assertEqual(
+            status['attributes'],
+            {'job': '42', 'project': 'p', 'status': 'STARTED'})
+        self.assertIsNone(job['parent_id'])
+        self.assertGreaterEqual(job['duration'], status['duration'])
+
+    def test_explicit_parent(self):
+        """Test that spans in other threads can be children of a span"""
+        exporter = ListExporter()
+        tracer = Tracer(exporter)
+        with tracer.span('job', job='42') as job:
+            def upload():
+                with tracer.span('output_upload', parent=job):
+                    pass
+            thread = threading.Thread(target=upload)
+            thread.start()
+            thread.join()
+        upload, job = exporter.spans
+        self.assertEqual(upload['parent_id'], job['span_id'])
+        self.assertEqual(upload['attributes'], {'job': '42'})
+
+    def test_error(self):
+        """Test that the error that ends a span is recorded"""
+        exporter = ListExporter()
+        tracer = Tracer(exporter)
+        with self.assertRaises(ValueError):
+            with tracer.span('claim'):
+                raise ValueError('conflict')
+        self.assertEqual(exporter.spans[0]['error'], 'ValueError: conflict')
+
+
+class TestJsonlFileExporter(unittest.TestCase):
+
+    def test_export(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'spans.jsonl')
+            exporter = JsonlFileExporter(path)
+            tracer = Tracer(exporter)
+            with tracer.span('fetch'):
+                pass
+            exporter.close()
+            with tracer.span('claim'):
+                pass
+            exporter.close()
+            self.assertEqual(
+                [span['name'] for span in read_spans(path)],
+                ['fetch', 'claim'])
+
+
+class TestWorkerTracing(BaseWorkerWithoutApiTest):
+
+    def test_job_spans(self):
+        """Test that the phases of a job are traced"""
+        self.monkeypatch.setattr(tracing.TRACER, 'exporter', None)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'spans.jsonl')
+            self.monkeypatch.setenv('UWORKER_TRACE_FILE', path)
+            w = uworker.UWorker()
+            w._process_job(FakeJob(), 0)
+            w.trace_exporter.close()
+            spans = read_spans(path)
+        self.assertEqual(
+            [span['name'] for span in spans],
+            ['status', 'spawn', 'execution', 'status', 'job'])
+        job = spans[-1]
+        for span in spans:
+            self.assertEqual(span['trace_id'], job['trace_id'])
+            self.assertEqual(span['attributes']['job'], FakeJob.url_claim)
+            self.assertEqual(span['attributes']['project'], 'project')
+        self.assertEqual(spans[0]['attributes']['status'], 'STARTED')
+        self.assertEqual(spans[2]['attributes']['exit_code'], 0)
+        self.assertEqual(spans[3]['attributes']['status'], 'FINISHED')
+
+    def test_restore_exporter(self):
+        """Test that the worker gives the tracer back when it stops"""
+        exporter = ListExporter()
+        self.monkeypatch.setattr(tracing.TRACER, 'exporter', exporter)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            self.monkeypatch.setenv(
+                'UWORKER_TRACE_FILE', os.path.join(tmpdir, 'spans.jsonl'))
+            w = uworker.UWorker()
+            self.assertIs(tracing.TRACER.exporter, w.trace_exporter)
+            w._process_next_job = lambda slot: None
+            w.alive = True
+            w.run(only_once=True)
+        self.assertIs(tracing.TRACER.exporter, exporter)
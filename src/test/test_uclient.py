@@ -1,7 +1,21 @@
+import asyncio
+from email.utils import formatdate
 import json
+import os
+import tempfile
+from time import sleep, time
+import unittest
+
 import pytest
 
+from uclient import uclient
+from uclient.breaker import CircuitBreaker
+from uclient.outbox import Outbox
+from uclient.retry import RetryPolicy, endpoint_policies, parse_retry_after
+from uclient.token_cache import TokenCache
 from uclient.uclient import UClient, UClientError, Job
+from uclient import async_uclient
+from test.fakeapi import FakeMicroqAPI
 from test.testbase import BaseWithWorkerUser
 
 
@@ -110,3 +124,522 @@ class TestJob(BaseTestWithInsertedJob):
 
         api.update_output(job.url_output, "Processing...")
         job.send_status("Work done")
+
+
+class BaseTestWithFakeAPI(unittest.TestCase):
+    """Base class for tests against the in-process fake api"""
+
+    @pytest.fixture(autouse=True)
+    def fake_api(self):
+        self.fake_api = FakeMicroqAPI()
+        self.fake_api.start()
+        self.fake_api.add_job('project', '42')
+        yield
+        self.fake_api.stop()
+
+    def get_client(self, **kwargs):
+        options = {'retries': 3, 'time_between_retries': 0.01}
+        options.update(kwargs)
+        return UClient(
+            self.fake_api.root, username=self.fake_api.username,
+            password=self.fake_api.password, **options)
+
+    def client_ports(self):
+        return set(r.client_port for r in self.fake_api.requests)
+
+
+class TestConnectionPool(BaseTestWithFakeAPI):
+
+    def test_connection_reuse(self):
+        """Test that all calls to the api share one connection"""
+        api = self.get_client()
+        job = Job.fetch(api, project='project')
+        job.claim()
+        job.send_status('STARTED')
+        job.send_output('Processing...')
+        job.send_status('FINISHED', 1., {'UserTime': .5})
+        self.assertEqual(len(self.fake_api.requests), 6)
+        self.assertEqual(len(self.client_ports()), 1)
+        self.assertEqual(
+            self.fake_api.job('project', '42')['output'], 'Processing...')
+        self.assertEqual(job.project, 'project')
+        self.assertEqual(
+            self.fake_api.job('project', '42')['resource_usage'],
+            {'UserTime': .5})
+
+    def test_token_renewal_reuses_connection(self):
+        """Test that 401 -> renew token -> retry uses the same connection"""
+        api = self.get_client()
+        job = Job.fetch(api, project='project')
+        self.fake_api.expire_tokens()
+        job.claim()
+        self.assertEqual(len(self.fake_api.requests_to('token')), 2)
+        self.assertEqual(len(self.fake_api.requests_to('claim')), 2)
+        self.assertEqual(len(self.client_ports()), 1)
+
+    def test_no_keep_alive(self):
+        """Test that connections can be closed after each request"""
+        api = self.get_client(keep_alive=False)
+        Job.fetch(api, project='project')
+        api.get_job_list('project')
+        self.assertEqual(len(self.client_ports()), 3)
+
+    def test_pool_size(self):
+        """Test that the pool size is configurable"""
+        api = self.get_client(pool_size=3)
+        adapter = api.session.get_adapter(self.fake_api.root)
+        self.assertEqual(adapter._pool_maxsize, 3)
+        api.close()
+
+
+class TestTokenRenewal(BaseTestWithFakeAPI):
+
+    def test_refresh_before_expiry(self):
+        """Test that a token that is due is renewed in the background while
+        the calls use the old token"""
+        api = self.get_client(token_lifetime=600)
+        job = Job.fetch(api, project='project')
+        token = api.token
+        self.assertAlmostEqual(api.token_expires, time() + 600, delta=5)
+        api.token_refresh_at = time() - 1
+        job.claim()
+        with api._refresh_lock:
+            pass
+        self.assertNotEqual(api.token, token)
+        self.assertEqual(len(self.fake_api.requests_to('token')), 2)
+        self.assertEqual(len(self.fake_api.requests_to('claim')), 1)
+        self.assertEqual(
+            self.fake_api.requests_to('claim')[0].username, token)
+
+    def test_expired_token(self):
+        """Test that an expired token is renewed before the call"""
+        self.fake_api.token_lifetime = .1
+        api = self.get_client(token_lifetime=.1)
+        job = Job.fetch(api, project='project')
+        api.token_refresh_at = api.token_expires = time() - 1
+        job.claim()
+        self.assertEqual(len(self.fake_api.requests_to('token')), 2)
+        self.assertEqual(len(self.fake_api.requests_to('claim')), 1)
+
+    def test_shared_token_cache(self):
+        """Test that clients with a shared cache share one token"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'tokens.json')
+            api1 = self.get_client(token_cache=TokenCache(path))
+            api2 = self.get_client(token_cache=TokenCache(path))
+            api1.get_job_list('project')
+            api2.get_job_list('project')
+            self.assertEqual(api1.token, api2.token)
+            self.assertEqual(len(self.fake_api.requests_to('token')), 1)
+            self.assertEqual(os.stat(path).st_mode & 0o777, 0o600)
+            # The first client that is rejected renews the token for both
+            self.fake_api.expire_tokens()
+            api1.get_job_list('project')
+            api2.get_job_list('project')
+            self.assertEqual(api1.token, api2.token)
+            self.assertEqual(len(self.fake_api.requests_to('token')), 2)
+            self.assertEqual(len(self.fake_api.requests_to('job_list')), 6)
+
+
+class TestRetryPolicy(unittest.TestCase):
+
+    def test_backoff(self):
+        """Test that the waits grow exponentially up to the max delay"""
+        policy = RetryPolicy(
+            retries=4, base_delay=1, multiplier=2, max_delay=5, jitter=0)
+        self.assertEqual(
+            [policy.next_delay(attempt, 0) for attempt in range(5)],
+            [1, 2, 4, 5, None])
+
+    def test_jitter(self):
+        policy = RetryPolicy(base_delay=2, jitter=.5)
+        delays = set(policy.next_delay(0, 0) for _ in range(20))
+        self.assertTrue(all(1 <= delay <= 2 for delay in delays), delays)
+        self.assertGreater(len(delays), 1)
+
+    def test_deadline(self):
+        """Test that no retry ends after the deadline"""
+        policy = RetryPolicy(base_delay=1, jitter=0, deadline=10)
+        self.assertEqual(policy.next_delay(0, 8), 1)
+        self.assertIsNone(policy.next_delay(0, 9.5))
+
+    def test_statuses(self):
+        """Test that only the retry statuses and errors are retried"""
+        policy = RetryPolicy(jitter=0)
+        self.assertEqual(policy.next_delay(0, 0, status_code=503), 1)
+        self.assertEqual(policy.next_delay(0, 0, status_code=429), 1)
+        self.assertEqual(policy.next_delay(0, 0), 1)
+        self.assertIsNone(policy.next_delay(0, 0, status_code=404))
+        self.assertIsNone(policy.next_delay(0, 0, status_code=500))
+
+    def test_retry_after(self):
+        """Test that Retry-After replaces the backoff, up to the max
+        delay"""
+        policy = RetryPolicy(max_delay=60, deadline=100)
+        self.assertEqual(policy.next_delay(0, 0, 503, retry_after=7), 7)
+        self.assertEqual(policy.next_delay(0, 0, 503, retry_after=600), 60)
+        self.assertIsNone(policy.next_delay(0, 50, 503, retry_after=60))
+
+    def test_parse_retry_after(self):
+        now = time()
+        self.assertEqual(parse_retry_after('120'), 120)
+        self.assertAlmostEqual(
+            parse_retry_after(formatdate(now + 30, usegmt=True), now),
+            30, delta=1)
+        self.assertEqual(
+            parse_retry_after(formatdate(now - 30, usegmt=True), now), 0)
+        self.assertIsNone(parse_retry_after(None))
+        self.assertIsNone(parse_retry_after('soon'))
+
+    def test_endpoint_policies(self):
+        """Test that output uploads fail fast and that claims are not
+        retried on error responses"""
+        policies = endpoint_policies(RetryPolicy(retries=200))
+        self.assertEqual(policies['output'].retries, 3)
+        self.assertEqual(policies['append_output'].deadline, 60)
+        self.assertEqual(policies['claim'].retry_statuses, ())
+        self.assertEqual(policies['fetch'].deadline, 600)
+        self.assertEqual(policies['status'].retries, 200)
+        self.assertIsNone(policies['status'].deadline)
+
+
+class TestRetries(BaseTestWithFakeAPI):
+
+    def test_retry_status(self):
+        """Test that calls are retried when the api is unavailable and that
+        each attempt is counted"""
+        self.fake_api.set_failures(1., route='fetch', status_code=503)
+        api = self.get_client()
+        attempts = uclient.API_ATTEMPTS.get(
+            endpoint='fetch', result='503') or 0
+        with self.assertRaises(UClientError) as context:
+            Job.fetch(api, project='project')
+        self.assertEqual(context.exception.status_code, 503)
+        self.assertEqual(len(self.fake_api.requests_to('fetch')), 4)
+        self.assertEqual(
+            uclient.API_ATTEMPTS.get(endpoint='fetch', result='503'),
+            attempts + 4)
+
+    def test_recovery(self):
+        """Test that a call succeeds after a retried failure"""
+        self.fake_api.set_failures(.5, route='fetch', status_code=502)
+        self.fake_api.random.seed(0)
+        api = self.get_client(retries=20)
+        self.assertEqual(Job.fetch(api, project='project').id, '42')
+        self.assertEqual(
+            self.fake_api.requests_to('fetch')[-1].status_code, 200)
+
+    def test_retry_after(self):
+        """Test that the client waits as long as the api asks"""
+        self.fake_api.set_failures(
+            1., route='status', status_code=429, retry_after='0.2')
+        api = self.get_client(retries=1)
+        job = Job.fetch(api, project='project')
+        start = time()
+        with self.assertRaises(UClientError) as context:
+            job.send_status('STARTED')
+        self.assertGreaterEqual(time() - start, .2)
+        self.assertEqual(context.exception.status_code, 429)
+        self.assertEqual(len(self.fake_api.requests_to('status')), 2)
+
+    def test_endpoint_policy(self):
+        """Test that the policy of an endpoint can be replaced"""
+        self.fake_api.set_failures(1., route='fetch', status_code=None)
+        api = self.get_client(
+            retry_policies={'fetch': RetryPolicy(retries=0)})
+        with self.assertRaises(UClientError):
+            Job.fetch(api, project='project')
+        self.assertEqual(len(self.fake_api.requests_to('fetch')), 1)
+
+
+class TestCircuitBreaker(unittest.TestCase):
+
+    def test_open(self):
+        """Test that the breaker opens after failures in a row"""
+        breaker = CircuitBreaker(threshold=2, reset_timeout=60)
+        breaker.record_failure()
+        breaker.record_success()
+        breaker.record_failure()
+        self.assertTrue(breaker.allow())
+        breaker.record_failure()
+        self.assertFalse(breaker.allow())
+        self.assertEqual(breaker.state, 'open')
+        self.assertAlmostEqual(breaker.retry_in(), 60, delta=1)
+
+    def test_trial_call(self):
+        """Test that one trial call is let through after the reset timeout,
+        that it closes the breaker if it succeeds and opens it again if it
+        fails"""
+        breaker = CircuitBreaker(threshold=1, reset_timeout=.05)
+        breaker.record_failure()
+        self.assertFalse(breaker.allow())
+        sleep(.05)
+        self.assertTrue(breaker.allow())
+        self.assertEqual(breaker.state, 'half_open')
+        self.assertFalse(breaker.allow())
+        breaker.record_failure()
+        self.assertFalse(breaker.allow())
+        sleep(.05)
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        breaker.record_success()
+        self.assertTrue(breaker.allow())
+        self.assertTrue(breaker.is_closed)
+        self.assertEqual(breaker.retry_in(), 0)
+
+
+class TestOutbox(unittest.TestCase):
+
+    def test_outbox(self):
+        """Test that updates are kept in order across restarts and that
+        whole outputs are coalesced"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'outbox.sqlite')
+            outbox = Outbox(path)
+            outbox.put('status', 'PUT', '/status', {'Status': 'STARTED'})
+            outbox.put('output', 'PUT', '/output', {'Output': 'a'},
+                       coalesce=True)
+            outbox.put('output', 'PUT', '/output', {'Output': 'ab'},
+                       coalesce=True)
+            outbox.put('status', 'PUT', '/status', {'Status': 'FINISHED'})
+            self.assertEqual(len(outbox), 3)
+            outbox = Outbox(path)
+            updates = outbox.updates()
+            self.assertEqual([u.data for u in updates], [
+                {'Status': 'STARTED'}, {'Output': 'ab'},
+                {'Status': 'FINISHED'}])
+            outbox.remove(updates[0].id)
+            self.assertEqual(len(outbox), 2)
+            self.assertEqual(len(Outbox(path).updates()), 2)
+
+
+class TestOutboxReplay(BaseTestWithFakeAPI):
+
+    def test_replay(self):
+        """Test that updates are queued while the api is down and replayed
+        in order when it has recovered"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            api = self.get_client(
+                breaker=CircuitBreaker(threshold=2, reset_timeout=.1),
+                outbox=Outbox(os.path.join(tmpdir, 'outbox.sqlite')))
+            job = Job.fetch(api, project='project')
+            job.claim()
+            self.fake_api.set_failures(1., status_code=None)
+            job.send_status('STARTED')
+            self.assertEqual(api.breaker.state, 'open')
+            self.assertEqual(len(self.fake_api.requests_to('status')), 2)
+            job.send_output('Processing')
+            job.send_output('Processing...')
+            job.send_status('FINISHED', 1.)
+            self.assertEqual(len(api.outbox), 3)
+            self.assertEqual(len(self.fake_api.requests_to('status')), 2)
+            with self.assertRaises(uclient.CircuitOpenError):
+                Job.fetch(api, project='project')
+            self.fake_api.set_failures(0.)
+            self.assertFalse(api.flush_outbox())
+            sleep(.1)
+            self.assertTrue(api.flush_outbox())
+        self.assertEqual(len(api.outbox), 0)
+        self.assertTrue(api.breaker.is_closed)
+        self.assertEqual(
+            [r.json['Status'] for r in self.fake_api.requests_to('status')
+             if r.status_code == 200], ['STARTED', 'FINISHED'])
+        job = self.fake_api.job('project', '42')
+        self.assertEqual(job['status'], 'FINISHED')
+        self.assertEqual(job['output'], 'Processing...')
+
+    def test_recovered(self):
+        """Test that the queued updates are sent before the next update
+        once the api has recovered"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            api = self.get_client(
+                breaker=CircuitBreaker(threshold=1, reset_timeout=60),
+                outbox=Outbox(os.path.join(tmpdir, 'outbox.sqlite')))
+            job = Job.fetch(api, project='project')
+            self.fake_api.set_failures(1., status_code=None)
+            job.send_status('STARTED')
+            self.assertEqual(len(api.outbox), 1)
+            self.fake_api.set_failures(0.)
+            api.breaker.record_success()
+            for output in ('a', 'ab', 'abc'):
+                self.assertIsNotNone(
+                    api.update_output(job.url_output, output))
+            self.assertEqual(len(api.outbox), 0)
+        job = self.fake_api.job('project', '42')
+        self.assertEqual(job['status'], 'STARTED')
+        self.assertEqual(job['output'], 'abc')
+
+    def test_background_flush(self):
+        """Test that the queued updates are sent when the api has
+        recovered, without further calls"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            api = self.get_client(
+                breaker=CircuitBreaker(threshold=1, reset_timeout=.1),
+                outbox=Outbox(os.path.join(tmpdir, 'outbox.sqlite')))
+            api.OUTBOX_FLUSH_INTERVAL = .05
+            job = Job.fetch(api, project='project')
+            self.fake_api.set_failures(1., status_code=None)
+            job.send_status('STARTED')
+            job.send_output('Processing...')
+            self.assertEqual(len(api.outbox), 2)
+            self.fake_api.set_failures(0.)
+            start = time()
+            while len(api.outbox) and time() - start < 5:
+                sleep(.05)
+            self.assertEqual(len(api.outbox), 0)
+            api.close()
+        job = self.fake_api.job('project', '42')
+        self.assertEqual(job['status'], 'STARTED')
+        self.assertEqual(job['output'], 'Processing...')
+
+    def test_rejected_update(self):
+        """Test that queued updates that the api rejects are dropped"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            api = self.get_client(
+                breaker=CircuitBreaker(),
+                outbox=Outbox(os.path.join(tmpdir, 'outbox.sqlite')))
+            job = Job.fetch(api, project='project')
+            api.outbox.put(
+                'status', 'PUT',
+                job.url_status + '/unknown',
+                {'Status': 'FINISHED'})
+            api.outbox.put(
+                'status', 'PUT', job.url_status, {'Status': 'FINISHED'})
+            self.assertTrue(api.flush_outbox())
+        self.assertEqual(self.fake_api.job('project', '42')['status'],
+                         'FINISHED')
+
+
+class TestFaultInjection(BaseTestWithFakeAPI):
+
+    def test_latency(self):
+        """Test that responses of a route can be delayed"""
+        self.fake_api.set_latency(.2, route='claim')
+        api = self.get_client()
+        start = time()
+        job = Job.fetch(api, project='project')
+        self.assertLess(time() - start, .2)
+        job.claim()
+        self.assertGreaterEqual(time() - start, .2)
+
+    def test_failures(self):
+        """Test that calls fail with the injected status code"""
+        self.fake_api.set_failures(1., route='claim', status_code=503)
+        api = self.get_client()
+        job = Job.fetch(api, project='project')
+        with self.assertRaises(UClientError) as context:
+            job.claim()
+        self.assertEqual(context.exception.status_code, 503)
+        self.assertEqual(
+            self.fake_api.job('project', '42')['status'], 'AVAILABLE')
+        self.assertTrue(self.fake_api.requests_to('claim')[0].injected)
+        self.assertEqual(len(self.fake_api.requests_to('claim')), 1)
+
+    def test_dropped_connections(self):
+        """Test that dropped connections are retried by the client"""
+        self.fake_api.set_failures(1., route='fetch', status_code=None)
+        api = self.get_client()
+        with self.assertRaises(UClientError):
+            Job.fetch(api, project='project')
+        self.assertEqual(len(self.fake_api.requests_to('fetch')), 4)
+
+
+@unittest.skipIf(async_uclient.aiohttp is None, 'aiohttp is not installed')
+class TestAsyncUClient(BaseTestWithFakeAPI):
+
+    def get_async_client(self, **kwargs):
+        return async_uclient.AsyncUClient(
+            self.fake_api.root, username=self.fake_api.username,
+            password=self.fake_api.password, retries=3,
+            time_between_retries=0.01, **kwargs)
+
+    def run_async(self, coroutine):
+        return asyncio.run(coroutine)
+
+    def test_job(self):
+        """Test fetch, claim and update status/output"""
+
+        async def process_job():
+            async with self.get_async_client() as api:
+                r = await api.get_job_list('project')
+                self.assertEqual(r.status, 200)
+                job = await async_uclient.AsyncJob.fetch(
+                    api, project='project')
+                await job.claim(worker='async')
+                self.assertTrue(job.claimed)
+                await job.send_status('STARTED')
+                await job.send_output('Processing...')
+                await job.send_status('FINISHED', 1.)
+                self.assertIsNone(await async_uclient.AsyncJob.fetch(api))
+
+        self.run_async(process_job())
+        job = self.fake_api.job('project', '42')
+        self.assertEqual(job['worker'], 'async')
+        self.assertEqual(job['status'], 'FINISHED')
+        self.assertEqual(job['output'], 'Processing...')
+
+    def test_concurrent_calls(self):
+        """Test many concurrent calls that share one token"""
+        for job_id in range(20):
+            self.fake_api.add_job('project', str(job_id))
+
+        async def claim_all(api):
+            jobs = await api.get_job_list('project')
+            urls = [
+                job['Job']['URLS']['URL-claim']
+                for job in (await jobs.json())['Jobs']]
+            self.fake_api.expire_tokens()
+            api.token = None
+            await asyncio.gather(*[
+                api.claim_job(url, 'async') for url in urls])
+            await api.close()
+
+        self.run_async(claim_all(self.get_async_client(pool_size=5)))
+        self.assertEqual(len(self.fake_api.requests_to('token')), 2)
+        self.assertEqual(len(self.fake_api.requests_to('claim')), 21)
+        self.assertLessEqual(len(self.client_ports()), 5)
+
+    def test_token_renewal(self):
+        """Test that an expired token is renewed and the call retried"""
+
+        async def claim(api):
+            job = await async_uclient.AsyncJob.fetch(api, project='project')
+            self.fake_api.expire_tokens()
+            await job.claim()
+            await api.close()
+
+        self.run_async(claim(self.get_async_client()))
+        self.assertEqual(len(self.fake_api.requests_to('token')), 2)
+        self.assertEqual(len(self.fake_api.requests_to('claim')), 2)
+
+    def test_api_exception(self):
+        """Test that failed calls raise UClientError"""
+
+        async def bad_credentials():
+            async with async_uclient.AsyncUClient(
+                    self.fake_api.root, username='snoopy', password='ace',
+                    retries=0) as api:
+                await api.fetch_job()
+
+        with self.assertRaises(UClientError) as ctx:
+            self.run_async(bad_credentials())
+        self.assertEqual(ctx.exception.status_code, 401)
+
+    def test_breaker(self):
+        """Test that the async client stops calling the api while it is
+        down"""
+        self.fake_api.set_failures(1., status_code=None)
+
+        async def fetch(api):
+            with self.assertRaises(uclient.CircuitOpenError):
+                await api.fetch_job(project='project')
+            made = len(self.fake_api.requests)
+            with self.assertRaises(uclient.CircuitOpenError):
+                await api.fetch_job(project='project')
+            self.assertEqual(len(self.fake_api.requests), made)
+            await api.close()
+
+        api = self.get_async_client(
+            breaker=CircuitBreaker(threshold=2, reset_timeout=60))
+        self.run_async(fetch(api))
+        self.assertEqual(api.breaker.state, 'open')
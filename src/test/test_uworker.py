@@ -1,5 +1,7 @@
 import json
 import os
+import sys
+import tempfile
 import threading
 from time import time, sleep
 import unittest
@@ -9,6 +11,7 @@ import requests
 from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
 from werkzeug.wrappers import Request, Response
 
+from test.fakeapi import FakeMicroqAPI
 from test.testbase import BaseWithWorkerUser, TEST_DATA_DIR
 
 from utils.defs import JOB_STATES
@@ -168,6 +171,305 @@ class TestUWorkerNoCommand(BaseUWorkerTest):
         self._run_once(expected_jobs_count=1, with_command=False)
 
 
+class BaseWorkerWithoutApiTest(unittest.TestCase):
+    """Base class for worker tests that do not talk to a job api"""
+
+    env = {
+        'UWORKER_JOB_CMD': 'echo test',
+        'UWORKER_JOB_API_ROOT': 'http://localhost:1/rest_api',
+        'UWORKER_JOB_API_PROJECT': 'project',
+        'UWORKER_JOB_API_USERNAME': 'worker',
+        'UWORKER_JOB_API_PASSWORD': 'secret',
+    }
+
+    @pytest.fixture(autouse=True)
+    def environment(self, monkeypatch):
+        for k, v in self.env.items():
+            monkeypatch.setenv(k, v)
+        monkeypatch.setattr(docker_util, 'in_docker', lambda: False)
+        monkeypatch.setattr(docker_util, 'docker_available', lambda: True)
+        monkeypatch.setattr(
+            docker_util, 'docker_socket_available', lambda: True)
+        self.monkeypatch = monkeypatch
+
+
+class TestApiConfig(BaseWorkerWithoutApiTest):
+
+    def test_token_config(self):
+        """Test the token lifetime and the shared token cache"""
+        api = uworker.UWorker().api
+        self.assertEqual(api.token_lifetime, uworker.DEFAULT_TOKEN_LIFETIME)
+        self.assertIsNone(api.token_cache)
+        self.monkeypatch.setenv('UWORKER_JOB_API_TOKEN_LIFETIME', '0')
+        self.monkeypatch.setenv('UWORKER_TOKEN_CACHE', '/tmp/tokens.json')
+        api = uworker.UWorker().api
+        self.assertIsNone(api.token_lifetime)
+        self.assertEqual(api.token_cache.path, '/tmp/tokens.json')
+        self.monkeypatch.setenv('UWORKER_JOB_API_TOKEN_LIFETIME', 'long')
+        with self.assertRaises(uworker.UWorkerError):
+            uworker.UWorker()
+
+    def test_api_deadline(self):
+        """Test that the calls to the api can be given a deadline"""
+        api = uworker.UWorker(retries=5).api
+        self.assertEqual(api.retry_policy.retries, 5)
+        self.assertIsNone(api.retry_policy.deadline)
+        self.assertEqual(api.get_retry_policy('fetch').deadline, 600)
+        self.monkeypatch.setenv('UWORKER_JOB_API_DEADLINE', '120')
+        api = uworker.UWorker().api
+        self.assertEqual(api.get_retry_policy('status').deadline, 120)
+        self.assertEqual(api.get_retry_policy('fetch').deadline, 120)
+        self.monkeypatch.setenv('UWORKER_JOB_API_DEADLINE', 'never')
+        with self.assertRaises(uworker.UWorkerError):
+            uworker.UWorker()
+
+    def test_api_timeout(self):
+        """Test that the api timeout is validated"""
+        self.monkeypatch.setenv('UWORKER_JOB_API_TIMEOUT', '60')
+        self.assertEqual(uworker.UWorker().api.timeout, 60)
+        self.monkeypatch.setenv('UWORKER_JOB_API_TIMEOUT', 'soon')
+        with self.assertRaises(uworker.UWorkerError):
+            uworker.UWorker()
+
+
+class TestJobSlots(BaseWorkerWithoutApiTest):
+    """Test the job slots of a worker"""
+
+    def test_slots_from_config(self):
+        """Test that the number of slots can be set from the environment"""
+        self.assertEqual(uworker.UWorker().slots, 1)
+        self.monkeypatch.setenv('UWORKER_CONCURRENCY', '4')
+        self.assertEqual(uworker.UWorker().slots, 4)
+        self.assertEqual(uworker.UWorker(slots=2).slots, 2)
+
+    def test_bad_slots(self):
+        """Test that the number of slots must be a positive integer"""
+        for slots in (0, -1, 'many'):
+            with self.assertRaises(uworker.UWorkerError):
+                uworker.UWorker(slots=slots)
+
+    def test_run_slots(self):
+        """Test that each slot runs its own job loop in its own thread"""
+        w = uworker.UWorker(slots=3)
+        threads = []
+        lock = threading.Lock()
+
+        def process_next_job(slot):
+            with lock:
+                threads.append((slot, threading.current_thread().name))
+
+        w._process_next_job = process_next_job
+        w.alive = True
+        w.run(only_once=True)
+        self.assertEqual(
+            sorted(threads),
+            [(0, 'slot-0'), (1, 'slot-1'), (2, 'slot-2')])
+        self.assertFalse(w.alive)
+
+    def test_stop_wakes_up_slots(self):
+        """Test that sleeping slots wake up when the worker is stopped"""
+        w = uworker.UWorker(slots=2, idle_sleep=600)
+        w._process_next_job = lambda slot: w._sleep(w.idle_sleep)
+        w.alive = True
+        t = threading.Thread(target=w.run)
+        t.start()
+        w.stop(None, None)
+        t.join(5)
+        self.assertFalse(t.is_alive())
+        self.assertFalse(w.running)
+
+
+class TestJobPrefetch(BaseWorkerWithoutApiTest):
+    """Test prefetching of jobs"""
+
+    def test_bad_prefetch(self):
+        """Test that the lookahead must be a non negative integer"""
+        for prefetch in (-1, 'many'):
+            with self.assertRaises(uworker.UWorkerError):
+                uworker.UWorker(prefetch=prefetch)
+
+    def test_prefetch(self):
+        """Test that the next job is claimed while a job is running and
+        that unstarted jobs are released when the worker stops"""
+        w = uworker.UWorker(prefetch=1, idle_sleep=0.01)
+        jobs = ['job1', 'job2', 'job3', 'job4']
+        fetched = []
+        processed = []
+        released = []
+
+        def next_jobs(count, slot=None):
+            if not jobs:
+                w._sleep(w.idle_sleep)
+                return []
+            fetched.append(jobs.pop(0))
+            return fetched[-1:]
+
+        def process_job(job, slot):
+            processed.append(job)
+            start = time()
+            while not w.prefetcher.jobs.qsize() and time() - start < 5:
+                sleep(0.01)
+            if len(processed) == 2:
+                w.stop(None, None)
+
+        w.next_jobs = next_jobs
+        w._process_job = process_job
+        w.release_job = released.append
+        w.alive = True
+        w.run()
+        self.assertEqual(processed, ['job1', 'job2'])
+        self.assertEqual(released, ['job3'])
+        self.assertEqual(fetched, ['job1', 'job2', 'job3'])
+        self.assertIsNone(w.prefetcher)
+
+
+class TestBatchFetch(BaseWorkerWithoutApiTest):
+    """Test fetching jobs in batches from the in-process fake api"""
+
+    supports_batch = True
+
+    @pytest.fixture(autouse=True)
+    def fake_api(self, environment):
+        self.fake_api = FakeMicroqAPI(supports_batch=self.supports_batch)
+        self.fake_api.start()
+        for job_id in range(5):
+            self.fake_api.add_job('project', str(job_id))
+        self.monkeypatch.setenv('UWORKER_JOB_API_ROOT', self.fake_api.root)
+        self.monkeypatch.setenv(
+            'UWORKER_JOB_API_USERNAME', self.fake_api.username)
+        self.monkeypatch.setenv(
+            'UWORKER_JOB_API_PASSWORD', self.fake_api.password)
+        yield
+        self.fake_api.stop()
+
+    def test_next_jobs(self):
+        """Test that a batch of jobs is fetched in one call and claimed"""
+        w = uworker.UWorker()
+        jobs = w.next_jobs(3)
+        self.assertEqual([job.id for job in jobs], ['0', '1', '2'])
+        self.assertEqual(len(self.fake_api.requests_to('fetch')), 1)
+        self.assertEqual(len(self.fake_api.requests_to('claim')), 3)
+        self.assertEqual(len(w.governor.reservations), 3)
+
+    def test_claim_contention(self):
+        """Test that more jobs are fetched to choose among when claims often
+        lose to other workers"""
+        w = uworker.UWorker()
+        w.claim_contention.record('project', conflict=True)
+        jobs = w.next_jobs(1)
+        self.assertEqual(len(jobs), 1)
+        fetches = self.fake_api.requests_to('fetch')
+        self.assertEqual(len(fetches), 1)
+        self.assertEqual(fetches[0].query.get('limit'), '2')
+        self.assertEqual(len(self.fake_api.requests_to('claim')), 1)
+        self.assertEqual(len(w.governor.reservations), 1)
+
+    def test_api_down(self):
+        """Test that no jobs are fetched while the api is down"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            self.monkeypatch.setenv(
+                'UWORKER_OUTBOX', os.path.join(tmpdir, 'outbox.sqlite'))
+            w = uworker.UWorker(idle_sleep=1, min_idle_sleep=.1)
+            sleeps = []
+            w._sleep = sleeps.append
+            for _ in range(w.api.breaker.threshold):
+                w.api.breaker.record_failure()
+            self.assertEqual(w.next_jobs(1), [])
+            self.assertEqual(sleeps, [1])
+            self.assertEqual(len(self.fake_api.requests_to('fetch')), 0)
+            w.api.breaker.record_success()
+            self.assertEqual(len(w.next_jobs(1)), 1)
+
+    def test_api_trial(self):
+        """Test that the worker waits while another call tries whether the
+        api has recovered"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            self.monkeypatch.setenv(
+                'UWORKER_OUTBOX', os.path.join(tmpdir, 'outbox.sqlite'))
+            w = uworker.UWorker(idle_sleep=1, min_idle_sleep=.1)
+            sleeps = []
+            w._sleep = sleeps.append
+
+            def fetch_jobs(count):
+                raise uworker.CircuitOpenError('The api is down')
+
+            w.fetch_jobs = fetch_jobs
+            self.assertEqual(w.next_jobs(1), [])
+            self.assertEqual(sleeps, [.1])
+
+    def test_prefetcher(self):
+        """Test that the prefetcher fills its queue with batches and
+        releases the jobs that are left when the worker stops"""
+        w = uworker.UWorker(prefetch=3, idle_sleep=0.01, min_idle_sleep=0.01)
+        processed = []
+
+        def process_job(job, slot):
+            processed.append(job.id)
+            if len(processed) == 2:
+                w.stop(None, None)
+
+        w._process_job = process_job
+        w.alive = True
+        w.run()
+        self.assertEqual(processed, ['0', '1'])
+        self.assertLess(
+            len(self.fake_api.requests_to('fetch')),
+            len(self.fake_api.requests_to('claim')))
+        statuses = [self.fake_api.job('project', str(job_id))['status']
+                    for job_id in range(5)]
+        self.assertEqual(statuses.count('CLAIMED'), 2)
+
+
+class TestSingleFetchFallback(TestBatchFetch):
+    """Test fetching jobs from an api without batches"""
+
+    supports_batch = False
+
+    def test_next_jobs(self):
+        """Test that one job is fetched if the api has no batches"""
+        w = uworker.UWorker()
+        jobs = w.next_jobs(3)
+        self.assertEqual([job.id for job in jobs], ['0'])
+        self.assertEqual(len(w.next_jobs(3)), 1)
+        self.assertEqual(len(self.fake_api.requests_to('fetch')), 2)
+
+    def test_prefetcher(self):
+        """Test that the prefetcher fetches the jobs one at a time"""
+        w = uworker.UWorker(prefetch=3, idle_sleep=0.01, min_idle_sleep=0.01)
+        processed = []
+
+        def process_job(job, slot):
+            processed.append(job.id)
+            if len(processed) == 5:
+                w.stop(None, None)
+
+        w._process_job = process_job
+        w.alive = True
+        w.run()
+        self.assertEqual(processed, ['0', '1', '2', '3', '4'])
+        self.assertGreaterEqual(
+            len(self.fake_api.requests_to('fetch')), 5)
+
+
+class TestDockerBackend(BaseWorkerWithoutApiTest):
+    """Test the choice between the docker api and the docker client"""
+
+    def test_backend(self):
+        """Test that the api is used when the socket is available"""
+        self.assertEqual(
+            uworker.UWorker(with_command=False).docker_backend, 'api')
+        self.monkeypatch.setattr(
+            docker_util, 'docker_socket_available', lambda: False)
+        self.assertEqual(
+            uworker.UWorker(with_command=False).docker_backend, 'cli')
+        self.monkeypatch.setenv('UWORKER_DOCKER_BACKEND', 'api')
+        self.assertEqual(
+            uworker.UWorker(with_command=False).docker_backend, 'api')
+        self.monkeypatch.setenv('UWORKER_DOCKER_BACKEND', 'grpc')
+        with self.assertRaises(uworker.UWorkerError):
+            uworker.UWorker(with_command=False)
+
+
 class BaseExecutorTest(unittest.TestCase):
 
     @staticmethod
@@ -204,6 +506,47 @@ class TestCommandExecutor(BaseExecutorTest):
         self.assertNotEqual(return_code, 0)
         self.assertTrue('Killed Test process' in self.callback.last_message)
 
+    def test_streams(self):
+        """Test that stdout and stderr are tagged and kept in order"""
+        ce = uworker.CommandExecutor('Test', ['sh', '-c'], self.log)
+        return_code, _ = ce.execute(
+            ['echo out1; sleep 0.1; echo err1 >&2; sleep 0.1; '
+             'printf "out2\\n\\n\\n"; sleep 0.1; printf last'],
+            self.callback)
+        self.assertEqual(return_code, 0)
+        lines = [
+            line.split(' - ', 1)[1]
+            for line in self.callback.last_message.splitlines()]
+        self.assertEqual(lines[:6], [
+            'STDOUT: out1', 'STDERR: err1', 'STDOUT: out2', 'STDOUT: ',
+            'STDOUT: ', 'STDOUT: last'])
+
+    def test_resource_usage(self):
+        """Test that the resources used by the process are measured"""
+        ce = uworker.CommandExecutor('Test', [sys.executable, '-c'], self.log)
+        return_code, _ = ce.execute(
+            ['x = bytearray(64 * 1024 ** 2); print(sum(range(10 ** 6)))'],
+            self.callback)
+        self.assertEqual(return_code, 0)
+        usage = ce.usage.as_dict()
+        self.assertGreater(usage['MaxRss'], 64 * 1024 ** 2)
+        self.assertGreater(usage['UserTime'] + usage['SystemTime'], 0)
+        self.assertEqual(usage['OutputBytes'], ce.output.size)
+        self.assertIn('MaxRss=', str(ce.usage))
+
+    def test_no_reader_threads(self):
+        """Test that the output is read without extra threads or sleeps"""
+        threads = []
+        ce = uworker.CommandExecutor('Test', ['sh', '-c'], self.log)
+        ce._write_lines = lambda stream, lines: threads.append(
+            threading.current_thread())
+        start = time()
+        return_code, _ = ce.execute(
+            ['for i in 1 2 3 4 5; do echo; done'], self.callback)
+        self.assertEqual(return_code, 0)
+        self.assertLess(time() - start, 2)
+        self.assertEqual(set(threads), {threading.current_thread()})
+
 
 @pytest.mark.slow
 class TestDockerExecutor(BaseExecutorTest):
@@ -0,0 +1,11 @@
+#!/bin/sh
+# Job command of the benchmark, see test/benchmark.py. Waits for
+# BENCHMARK_JOB_DURATION seconds and writes BENCHMARK_JOB_OUTPUT bytes of
+# output in lines of 80 bytes.
+if [ "${BENCHMARK_JOB_DURATION:-0}" != 0 ]; then
+    sleep "$BENCHMARK_JOB_DURATION"
+fi
+if [ "${BENCHMARK_JOB_OUTPUT:-0}" != 0 ]; then
+    yes xxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx \
+        | head -c "$BENCHMARK_JOB_OUTPUT"
+fi
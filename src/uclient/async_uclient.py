@@ -0,0 +1,178 @@
+"""Asyncio version of the API to the micro service.
+
+Requires aiohttp, install with `pip install aiohttp`.
+
+Example usage:
+
+>>> async def main():
+>>>     async with AsyncUClient(apiroot, username, password) as api:
+>>>         job = await AsyncJob.fetch(api, project='myproject')
+>>>         if job:
+>>>             await job.claim(worker='myworker')
+>>>             await job.send_status('STARTED')
+"""
+import asyncio
+import base64
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from uclient.uclient import (
+    BaseUClient, UClientError, Job, STEP_AUTH, STEP_DONE, STEP_SEND,
+    TOKEN_RENEWALS)
+
+
+def basic_auth_header(username, password):
+    """Return the value of an Authorization header for basic auth"""
+    credentials = '{}:{}'.format(username, password).encode('latin1')
+    return 'Basic ' + base64.b64encode(credentials).decode('ascii')
+
+
+class AsyncUClient(BaseUClient):
+    """API to the micro service for use in an asyncio event loop.
+
+    Has the same methods as UClient, but the api methods are coroutines.
+    Many calls can be in flight at the same time, they share a pool of at
+    most `pool_size` connections.
+    """
+
+    def __init__(self, *args, **kwargs):
+        if aiohttp is None:
+            raise UClientError('AsyncUClient requires aiohttp')
+        super(AsyncUClient, self).__init__(*args, **kwargs)
+        self.session = None
+        self._token_lock = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    def _get_session(self):
+        """The session must be created when the event loop is running"""
+        if self.session is None:
+            if isinstance(self.timeout, tuple):
+                connect_timeout, read_timeout = self.timeout
+            else:
+                connect_timeout = read_timeout = self.timeout
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=self.pool_size, force_close=not self.keep_alive),
+                timeout=aiohttp.ClientTimeout(
+                    sock_connect=connect_timeout, sock_read=read_timeout))
+        return self.session
+
+    async def close(self):
+        """Close the connections to the micro service"""
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def renew_token(self):
+        """
+        Renew token for token based authorization.
+        """
+        TOKEN_RENEWALS.inc()
+        url = self.uri + "/token"
+        r = await self._call_api(
+            url, renew_token=False, auth=self.token_auth, endpoint='token')
+        self._set_token((await r.json())['token'])
+
+    async def _call_api(self, url, method='GET', renew_token=True, auth=None,
+                        not_found_ok=False, endpoint=None, **kwargs):
+        """Call micro service.
+
+        Returns:
+           r (aiohttp.ClientResponse): The api response, the body has been
+             read.
+        Raises:
+           UClientError: When api call failes.
+           CircuitOpenError: When the api is down.
+        """
+        steps = self._call_steps(
+            url, renew_token, auth, not_found_ok, endpoint)
+        step, arg = self._next_step(steps)
+        while step != STEP_DONE:
+            try:
+                if step == STEP_AUTH:
+                    result = await self.get_auth(rejected=arg)
+                elif step == STEP_SEND:
+                    result = await self._send(url, method, arg, **kwargs)
+                else:
+                    await asyncio.sleep(arg)
+                    result = None
+            except Exception as e:
+                step, arg = self._next_step(steps, error=e)
+            else:
+                step, arg = self._next_step(steps, result)
+        return arg
+
+    async def _send(self, url, method, auth, headers=None, **kwargs):
+        """Send a request and read the response"""
+        headers = dict(headers or {})
+        headers['Authorization'] = basic_auth_header(*auth)
+        session = self._get_session()
+        async with session.request(
+                method, url, headers=headers, **kwargs) as response:
+            await response.read()
+        if self.verbose:
+            print(await response.text())
+        return response
+
+    @staticmethod
+    def _status_code(response):
+        return response.status
+
+    async def get_auth(self, rejected=None):
+        """Return the credentials of a call, renew the token if it is
+        missing, due for renewal or the rejected token.
+        """
+        if not self.credentials:
+            raise UClientError('No credentials provided')
+        if self._token_lock is None:
+            self._token_lock = asyncio.Lock()
+        # Concurrent calls should only renew the token once
+        async with self._token_lock:
+            if self._token_due() or (
+                    rejected is not None and self.token == rejected):
+                await self.renew_token()
+        return (self.token, '')
+
+
+class AsyncJob(Job):
+    """Job that is handled with an AsyncUClient"""
+
+    @classmethod
+    async def fetch(cls, api, job_type=None, project=None):
+        resp = await api.fetch_job(job_type=job_type, project=project)
+        if resp:
+            return cls(await resp.json(), api)
+
+    @classmethod
+    async def fetch_jobs(cls, api, count, job_type=None, project=None):
+        resp = await api.fetch_jobs(count, job_type=job_type, project=project)
+        if resp:
+            return cls._from_batch(await resp.json(), api)
+        return []
+
+    async def claim(self, worker='anonymous'):
+        if not self.claimed:
+            await self.api.claim_job(self.url_claim, worker)
+            self.claimed = True
+
+    async def unclaim(self):
+        if self.claimed:
+            await self.api.unclaim_job(self.url_claim)
+            self.claimed = False
+
+    async def send_status(self, status, processing_time=None,
+                          resource_usage=None):
+        await self.api.update_status(
+            self.url_status, status, processing_time=processing_time,
+            resource_usage=resource_usage)
+
+    async def send_output(self, output):
+        await self.api.update_output(self.url_output, output)
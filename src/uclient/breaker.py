@@ -0,0 +1,91 @@
+"""Stop calling the job api while it is down.
+
+The circuit breaker opens after a number of calls in a row have failed
+because the api could not be reached or was unavailable. While it is open
+the calls fail at once instead of going through their retries. After a
+while one call is let through as a trial; the breaker closes if it
+succeeds and opens again if it fails.
+
+Example usage:
+
+>>> breaker = CircuitBreaker(threshold=5, reset_timeout=30)
+>>> if breaker.allow():
+>>>     try:
+>>>         call_api()
+>>>     except ConnectionError:
+>>>         breaker.record_failure()
+>>>     else:
+>>>         breaker.record_success()
+"""
+from threading import Lock
+from time import time
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitBreaker:
+
+    def __init__(self, threshold=5, reset_timeout=30.):
+        """
+        Args:
+          threshold (int): Failures in a row that open the breaker.
+          reset_timeout (float): Seconds before a trial call is let through.
+        """
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened = None
+        self._state = CLOSED
+        # Set while the trial call of the half open breaker is made
+        self.trial_in_flight = False
+        self.lock = Lock()
+
+    @property
+    def state(self):
+        with self.lock:
+            return self._state
+
+    @property
+    def is_closed(self):
+        return self.state == CLOSED
+
+    def allow(self):
+        """Return True if a call may be made.
+
+        When the breaker is half open only the first caller gets True, it
+        makes the trial call and must record its result.
+        """
+        with self.lock:
+            if self._state == OPEN and (
+                    time() - self.opened >= self.reset_timeout):
+                self._state = HALF_OPEN
+            if self._state == CLOSED:
+                return True
+            if self._state == HALF_OPEN and not self.trial_in_flight:
+                self.trial_in_flight = True
+                return True
+            return False
+
+    def retry_in(self):
+        """Return the seconds until the next trial call, 0 if the breaker
+        is not open"""
+        with self.lock:
+            if self._state != OPEN:
+                return 0.
+            return max(self.opened + self.reset_timeout - time(), 0.)
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self._state = CLOSED
+            self.trial_in_flight = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.trial_in_flight = False
+            if self._state == HALF_OPEN or self.failures >= self.threshold:
+                self._state = OPEN
+                self.opened = time()
@@ -0,0 +1,85 @@
+"""Durable queue of the status and output updates that could not be sent.
+
+The updates are kept in a SQLite database so that they survive restarts of
+the worker, and are replayed in the order they were queued.
+
+Example usage:
+
+>>> outbox = Outbox('/var/lib/uworker/outbox.sqlite')
+>>> outbox.put('status', 'PUT', url, {'Status': 'FINISHED'})
+>>> for update in outbox.updates():
+>>>     send(update)
+>>>     outbox.remove(update.id)
+"""
+from collections import namedtuple
+from contextlib import contextmanager
+import json
+import sqlite3
+from threading import Lock
+from time import time
+
+Update = namedtuple('Update', 'id endpoint method url data created')
+
+
+class Outbox:
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = Lock()
+        with self._connect() as db:
+            db.execute(
+                'CREATE TABLE IF NOT EXISTS updates ('
+                'id INTEGER PRIMARY KEY AUTOINCREMENT, endpoint TEXT, '
+                'method TEXT, url TEXT, data TEXT, created REAL)')
+            self.size = db.execute(
+                'SELECT COUNT(*) FROM updates').fetchone()[0]
+
+    @contextmanager
+    def _connect(self):
+        """Yield a connection, commit and close it after the context"""
+        db = sqlite3.connect(self.path, timeout=30)
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def put(self, endpoint, method, url, data, coalesce=False):
+        """Queue an update.
+
+        Args:
+          endpoint (str): Endpoint of the api, e.g. 'status'.
+          method (str): The http method.
+          url (str): The url to call.
+          data: The json body of the call.
+          coalesce (bool): Drop the queued updates of the same endpoint
+            and url, e.g. older versions of the whole output of a job.
+        """
+        with self.lock, self._connect() as db:
+            if coalesce:
+                self.size -= db.execute(
+                    'DELETE FROM updates WHERE endpoint = ? AND url = ?',
+                    (endpoint, url)).rowcount
+            db.execute(
+                'INSERT INTO updates (endpoint, method, url, data, created) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (endpoint, method, url, json.dumps(data), time()))
+            self.size += 1
+
+    def updates(self):
+        """Return the queued updates, oldest first"""
+        with self.lock, self._connect() as db:
+            rows = db.execute(
+                'SELECT id, endpoint, method, url, data, created '
+                'FROM updates ORDER BY id').fetchall()
+        return [
+            Update(row[0], row[1], row[2], row[3], json.loads(row[4]), row[5])
+            for row in rows]
+
+    def remove(self, update_id):
+        with self.lock, self._connect() as db:
+            self.size -= db.execute(
+                'DELETE FROM updates WHERE id = ?', (update_id,)).rowcount
+
+    def __len__(self):
+        return self.size
@@ -0,0 +1,140 @@
+"""When and how long to wait before failed calls to the job api are retried.
+
+A call is retried when the api cannot be reached or responds with one of
+the retry statuses, by default 429 and the 5xx statuses of overloaded or
+restarting servers. The waits grow exponentially and are jittered so that
+many workers do not retry at the same time. A `Retry-After` header of the
+response is honored. No retry is made that would end after the deadline of
+the call.
+
+Example usage:
+
+>>> policy = RetryPolicy(retries=5, base_delay=1, deadline=60)
+>>> delay = policy.next_delay(attempt, elapsed, status_code=503)
+>>> if delay is None:
+>>>     raise UClientError('Giving up')
+"""
+from email.utils import parsedate_to_datetime
+import random
+from time import time
+
+RETRY_STATUSES = (429, 502, 503, 504)
+
+
+class RetryPolicy:
+
+    def __init__(self, retries=200, base_delay=1., multiplier=3.,
+                 max_delay=300., jitter=.5, deadline=None,
+                 retry_statuses=RETRY_STATUSES):
+        """
+        Args:
+          retries (int): Retry a call at most this many times.
+          base_delay (float): Seconds before the first retry.
+          multiplier (float): Growth of the wait for each retry, 1 for
+            constant waits.
+          max_delay (float): Longest wait in seconds, also caps Retry-After.
+          jitter (float): Share of each wait that is random, 0 to 1.
+          deadline (float): Seconds from the start of a call after which it
+            is not retried, None for no deadline.
+          retry_statuses (tuple): Status codes of responses that are
+            retried.
+        """
+        self.retries = retries
+        self.base_delay = base_delay
+        self.multiplier = multiplier
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.deadline = deadline
+        self.retry_statuses = tuple(retry_statuses)
+
+    def replace(self, **changes):
+        """Return a copy of the policy with some of the settings changed"""
+        settings = dict(vars(self))
+        settings.update(changes)
+        return RetryPolicy(**settings)
+
+    def retries_status(self, status_code):
+        return status_code in self.retry_statuses
+
+    def delay(self, attempt, retry_after=None):
+        """Return the seconds to wait before retry number `attempt` + 1.
+
+        Args:
+          attempt (int): Number of the failed attempt, from 0.
+          retry_after (float): Seconds that the api asked to wait.
+        """
+        if retry_after is not None:
+            return min(max(retry_after, 0.), self.max_delay)
+        delay = min(
+            self.base_delay * self.multiplier ** attempt, self.max_delay)
+        return delay * (1 - self.jitter * random.random())
+
+    def next_delay(self, attempt, elapsed, status_code=None,
+                   retry_after=None):
+        """Return the seconds to wait before the next attempt, or None if
+        the call should not be retried.
+
+        Args:
+          attempt (int): Number of the failed attempt, from 0.
+          elapsed (float): Seconds since the call started.
+          status_code (int): Status of the failed attempt, None if the api
+            could not be reached.
+          retry_after (float): Seconds that the api asked to wait.
+        """
+        if attempt >= self.retries:
+            return None
+        if status_code is not None and not self.retries_status(status_code):
+            return None
+        delay = self.delay(attempt, retry_after)
+        if self.deadline is not None and elapsed + delay > self.deadline:
+            return None
+        return delay
+
+
+def parse_retry_after(value, now=None):
+    """Return the seconds to wait from a Retry-After header, None if the
+    header is missing or malformed.
+
+    The header is either a number of seconds or an http date.
+    """
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.)
+    except ValueError:
+        pass
+    try:
+        date = parsedate_to_datetime(value)
+    except (TypeError, ValueError, IndexError):
+        return None
+    if date is None:
+        return None
+    return max(date.timestamp() - (now or time()), 0.)
+
+
+def _earliest(deadline, other):
+    return other if deadline is None else min(deadline, other)
+
+
+def endpoint_policies(policy):
+    """Return the policies of the endpoints of the api, derived from the
+    policy of the client.
+
+    Output uploads fail fast, the next upload sends the output again.
+    Claims are only retried when the api cannot be reached, error responses
+    are left to `UWorker.claim_job`, which retries them after short
+    jittered waits unless the job was claimed by another worker. Fetches
+    give up after ten minutes and poll again, status updates are as patient
+    as the client.
+    """
+    fail_fast = policy.replace(
+        retries=min(policy.retries, 3),
+        deadline=_earliest(policy.deadline, 60.))
+    return {
+        'fetch': policy.replace(deadline=_earliest(policy.deadline, 600.)),
+        'claim': policy.replace(
+            retries=min(policy.retries, 3), retry_statuses=()),
+        'output': fail_fast,
+        'append_output': fail_fast,
+        'status': policy,
+    }
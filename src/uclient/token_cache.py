@@ -0,0 +1,75 @@
+"""Share the tokens of the job api between the processes on a host.
+
+The tokens are kept in a json file that only the user can read. A lock file
+next to it serializes the processes, so when the token is due for renewal
+only one of them asks the api for a new token and the others read it from
+the file.
+
+Example usage:
+
+>>> cache = TokenCache('/tmp/uworker-tokens.json')
+>>> with cache.locked():
+>>>     entry = cache.get(key)
+>>>     if entry is None:
+>>>         cache.put(key, token, expires, refresh_at)
+"""
+from contextlib import contextmanager
+import fcntl
+import hashlib
+import json
+import os
+from threading import Lock
+
+
+class TokenCache:
+
+    def __init__(self, path):
+        self.path = path
+        self.lock_path = path + '.lock'
+        # flock does not serialize the threads of a process
+        self.thread_lock = Lock()
+
+    @staticmethod
+    def key(uri, username):
+        """Return the key of the tokens of a user of an api"""
+        return hashlib.sha256(
+            '{} {}'.format(uri, username).encode('utf-8')).hexdigest()
+
+    @contextmanager
+    def locked(self):
+        """Hold the lock of the cache for the context"""
+        with self.thread_lock:
+            fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                yield
+            finally:
+                os.close(fd)
+
+    def get(self, key):
+        """Return the cached token of a key, or None.
+
+        Returns:
+          dict: The token, when it expires and when it should be renewed,
+            seconds since the epoch, the times are None if unknown.
+        """
+        return self._read().get(key)
+
+    def put(self, key, token, expires=None, refresh_at=None):
+        """Store the token of a key, call with the lock held"""
+        entries = self._read()
+        entries[key] = {
+            'token': token, 'expires': expires, 'refresh_at': refresh_at}
+        tmp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as out:
+            json.dump(entries, out)
+        os.replace(tmp_path, self.path)
+
+    def _read(self):
+        try:
+            with open(self.path) as inp:
+                entries = json.load(inp)
+        except (IOError, ValueError):
+            return {}
+        return entries if isinstance(entries, dict) else {}
@@ -1,13 +1,36 @@
 import json
+import re
 import requests
-from time import sleep
+from requests.adapters import HTTPAdapter
+from threading import Event, Lock, Thread
+from time import sleep, time
 import urllib.request
 import urllib.parse
 import urllib.error
 
+from uclient.retry import RetryPolicy, endpoint_policies, parse_retry_after
 from utils.logs import get_logger
+from utils.metrics import REGISTRY
 from utils.validate import validate_project_name
 
+API_RETRIES = REGISTRY.counter(
+    'uclient_api_retries_total',
+    'Calls to the job api that were retried after a failed attempt')
+API_ATTEMPTS = REGISTRY.counter(
+    'uclient_api_attempts_total',
+    'Attempts of calls to the job api by endpoint and status code, error '
+    'if the api could not be reached', ['endpoint', 'result'])
+TOKEN_RENEWALS = REGISTRY.counter(
+    'uclient_token_renewals_total', 'Tokens requested from the job api')
+CIRCUIT_OPEN = REGISTRY.gauge(
+    'uclient_circuit_open',
+    '1 while calls to the job api are stopped because it is down')
+OUTBOX_UPDATES = REGISTRY.gauge(
+    'uclient_outbox_updates',
+    'Status and output updates waiting for the job api to recover')
+# Updates that are queued in the outbox while the api is down
+OUTBOX_ENDPOINTS = ('status', 'output')
+
 
 class UClientError(Exception):
     def __init__(self, reason, status_code=None):
@@ -19,16 +42,35 @@ class UClientError(Exception):
         super(UClientError, self).__init__(msg)
 
 
-class UClient:
-    """API to the micro service
+class CircuitOpenError(UClientError):
+    """The call was not made because the job api is down"""
 
-    The client is mostly adapted to suit the needs of uworker.
+
+# Steps of a call to the api that the transports carry out, see
+# `BaseUClient._call_steps`
+STEP_AUTH = 'auth'
+STEP_SEND = 'send'
+STEP_SLEEP = 'sleep'
+STEP_DONE = 'done'
+
+
+class BaseUClient:
+    """Transport independent parts of the API to the micro service.
+
+    The retries, the renewal of rejected tokens, the circuit breaker and the
+    checks of the responses are made by `_call_steps`. Subclasses implement
+    `_call_api`, which carries out the steps with their transport, and
+    `renew_token`. The api methods return whatever `_call_api` returns.
     """
     logger = get_logger("UClient", to_file=False, to_stdout=True)
+    # Renew tokens when this share of their lifetime is left
+    TOKEN_REFRESH_SHARE = .2
 
     def __init__(self, apiroot, username=None, password=None,
                  credentials_file=None, verbose=False, retries=200,
-                 time_between_retries=None):
+                 time_between_retries=None, pool_size=10, keep_alive=True,
+                 timeout=(10, 300), token_lifetime=None, token_cache=None,
+                 retry_policy=None, retry_policies=None, breaker=None):
         """
         Init the api client.
 
@@ -44,33 +86,90 @@ class UClient:
           retries (int): Retry the requests to the micro service at most This
             many times.
           time_between_retries (int): Number of seconds between the retry
-            requests.
+            requests, by default the waits grow exponentially.
+          pool_size (int): Keep at most this many connections to the micro
+            service open. Should be at least the number of threads that
+            use the client concurrently.
+          keep_alive (bool): If False, close the connection after each
+            request.
+          timeout (float or tuple): Seconds to wait for the server to
+            accept the connection and to send data, see the requests
+            documentation. None means wait forever.
+          token_lifetime (float): Seconds that the tokens of the api are
+            valid. Tokens are renewed before they expire if this is given,
+            otherwise only when the api rejects them.
+          token_cache (TokenCache): Share the tokens with the other
+            processes on the host.
+          retry_policy (RetryPolicy): When to retry failed calls, replaces
+            `retries` and `time_between_retries`.
+          retry_policies (dict): Endpoint -> RetryPolicy, for the endpoints
+            that should not use the policies from `endpoint_policies`.
+          breaker (CircuitBreaker): Fail calls at once while the api is
+            down.
         """
         self.uri = apiroot.strip('/')
         self.verbose = verbose
         self.credentials = self._get_credentials(
             username, password, credentials_file)
         self.token = None
-        self.retries = retries
-        if time_between_retries is None:
-            self.time_between_retries = [
-                min(pow(3, v), 300) for v in range(retries)]
-        else:
-            self.time_between_retries = [time_between_retries] * retries
+        self.token_expires = None
+        self.token_refresh_at = None
+        self.token_lifetime = token_lifetime
+        self.token_cache = token_cache
+        if retry_policy is None:
+            if time_between_retries is None:
+                retry_policy = RetryPolicy(retries)
+            else:
+                retry_policy = RetryPolicy(
+                    retries, base_delay=time_between_retries, multiplier=1,
+                    jitter=0)
+        self.retry_policy = retry_policy
+        self.retry_policies = endpoint_policies(retry_policy)
+        self.retry_policies.update(retry_policies or {})
+        self.pool_size = pool_size
+        self.keep_alive = keep_alive
+        self.timeout = timeout
+        # Cleared when the api turns out not to support appending output
+        self.append_supported = True
+        self.breaker = breaker
 
     def get_project_uri(self, project):
         if not validate_project_name(project):
             raise UClientError('Unsupported project name')
         return self.uri + '/v4/{}'.format(project)
 
-    def renew_token(self):
-        """
-        Renew token for token based authorization.
-        """
-        url = self.uri + "/token"
-        auth = (self.credentials['username'], self.credentials['password'])
-        r = self._call_api(url, renew_token=False, auth=auth)
-        self.token = r.json()['token']
+    @property
+    def token_auth(self):
+        """Credentials used to request a new token"""
+        if not self.credentials:
+            raise UClientError('No credentials provided')
+        return (self.credentials['username'], self.credentials['password'])
+
+    def _token_due(self, now=None):
+        """Return True if there is no token or if it should be renewed"""
+        if not self.token:
+            return True
+        return self.token_refresh_at is not None and (
+            now or time()) >= self.token_refresh_at
+
+    def _token_expired(self, now=None):
+        return self.token_expires is not None and (
+            now or time()) >= self.token_expires
+
+    def _set_token(self, token, expires=None, refresh_at=None):
+        """Use a token, by default it expires after `token_lifetime`"""
+        if expires is None and self.token_lifetime:
+            now = time()
+            expires = now + self.token_lifetime
+            refresh_at = expires - self.TOKEN_REFRESH_SHARE * (
+                self.token_lifetime)
+        self.token = token
+        self.token_expires = expires
+        self.token_refresh_at = refresh_at
+
+    @property
+    def token_cache_key(self):
+        return self.token_cache.key(self.uri, self.token_auth[0])
 
     def _load_credentials(self, filename="credentials.json"):
         """
@@ -100,92 +199,493 @@ class UClient:
 
     def get_job_list(self, project):
         """Request list of jobs from server."""
-        return self._call_api(self.get_project_uri(project) + "/jobs")
+        return self._call_api(
+            self.get_project_uri(project) + "/jobs", endpoint='job_list')
 
     def fetch_job(self, job_type=None, project=None):
         """Request an unprocessed job from server."""
+        return self._call_api(
+            self._fetch_url(job_type, project), not_found_ok=True,
+            endpoint='fetch')
+
+    def fetch_jobs(self, count, job_type=None, project=None):
+        """Request up to `count` unprocessed jobs from server.
+
+        The api responds with a list of jobs, {"Jobs": [...]}, if it
+        supports fetching jobs in batches. Apis that do not ignore the
+        limit and respond with one job like for `fetch_job`.
+        """
+        return self._call_api(
+            self._fetch_url(job_type, project, limit=count),
+            not_found_ok=True, endpoint='fetch')
+
+    def _fetch_url(self, job_type=None, project=None, limit=None):
         if project:
             url = self.get_project_uri(project) + "/jobs/fetch"
         else:
             url = self.uri + '/v4/projects/jobs/fetch'
+        params = {}
         if job_type:
-            url += '?{}'.format(urllib.parse.urlencode({'type': job_type}))
-        try:
-            return self._call_api(url)
-        except UClientError as err:
-            if err.status_code != 404:
-                raise
+            params['type'] = job_type
+        if limit:
+            params['limit'] = limit
+        if params:
+            url += '?{}'.format(urllib.parse.urlencode(params))
+        return url
 
     def claim_job(self, url, worker_name):
         """Claim job from server"""
         # TODO: Worker node info
-        return self._call_api(url, 'PUT', json={"Worker": worker_name})
+        return self._call_api(
+            url, 'PUT', json={"Worker": worker_name}, endpoint='claim')
+
+    def unclaim_job(self, url):
+        """Remove the claim of a job so that it can be fetched again"""
+        return self._call_api(url, 'DELETE', endpoint='unclaim')
 
     def update_output(self, url, output):
         """Update output of job."""
         return self._call_api(url, 'PUT', json={'Output': output},
-                              headers={'Content-Type': "application/json"})
+                              headers={'Content-Type': "application/json"},
+                              endpoint='output')
+
+    def append_output(self, url, output, offset):
+        """Append output to the output of a job.
+
+        Args:
+          url (str): Output url of the job.
+          output (str): The new output.
+          offset (int): Length of the output that the job already has,
+            the api responds with 409 if the offset is wrong.
+        """
+        return self._call_api(url, 'PATCH',
+                              json={'Output': output, 'Offset': offset},
+                              headers={'Content-Type': "application/json"},
+                              endpoint='append_output')
+
+    def update_status(self, url, status, processing_time=None,
+                      resource_usage=None):
+        """Update status of job.
 
-    def update_status(self, url, status, processing_time=None):
-        """Update status of job."""
+        Args:
+          resource_usage (dict): CPU time, memory, I/O etc. used by the job.
+        """
         data = {'Status': status,
                 'ProcessingTime': processing_time}
+        if resource_usage:
+            data['ResourceUsage'] = resource_usage
         return self._call_api(
             url, 'PUT',
             json=data,
-            headers={'Content-Type': "application/json"}
+            headers={'Content-Type': "application/json"},
+            endpoint='status'
         )
 
     def _call_api(self, url, method='GET', renew_token=True, auth=None,
-                  **kwargs):
+                  not_found_ok=False, endpoint=None, **kwargs):
         """Call micro service.
 
-        Returns:
-           r (requests.Response): The api response.
-        Raises:
-           UClientError: When api call failes.
+        Args:
+          url (str): The url to call.
+          method (str): The http method.
+          renew_token (bool): Renew the token and try again once if the
+            call is unauthorized.
+          auth (tuple): Use these credentials instead of the token.
+          not_found_ok (bool): Return None instead of raising an error
+            if the api responds with 404.
+          endpoint (str): Name of the endpoint, e.g. 'claim', selects the
+            retry policy of the call.
         """
-        if auth is None:
-            auth = self.auth
-        response = None
-        error = None
-        is_retry = False
-        retries = self.retries
+        raise NotImplementedError
+
+    def _call_steps(self, url, renew_token=True, auth=None,
+                    not_found_ok=False, endpoint=None):
+        """Make a call to the api, independent of the transport.
 
-        for attempt in range(retries + 1):
+        A generator that yields (step, argument) for the transport to carry
+        out and that is sent the results of the steps:
 
-            if is_retry:
-                sleep(self.time_between_retries[attempt - 1])
+          (STEP_AUTH, rejected): Return the credentials of the call, renew
+            the token first if it is the rejected token.
+          (STEP_SEND, credentials): Send the request and return the
+            response. Errors are thrown into the generator.
+          (STEP_SLEEP, seconds): Wait before the next attempt.
 
+        The generator returns the response, or None for an ignored 404, see
+        `_next_step`. See `_call_api` for the arguments.
+        """
+        request_auth = auth or (yield STEP_AUTH, None)
+        response = yield from self._attempt_steps(url, request_auth, endpoint)
+        if (renew_token and auth is None and
+                self._status_code(response) == 401):
+            # Retry once with a new token
+            request_auth = yield STEP_AUTH, request_auth[0]
+            response = yield from self._attempt_steps(
+                url, request_auth, endpoint)
+        if not self._check_response(
+                self._status_code(response), response.reason, not_found_ok):
+            return None
+        return response
+
+    @staticmethod
+    def _next_step(steps, result=None, error=None):
+        """Send the result or throw the error of a step into the steps of
+        a call.
+
+        Returns:
+          tuple: The next (step, argument), (STEP_DONE, response) when the
+            call is done.
+        """
+        try:
+            if error is None:
+                return steps.send(result)
+            return steps.throw(error)
+        except StopIteration as stop:
+            return STEP_DONE, stop.value
+
+    def _attempt_steps(self, url, auth, endpoint):
+        """Send a request, retry it according to the policy of the endpoint
+        if the api cannot be reached or responds with a retry status"""
+        policy = self.get_retry_policy(endpoint)
+        start = time()
+        attempt = 0
+        while True:
+            if self.breaker is not None and not self.breaker.allow():
+                CIRCUIT_OPEN.set(1)
+                raise CircuitOpenError(
+                    'API call to {} not made, the api is down'.format(url))
             try:
-                response = getattr(
-                    requests, method.lower())(url, auth=auth, **kwargs)
-                break
+                response = yield STEP_SEND, auth
             except Exception as err:
-                self.logger.warning(
-                    "Request to {0} raised {3} (attempt {1}/{2})".format(
-                        url, attempt + 1, retries + 1, err))
-                is_retry = True
-                error = err
-
-        if response is None:
-            raise UClientError('API call to {} failed: {}'.format(url, error))
-        if self.verbose:
-            print(response.text)
-        if renew_token and response.status_code == 401:
-            self.renew_token()
-            return self._call_api(
-                url, method=method, renew_token=False, **kwargs)
-        if response.status_code > 299:
-            raise UClientError(response.reason, response.status_code)
-        return response
+                self._record_result(ok=False)
+                delay = self._failed_attempt(
+                    url, endpoint, attempt, start, err)
+                if delay is None:
+                    raise UClientError(
+                        'API call to {} failed: {}'.format(url, err))
+            else:
+                status_code = self._status_code(response)
+                if not policy.retries_status(status_code):
+                    self._record_result(ok=True)
+                    self._count_attempt(endpoint, status_code)
+                    return response
+                self._record_result(ok=False)
+                delay = self._failed_attempt(
+                    url, endpoint, attempt, start,
+                    '{} {}'.format(status_code, response.reason),
+                    status_code,
+                    parse_retry_after(response.headers.get('Retry-After')))
+                if delay is None:
+                    return response
+            yield STEP_SLEEP, delay
+            attempt += 1
+
+    @staticmethod
+    def _status_code(response):
+        return response.status_code
+
+    def _record_result(self, ok):
+        if self.breaker is None:
+            return
+        if ok:
+            self.breaker.record_success()
+        else:
+            self.breaker.record_failure()
+        CIRCUIT_OPEN.set(0 if self.breaker.is_closed else 1)
+
+    def get_retry_policy(self, endpoint):
+        return self.retry_policies.get(endpoint, self.retry_policy)
+
+    def _failed_attempt(self, url, endpoint, attempt, start, error,
+                        status_code=None, retry_after=None):
+        """Count and log an attempt that failed.
+
+        Returns:
+          float: Seconds to wait before the next attempt, None if the call
+            should not be retried.
+        """
+        self._count_attempt(
+            endpoint, 'error' if status_code is None else status_code)
+        policy = self.get_retry_policy(endpoint)
+        delay = policy.next_delay(
+            attempt, time() - start, status_code, retry_after)
+        if delay is not None:
+            API_RETRIES.inc()
+        self.logger.warning(
+            "Request to {0} raised {3} (attempt {1}/{2})".format(
+                url, attempt + 1, policy.retries + 1, error))
+        return delay
+
+    @staticmethod
+    def _count_attempt(endpoint, status_code):
+        API_ATTEMPTS.inc(endpoint=endpoint or 'other', result=str(status_code))
+
+    @staticmethod
+    def _check_response(status_code, reason, not_found_ok=False):
+        """Return False if a 404 should be ignored, raise UClientError if
+        the api call failed and return True otherwise.
+        """
+        if not_found_ok and status_code == 404:
+            return False
+        if status_code > 299:
+            raise UClientError(reason, status_code)
+        return True
+
+
+class UClient(BaseUClient):
+    """API to the micro service
+
+    The client is mostly adapted to suit the needs of uworker.
+    """
+
+    # Seconds between the tries to send the queued updates in the background
+    OUTBOX_FLUSH_INTERVAL = 5.
+
+    def __init__(self, *args, outbox=None, **kwargs):
+        """See BaseUClient, and:
+
+        Args:
+          outbox (Outbox): Queue status and output updates while the
+            breaker is open and send them in the background when the api
+            has recovered, see `flush_outbox`. Requires a breaker.
+        """
+        super(UClient, self).__init__(*args, **kwargs)
+        self.session = self._create_session(self.pool_size, self.keep_alive)
+        # Threads share the client, one of them renews the token at a time
+        self._token_lock = Lock()
+        self._refresh_lock = Lock()
+        if outbox is not None and self.breaker is None:
+            raise UClientError('An outbox requires a circuit breaker')
+        self.outbox = outbox
+        # Updates are queued and replayed in order
+        self._outbox_lock = Lock()
+        self._flusher_lock = Lock()
+        self._closed = Event()
+        if outbox is not None:
+            OUTBOX_UPDATES.set(len(outbox))
+            if len(outbox):
+                self._flush_in_background()
+
+    @staticmethod
+    def _create_session(pool_size, keep_alive):
+        """Create a session that reuses connections to the micro service"""
+        session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        if not keep_alive:
+            session.headers['Connection'] = 'close'
+        return session
+
+    def close(self):
+        """Close the connections to the micro service"""
+        self._closed.set()
+        self.session.close()
+
+    def renew_token(self, rejected=None):
+        """
+        Renew token for token based authorization.
+
+        Args:
+          rejected (str): The token that the api rejected or that is due
+            for renewal. Nothing is done if another thread has already
+            replaced it. By default the token is always renewed.
+        """
+        with self._token_lock:
+            if rejected is not None and self.token != rejected:
+                return
+            if self.token_cache is None:
+                self._set_token(self._request_token())
+                return
+            key = self.token_cache_key
+            with self.token_cache.locked():
+                entry = self.token_cache.get(key)
+                now = time()
+                if (entry and entry['token'] != self.token and not any(
+                        t is not None and now >= t for t in (
+                            entry['expires'], entry['refresh_at']))):
+                    # Another process on the host has renewed the token
+                    self._set_token(
+                        entry['token'], entry['expires'], entry['refresh_at'])
+                    return
+                self._set_token(self._request_token())
+                self.token_cache.put(
+                    key, self.token, self.token_expires,
+                    self.token_refresh_at)
+
+    def _request_token(self):
+        TOKEN_RENEWALS.inc()
+        url = self.uri + "/token"
+        r = self._call_api(
+            url, renew_token=False, auth=self.token_auth, endpoint='token')
+        return r.json()['token']
+
+    def _refresh_in_background(self, token):
+        """Renew a token that is due for renewal but still valid"""
+        if not self._refresh_lock.acquire(blocking=False):
+            return
+        Thread(target=self._refresh_token, args=(token,),
+               name='token-refresh', daemon=True).start()
+
+    def _refresh_token(self, token):
+        try:
+            self.renew_token(rejected=token)
+        except UClientError as e:
+            self.logger.warning('Failed to renew the token: {}'.format(e))
+        finally:
+            self._refresh_lock.release()
+
+    def _call_api(self, url, method='GET', renew_token=True, auth=None,
+                  not_found_ok=False, endpoint=None, queue=True, **kwargs):
+        """Call micro service.
+
+        Args:
+          queue (bool): Queue status and output updates in the outbox if
+            the api is down, see BaseUClient for the other arguments.
+        Returns:
+           r (requests.Response): The api response, None if the update was
+             queued.
+        Raises:
+           UClientError: When api call failes.
+           CircuitOpenError: When the api is down and the call could not
+             be queued.
+        """
+        if queue and self.outbox is not None:
+            if (endpoint in OUTBOX_ENDPOINTS and len(self.outbox) and
+                    self.breaker.is_closed):
+                # The api has recovered, the queued updates go first
+                self.flush_outbox()
+            if self._queue_update(endpoint, method, url, kwargs):
+                return None
+            if endpoint == 'append_output' and len(self.outbox):
+                # Appending would overtake the queued output
+                raise CircuitOpenError('Output updates are queued')
+        try:
+            return self._run_steps(
+                self._call_steps(
+                    url, renew_token, auth, not_found_ok, endpoint),
+                method, url, kwargs)
+        except CircuitOpenError:
+            if queue and self._queue_update(
+                    endpoint, method, url, kwargs, api_down=True):
+                return None
+            raise
+
+    def _run_steps(self, steps, method, url, kwargs):
+        """Carry out the steps of a call with the session"""
+        step, arg = self._next_step(steps)
+        while step != STEP_DONE:
+            try:
+                if step == STEP_AUTH:
+                    if arg is not None:
+                        self.renew_token(rejected=arg)
+                    result = self.auth
+                elif step == STEP_SEND:
+                    result = self.session.request(
+                        method, url, auth=arg, timeout=self.timeout,
+                        **kwargs)
+                    if self.verbose:
+                        print(result.text)
+                else:
+                    sleep(arg)
+                    result = None
+            except Exception as e:
+                step, arg = self._next_step(steps, error=e)
+            else:
+                step, arg = self._next_step(steps, result)
+        return arg
+
+    def _queue_update(self, endpoint, method, url, kwargs, api_down=False):
+        """Queue a status or output update in the outbox if the api is down
+        or if earlier updates are queued.
+
+        Returns:
+          bool: True if the update was queued.
+        """
+        if endpoint not in OUTBOX_ENDPOINTS:
+            return False
+        with self._outbox_lock:
+            if not (api_down or len(self.outbox) or
+                    not self.breaker.is_closed):
+                return False
+            # Only the latest whole output of a job has to be sent
+            self.outbox.put(
+                endpoint, method, url, kwargs.get('json'),
+                coalesce=endpoint == 'output')
+            OUTBOX_UPDATES.set(len(self.outbox))
+        self.logger.warning(
+            'Job api is down, queued {} update of {}'.format(endpoint, url))
+        self._flush_in_background()
+        return True
+
+    def _flush_in_background(self):
+        """Send the queued updates from a thread until the outbox is empty,
+        so that they do not wait for the next call of the worker"""
+        if not self._flusher_lock.acquire(blocking=False):
+            return
+        Thread(target=self._run_flusher, name='outbox-flusher',
+               daemon=True).start()
+
+    def _run_flusher(self):
+        try:
+            while len(self.outbox) and not self._closed.wait(max(
+                    self.breaker.retry_in(), self.OUTBOX_FLUSH_INTERVAL)):
+                try:
+                    self.flush_outbox()
+                except Exception as e:
+                    self.logger.warning(
+                        'Failed to send queued updates: {}'.format(e))
+        finally:
+            self._flusher_lock.release()
+        # An update may have been queued after the last check
+        if len(self.outbox) and not self._closed.is_set():
+            self._flush_in_background()
+
+    def flush_outbox(self):
+        """Send the queued updates in order, until one fails because the api
+        is still down. Updates that the api rejects are dropped.
+
+        Returns:
+          bool: True if no updates are queued and the breaker is not
+            open, so that the api may be called.
+        """
+        if self.breaker is None:
+            return True
+        if self.outbox is None:
+            return self.breaker.retry_in() == 0
+        with self._outbox_lock:
+            for update in self.outbox.updates():
+                try:
+                    self._call_api(
+                        update.url, update.method, endpoint=update.endpoint,
+                        queue=False, json=update.data)
+                except UClientError as e:
+                    if isinstance(e, CircuitOpenError) or (
+                            e.status_code is None) or (
+                            self.get_retry_policy(
+                                update.endpoint).retries_status(
+                                    e.status_code)):
+                        break
+                    self.logger.warning(
+                        'Dropped queued {} update of {}: {}'.format(
+                            update.endpoint, update.url, e))
+                self.outbox.remove(update.id)
+            pending = len(self.outbox)
+            OUTBOX_UPDATES.set(pending)
+        return not pending and self.breaker.retry_in() == 0
 
     @property
     def auth(self):
         if not self.credentials:
             raise UClientError('No credentials provided')
-        if not self.token:
-            self.renew_token()
+        now = time()
+        if self._token_due(now):
+            token = self.token
+            if token is None or self._token_expired(now):
+                self.renew_token(rejected=token)
+            else:
+                self._refresh_in_background(token)
         return (self.token, '')
 
 
@@ -208,6 +708,36 @@ class Job:
         if resp:
             return cls(resp.json(), api)
 
+    @classmethod
+    def fetch_jobs(cls, api, count, job_type=None, project=None):
+        """Fetch up to `count` jobs in one call.
+
+        Returns:
+          list: The jobs, only one job if the api does not support fetching
+            jobs in batches.
+        """
+        resp = api.fetch_jobs(count, job_type=job_type, project=project)
+        if resp:
+            return cls._from_batch(resp.json(), api)
+        return []
+
+    @classmethod
+    def _from_batch(cls, data, api):
+        if 'Jobs' in data:
+            return [cls(job, api) for job in data['Jobs']]
+        return [cls(data, api)]
+
+    @property
+    def id(self):
+        """Id of the job, None if the api does not tell it"""
+        return self.data["Job"].get("JobID")
+
+    @property
+    def project(self):
+        """Name of the project of the job, parsed from the status url"""
+        match = re.search(r'/v\d+/([^/]+)/jobs/', self.url_status)
+        return match.group(1) if match else None
+
     @property
     def url_claim(self):
         """Claim job by calling this url"""
@@ -248,9 +778,15 @@ class Job:
             self.api.claim_job(self.url_claim, worker)
             self.claimed = True
 
-    def send_status(self, status, processing_time=None):
+    def unclaim(self):
+        if self.claimed:
+            self.api.unclaim_job(self.url_claim)
+            self.claimed = False
+
+    def send_status(self, status, processing_time=None, resource_usage=None):
         self.api.update_status(
-            self.url_status, status, processing_time=processing_time)
+            self.url_status, status, processing_time=processing_time,
+            resource_usage=resource_usage)
 
     def send_output(self, output):
         self.api.update_output(self.url_output, output)
@@ -0,0 +1,367 @@
+"""Client for the Docker Engine API on the unix socket of the docker daemon.
+
+Only what the worker needs is implemented, see
+https://docs.docker.com/engine/api/ for the api documentation.
+
+Example usage:
+
+>>> docker = DockerAPI()
+>>> docker.pull_image('alpine:3.4')
+>>> container = docker.create_container('alpine:3.4', ['echo', 'hello'])
+>>> docker.start_container(container)
+>>> for stream, data in docker.container_logs(container):
+>>>     print(stream, data)
+>>> docker.wait_container(container)
+0
+>>> docker.remove_container(container)
+"""
+import base64
+import http.client
+import json
+import os
+import socket
+import struct
+from urllib.parse import quote, urlencode
+
+DEFAULT_SOCKET = '/var/run/docker.sock'
+API_VERSION = '1.25'
+DOCKER_CONFIG = os.path.join(os.path.expanduser('~'), '.docker', 'config.json')
+DOCKER_HUB = 'https://index.docker.io/v1/'
+
+STREAMS = {0: 'stdin', 1: 'stdout', 2: 'stderr'}
+
+
+class DockerAPIError(Exception):
+    def __init__(self, reason, status_code=None):
+        self.status_code = status_code
+        if status_code:
+            msg = '{} {}'.format(status_code, reason)
+        else:
+            msg = reason
+        super(DockerAPIError, self).__init__(msg)
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """HTTP connection over a unix socket"""
+
+    def __init__(self, socket_path, timeout=None):
+        super(UnixHTTPConnection, self).__init__('localhost', timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.socket_path)
+        self.sock = sock
+
+
+def split_image_reference(reference):
+    """Split 'registry:5000/name:tag' into ('registry:5000/name', 'tag')"""
+    if '@' in reference:
+        return reference.split('@', 1)
+    name, _, tag = reference.rpartition(':')
+    if not name or '/' in tag:
+        return reference, 'latest'
+    return name, tag
+
+
+def registry_auth(reference, config_file=DOCKER_CONFIG):
+    """Return the X-Registry-Auth header value for the registry of an image
+    from the credentials that `docker login` stored, None if there are no
+    stored credentials.
+    """
+    try:
+        with open(config_file) as inp:
+            auths = json.load(inp).get('auths', {})
+    except (IOError, OSError, ValueError):
+        return None
+    name, _ = split_image_reference(reference)
+    first = name.split('/', 1)[0]
+    if '/' in name and ('.' in first or ':' in first or first == 'localhost'):
+        registry = first
+    else:
+        registry = DOCKER_HUB
+    for server, auth in auths.items():
+        if server.replace('https://', '').replace('http://', '').rstrip(
+                '/') != registry.replace('https://', '').rstrip('/'):
+            continue
+        if 'auth' not in auth:
+            return None
+        username, password = base64.b64decode(
+            auth['auth']).decode().split(':', 1)
+        return base64.urlsafe_b64encode(json.dumps({
+            'username': username, 'password': password,
+            'serveraddress': server}).encode()).decode()
+    return None
+
+
+class DockerAPI:
+    """Client for the Docker Engine API.
+
+    A new connection is used for each request so that one client can be
+    shared by several threads.
+    """
+
+    def __init__(self, socket_path=DEFAULT_SOCKET, timeout=60,
+                 config_file=DOCKER_CONFIG):
+        """
+        Args:
+          socket_path (str): Path to the unix socket of the docker daemon.
+          timeout (float): Seconds to wait for responses, streams that
+            follow a running container have no timeout.
+          config_file (str): Docker client config with registry credentials.
+        """
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self.config_file = config_file
+
+    def _request(self, method, path, params=None, body=None, headers=None,
+                 stream=False):
+        """Send a request to the daemon.
+
+        Returns:
+          http.client.HTTPResponse: The response, the caller must read it.
+        Raises:
+          DockerAPIError: If the daemon can not be reached or responds with
+            an error.
+        """
+        url = '/v{}{}'.format(API_VERSION, path)
+        if params:
+            url += '?' + urlencode(params)
+        headers = dict(headers or {})
+        if body is not None:
+            body = json.dumps(body).encode()
+            headers['Content-Type'] = 'application/json'
+        connection = UnixHTTPConnection(
+            self.socket_path, timeout=None if stream else self.timeout)
+        try:
+            connection.request(method, url, body=body, headers=headers)
+            response = connection.getresponse()
+        except (OSError, http.client.HTTPException) as err:
+            connection.close()
+            raise DockerAPIError(
+                'Docker api call {} {} failed: {}'.format(method, path, err))
+        if response.status >= 400:
+            data = response.read()
+            connection.close()
+            try:
+                reason = json.loads(data.decode())['message']
+            except (ValueError, KeyError):
+                reason = data.decode(errors='replace') or response.reason
+            raise DockerAPIError(reason, response.status)
+        return response
+
+    def _call(self, method, path, params=None, body=None, headers=None):
+        """Send a request and return the decoded json response, if any"""
+        response = self._request(
+            method, path, params=params, body=body, headers=headers)
+        data = response.read()
+        response.close()
+        return json.loads(data.decode()) if data.strip() else None
+
+    def ping(self):
+        """Return True if the daemon responds"""
+        try:
+            return self._request('GET', '/_ping').read() == b'OK'
+        except DockerAPIError:
+            return False
+
+    def inspect_image(self, reference):
+        """Return image details or None if the image does not exist"""
+        try:
+            return self._call(
+                'GET', '/images/{}/json'.format(quote(reference, safe='/:@')))
+        except DockerAPIError as err:
+            if err.status_code == 404:
+                return None
+            raise
+
+    def pull_image(self, reference, progress_callback=None):
+        """Pull an image from its registry.
+
+        Args:
+          reference (str): The image, e.g. registry.com/name:tag
+          progress_callback (function): Called with each progress message,
+            a dict with status, id, progress etc.
+        Raises:
+          DockerAPIError: If the pull fails.
+        """
+        name, tag = split_image_reference(reference)
+        headers = {}
+        auth = registry_auth(reference, self.config_file)
+        if auth:
+            headers['X-Registry-Auth'] = auth
+        response = self._request(
+            'POST', '/images/create',
+            params={'fromImage': name, 'tag': tag}, headers=headers,
+            stream=True)
+        try:
+            for line in response:
+                if not line.strip():
+                    continue
+                message = json.loads(line.decode())
+                if 'error' in message:
+                    raise DockerAPIError(message['error'])
+                if progress_callback:
+                    progress_callback(message)
+        finally:
+            response.close()
+
+    def list_images(self):
+        return self._call('GET', '/images/json')
+
+    def remove_image(self, image_id, force=False):
+        self._call('DELETE', '/images/{}'.format(image_id),
+                   params={'force': int(force)})
+
+    def disk_usage(self):
+        """Return the disk usage of images, containers and volumes"""
+        return self._call('GET', '/system/df')
+
+    def list_containers(self, all=False):
+        return self._call('GET', '/containers/json', params={'all': int(all)})
+
+    def create_container(self, image, cmd=None, env=None, network_mode=None,
+                         labels=None, entrypoint=None, host_config=None):
+        """Create a container and return its id"""
+        host_config = dict(host_config or {})
+        if network_mode:
+            host_config['NetworkMode'] = network_mode
+        body = {
+            'Image': image,
+            'Env': ['{}={}'.format(k, v) for k, v in (env or {}).items()],
+            'Labels': labels or {},
+            'HostConfig': host_config,
+            'AttachStdout': True,
+            'AttachStderr': True,
+        }
+        if cmd is not None:
+            body['Cmd'] = cmd
+        if entrypoint is not None:
+            body['Entrypoint'] = entrypoint
+        return self._call('POST', '/containers/create', body=body)['Id']
+
+    def start_container(self, container):
+        self._call('POST', '/containers/{}/start'.format(container))
+
+    def inspect_container(self, container):
+        return self._call('GET', '/containers/{}/json'.format(container))
+
+    def kill_container(self, container, signal='KILL'):
+        self._call('POST', '/containers/{}/kill'.format(container),
+                   params={'signal': signal})
+
+    def stop_container(self, container, timeout=10):
+        """Send TERM to the container and KILL after `timeout` seconds"""
+        response = self._request(
+            'POST', '/containers/{}/stop'.format(container),
+            params={'t': int(timeout)}, stream=True)
+        response.read()
+        response.close()
+
+    def wait_container(self, container):
+        """Wait for the container to stop and return its exit code"""
+        response = self._request(
+            'POST', '/containers/{}/wait'.format(container), stream=True)
+        data = response.read()
+        response.close()
+        return json.loads(data.decode())['StatusCode']
+
+    def remove_container(self, container, force=True):
+        self._call('DELETE', '/containers/{}'.format(container),
+                   params={'force': int(force), 'v': 1})
+
+    def container_stats(self, container):
+        """Stream resource usage samples of a running container.
+
+        Yields:
+          dict: Stats of the container, about once a second.
+        """
+        response = self._request(
+            'GET', '/containers/{}/stats'.format(container),
+            params={'stream': 1}, stream=True)
+        try:
+            for line in response:
+                if line.strip():
+                    yield json.loads(line.decode())
+        finally:
+            response.close()
+
+    def exec_create(self, container, cmd, env=None):
+        """Prepare a command to run in a running container.
+
+        Returns:
+          str: Id of the exec instance.
+        """
+        body = {
+            'Cmd': cmd,
+            'Env': ['{}={}'.format(k, v) for k, v in (env or {}).items()],
+            'AttachStdout': True,
+            'AttachStderr': True,
+        }
+        return self._call(
+            'POST', '/containers/{}/exec'.format(container), body=body)['Id']
+
+    def exec_start(self, exec_id):
+        """Run a prepared command and stream its output.
+
+        The command is started before this returns, not when the output is
+        first read.
+
+        Returns:
+          generator: Stream name ('stdout' or 'stderr') and output.
+        """
+        response = self._request(
+            'POST', '/exec/{}/start'.format(exec_id),
+            body={'Detach': False, 'Tty': False}, stream=True)
+        return _stream_frames(response)
+
+    def exec_inspect(self, exec_id):
+        """Return details, like ExitCode, about an exec instance"""
+        return self._call('GET', '/exec/{}/json'.format(exec_id))
+
+    def container_logs(self, container, follow=True):
+        """Stream the output of a container that has no tty.
+
+        Returns:
+          generator: Stream name ('stdout' or 'stderr') and output, in the
+            order that the container wrote it.
+        """
+        response = self._request(
+            'GET', '/containers/{}/logs'.format(container),
+            params={'follow': int(follow), 'stdout': 1, 'stderr': 1},
+            stream=True)
+        return _stream_frames(response)
+
+
+def _stream_frames(response):
+    """Yield the frames of a response and close it when done"""
+    try:
+        for stream, data in read_frames(response):
+            yield stream, data
+    finally:
+        response.close()
+
+
+def read_frames(response):
+    """Demultiplex the stdout/stderr stream of a container.
+
+    Each frame has an 8 byte header with the stream type and the size of
+    the frame.
+    """
+    while True:
+        header = _read_exact(response, 8)
+        if not header:
+            return
+        stream_type, size = struct.unpack('>BxxxL', header)
+        yield STREAMS.get(stream_type, 'stdout'), _read_exact(response, size)
+
+
+def _read_exact(response, size):
+    data = b''
+    while len(data) < size:
+        chunk = response.read(size - len(data))
+        if not chunk:
+            break
+        data += chunk
+    return data
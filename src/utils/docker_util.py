@@ -1,5 +1,8 @@
+import os
 from subprocess import check_output, CalledProcessError
 
+from utils.docker_api import DEFAULT_SOCKET, DockerAPI
+
 
 def in_docker():
     """Return True if this process is running inside a docker container"""
@@ -9,8 +12,35 @@ def in_docker():
 
 def docker_available():
     """Return True if this process can access the docker daemon"""
+    if docker_socket_available():
+        return True
     try:
         check_output(['docker', 'info'])
         return True
-    except CalledProcessError:
+    except (CalledProcessError, OSError):
         return False
+
+
+def docker_socket_available(socket_path=DEFAULT_SOCKET):
+    """Return True if the docker daemon responds on its unix socket"""
+    return os.path.exists(socket_path) and DockerAPI(socket_path).ping()
+
+
+def zombie_children():
+    """Return pids of the children of this process that have exited but
+    have not been waited for.
+    """
+    pids = []
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            with open('/proc/%s/stat' % name) as inp:
+                stat = inp.read()
+        except (IOError, OSError):
+            continue
+        # The command name is in parentheses and may contain spaces
+        fields = stat[stat.rfind(')') + 2:].split()
+        if fields[0] == 'Z' and int(fields[1]) == os.getpid():
+            pids.append(int(name))
+    return pids
@@ -0,0 +1,255 @@
+"""Metrics of the worker in the Prometheus text format.
+
+The metrics are kept in memory in a registry and served on a local HTTP
+endpoint when the worker is started with a metrics port. Updating a metric
+only takes a lock and a dict update, so metrics can be updated from the job
+loop without slowing it down.
+
+Example usage:
+
+>>> JOBS = REGISTRY.counter('jobs_total', 'Processed jobs', ['result'])
+>>> JOBS.inc(result='finished')
+>>> server = MetricsServer(REGISTRY, port=9100)
+>>> server.start()
+>>> # curl localhost:9100/metrics
+>>> server.stop()
+"""
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from time import time
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Buckets in seconds for calls to apis and for jobs and image pulls
+LATENCY_BUCKETS = (.01, .025, .05, .1, .25, .5, 1., 2.5, 5., 10., 30.)
+DURATION_BUCKETS = (1., 5., 15., 30., 60., 120., 300., 600., 1800., 3600.,
+                    7200.)
+
+
+class Metric:
+    """Base class of the metrics, one value per combination of labels"""
+
+    type_name = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self.values = {}
+        self.lock = Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.label_names):
+            raise ValueError('Metric %s has labels %s, got %s' % (
+                self.name, self.label_names, sorted(labels)))
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def get(self, **labels):
+        """Return the value for the labels, None if it has no value"""
+        with self.lock:
+            return self.values.get(self._key(labels))
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.documentation),
+                 '# TYPE {} {}'.format(self.name, self.type_name)]
+        with self.lock:
+            items = sorted(self.values.items())
+            lines.extend(self._render_samples(items))
+        return lines
+
+    def _render_samples(self, items):
+        return ['{}{} {}'.format(self.name, self._labels(key), _number(value))
+                for key, value in items]
+
+    def _labels(self, key, extra=()):
+        pairs = list(zip(self.label_names, key)) + list(extra)
+        if not pairs:
+            return ''
+        return '{%s}' % ','.join(
+            '{}="{}"'.format(name, _escape(value)) for name, value in pairs)
+
+
+class Counter(Metric):
+    type_name = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type_name = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    """Counts of observations in cumulative buckets, with their sum.
+
+    The value of each label combination is [bucket counts, count, sum].
+    """
+
+    type_name = 'histogram'
+
+    def __init__(self, name, documentation, labels=(),
+                 buckets=LATENCY_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                counts = self.values[key] = [[0] * len(self.buckets), 0, 0.]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[0][i] += 1
+            counts[1] += 1
+            counts[2] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the seconds that the context takes"""
+        start = time()
+        try:
+            yield
+        finally:
+            self.observe(time() - start, **labels)
+
+    def _render_samples(self, items):
+        lines = []
+        for key, (bucket_counts, count, total) in items:
+            for bound, bucket_count in zip(self.buckets, bucket_counts):
+                lines.append('{}_bucket{} {}'.format(
+                    self.name, self._labels(key, [('le', _number(bound))]),
+                    bucket_count))
+            lines.append('{}_bucket{} {}'.format(
+                self.name, self._labels(key, [('le', '+Inf')]), count))
+            lines.append('{}_count{} {}'.format(
+                self.name, self._labels(key), count))
+            lines.append('{}_sum{} {}'.format(
+                self.name, self._labels(key), _number(total)))
+        return lines
+
+
+class Registry:
+    """The metrics of a process"""
+
+    def __init__(self):
+        self.metrics = {}
+        self.lock = Lock()
+
+    def _add(self, metric):
+        with self.lock:
+            existing = self.metrics.get(metric.name)
+            if existing is not None:
+                if type(existing) is not type(metric):
+                    raise ValueError(
+                        'Metric %s already exists with another type' % (
+                            metric.name))
+                return existing
+            self.metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name, documentation, labels=()):
+        return self._add(Counter(name, documentation, labels))
+
+    def gauge(self, name, documentation, labels=()):
+        return self._add(Gauge(name, documentation, labels))
+
+    def histogram(self, name, documentation, labels=(),
+                  buckets=LATENCY_BUCKETS):
+        return self._add(Histogram(name, documentation, labels, buckets))
+
+    def render(self):
+        """Return all metrics in the Prometheus text format"""
+        with self.lock:
+            metrics = sorted(self.metrics.values(), key=lambda m: m.name)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+class MetricsServer:
+    """Serve the metrics of a registry on /metrics"""
+
+    def __init__(self, registry=REGISTRY, port=9100, host='127.0.0.1'):
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self.server = None
+        self.thread = None
+
+    def start(self):
+        registry = self.registry
+
+        class Handler(_MetricsHandler):
+            metrics_registry = registry
+
+        self.server = ThreadingHTTPServer((self.host, self.port), Handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_port
+        self.thread = Thread(
+            target=self.server.serve_forever, name='metrics-server')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.thread.join()
+            self.server = None
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    metrics_registry = None
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        payload = self.metrics_registry.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        """Suppress request logging"""
+
+
+def parse_address(value, default_host='127.0.0.1'):
+    """Parse '[host:]port' into (host, port)"""
+    host, _, port = str(value).rpartition(':')
+    return host or default_host, int(port)
+
+
+def _number(value):
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value)) if abs(value) < 1e15 else repr(value)
+    return str(value)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace(
+        '\n', '\\n')
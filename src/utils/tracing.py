@@ -0,0 +1,155 @@
+"""Timing spans around the phases of the jobs of the worker.
+
+A span records when a phase started, how long it took, the attributes of
+the job it belongs to and the error that ended it, if any. Spans that are
+started inside another span in the same thread are its children and
+inherit its attributes, so the phases of a job carry the job, project and
+image of the job. Finished spans are handed to the exporter of the tracer.
+Without an exporter no spans are recorded.
+
+Example usage:
+
+>>> TRACER.exporter = JsonlFileExporter('/tmp/spans.jsonl')
+>>> with TRACER.span('job', job='42', project='project'):
+>>>     with TRACER.span('fetch') as span:
+>>>         span.set(found=True)
+"""
+from contextlib import contextmanager
+import json
+import os
+from threading import Lock, local
+from time import time
+import uuid
+
+
+class Span:
+
+    def __init__(self, name, parent=None, attributes=None):
+        self.name = name
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent.span_id if parent else None
+        self.trace_id = parent.trace_id if parent else self.span_id
+        self.attributes = dict(parent.attributes) if parent else {}
+        self.attributes.update(attributes or {})
+        self.start = time()
+        self.duration = None
+        self.error = None
+
+    def set(self, **attributes):
+        """Add attributes to the span"""
+        self.attributes.update(attributes)
+
+    def as_dict(self):
+        return {
+            'name': self.name,
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'start': self.start,
+            'duration': self.duration,
+            'attributes': self.attributes,
+            'error': self.error,
+        }
+
+
+class _NoSpan:
+    """Stands in for spans when no spans are recorded"""
+
+    span_id = trace_id = None
+    attributes = {}
+
+    def set(self, **attributes):
+        pass
+
+
+NO_SPAN = _NoSpan()
+
+
+class Tracer:
+    """Create spans and hand the finished spans to an exporter"""
+
+    def __init__(self, exporter=None):
+        self.exporter = exporter
+        self._local = local()
+
+    @property
+    def enabled(self):
+        return self.exporter is not None
+
+    def current(self):
+        """Return the innermost open span of the thread, or None"""
+        stack = getattr(self._local, 'stack', None)
+        return stack[-1] if stack else None
+
+    @contextmanager
+    def span(self, name, parent=None, **attributes):
+        """Time the context as a span.
+
+        Args:
+          name (str): The phase, e.g. 'fetch' or 'image_pull'.
+          parent (Span): Parent of a span that is started in another thread
+            than its parent, by default the current span of the thread.
+          attributes: Attributes of the span, added to the attributes of
+            the parent.
+        Yields:
+          Span: The span, or a span that records nothing if the tracer has
+            no exporter.
+        """
+        exporter = self.exporter
+        if exporter is None:
+            yield NO_SPAN
+            return
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        if parent is None or parent is NO_SPAN:
+            parent = stack[-1] if stack else None
+        span = Span(name, parent, attributes)
+        stack.append(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.error = '{}: {}'.format(type(e).__name__, e)
+            raise
+        finally:
+            span.duration = time() - span.start
+            stack.pop()
+            exporter.export(span)
+
+
+class JsonlFileExporter:
+    """Append finished spans to a file, one json object per line.
+
+    The file is opened when the first span is exported and is reopened
+    after `close`.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+        self.lock = Lock()
+
+    def export(self, span):
+        line = json.dumps(span.as_dict(), default=str) + '\n'
+        with self.lock:
+            if self.file is None:
+                self.file = open(self.path, 'a')
+            self.file.write(line)
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+def read_spans(path):
+    """Return the spans in a file written by JsonlFileExporter"""
+    if not os.path.exists(path):
+        return []
+    with open(path) as inp:
+        return [json.loads(line) for line in inp if line.strip()]
+
+
+TRACER = Tracer()
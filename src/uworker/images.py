@@ -0,0 +1,388 @@
+"""Bookkeeping of the docker images on the host."""
+from collections import OrderedDict
+from contextlib import contextmanager
+import re
+from threading import Event, Lock, Thread
+from time import time
+
+from utils.docker_api import DockerAPIError, split_image_reference
+
+SIZE_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3,
+              'T': 1024 ** 4}
+
+
+def parse_size(value):
+    """Parse a size like '500M' or '20G' into bytes"""
+    match = re.match(
+        r'^\s*(\d+(?:\.\d+)?)\s*([KMGT]?)(?:i?B)?\s*$', str(value),
+        re.IGNORECASE)
+    if not match:
+        raise ValueError('Bad size: %r' % value)
+    number, unit = match.groups()
+    return int(float(number) * SIZE_UNITS[unit.upper()])
+
+
+class ImageCache:
+    """Remember which docker images exist on the host.
+
+    Maps image references, like 'registry.com/name:tag', to the id of the
+    local image. A reference is trusted for `ttl` seconds, after that the
+    executor asks docker again. All references to an image are forgotten
+    when the image is invalidated.
+
+    Example usage:
+
+    >>> cache = ImageCache(ttl=600)
+    >>> cache.add('alpine:3.4', 'sha256:abc')
+    >>> cache.get('alpine:3.4')
+    'sha256:abc'
+    >>> cache.invalidate(image_id='sha256:abc')
+    >>> cache.get('alpine:3.4') is None
+    True
+    """
+
+    def __init__(self, ttl=600):
+        self.ttl = ttl
+        self.images = {}
+        self.lock = Lock()
+
+    def get(self, reference):
+        """Return the image id of the reference if it is known to exist"""
+        with self.lock:
+            image_id, checked = self.images.get(reference, (None, 0))
+            if time() - checked > self.ttl:
+                self.images.pop(reference, None)
+                return None
+            return image_id
+
+    def add(self, reference, image_id):
+        with self.lock:
+            self.images[reference] = (image_id, time())
+
+    def invalidate(self, reference=None, image_id=None):
+        """Forget a reference or all references to an image id"""
+        with self.lock:
+            if reference is not None:
+                self.images.pop(reference, None)
+            if image_id is not None:
+                for ref, (ref_id, _) in list(self.images.items()):
+                    if ref_id == image_id:
+                        del self.images[ref]
+
+    def clear(self):
+        with self.lock:
+            self.images.clear()
+
+
+class ImageUsage:
+    """Remember when images were last used and which images are in use.
+
+    Images are identified by their references, a reference without a tag
+    means the latest tag, like for docker.
+
+    Example usage:
+
+    >>> usage = ImageUsage()
+    >>> with usage.using('alpine:3.4'):
+    >>>     usage.in_use(['alpine:3.4'])
+    True
+    >>> usage.last_use(['alpine:3.4', 'alpine:latest'])
+    1500000000.0
+    """
+
+    def __init__(self):
+        self.last_used = {}
+        self.users = {}
+        self.lock = Lock()
+
+    def touch(self, reference):
+        with self.lock:
+            self.last_used[_normalize(reference)] = time()
+
+    @contextmanager
+    def using(self, reference):
+        """Mark an image as in use while the context is active"""
+        reference = _normalize(reference)
+        with self.lock:
+            self.users[reference] = self.users.get(reference, 0) + 1
+            self.last_used[reference] = time()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.users[reference] -= 1
+                if not self.users[reference]:
+                    del self.users[reference]
+                self.last_used[reference] = time()
+
+    def in_use(self, references):
+        with self.lock:
+            return any(_normalize(ref) in self.users for ref in references)
+
+    def last_use(self, references):
+        """Return the last use of any of the references, None if unknown"""
+        with self.lock:
+            uses = [self.last_used.get(_normalize(ref)) for ref in references]
+        uses = [use for use in uses if use is not None]
+        return max(uses) if uses else None
+
+
+def _normalize(reference):
+    if '@' in reference:
+        return reference
+    return '{}:{}'.format(*split_image_reference(reference))
+
+
+class ImageCollector:
+    """Keep the disk usage of the images on the host within a budget.
+
+    When the images take more disk than `budget` bytes, the least recently
+    used images are removed until the usage is within the budget again.
+    Images that are used by containers, running or not, and images that an
+    executor is using are never removed. Images that the worker has not
+    used since it started are considered used when they were created.
+
+    Example usage:
+
+    >>> collector = ImageCollector(
+    >>>     DockerAPI(), parse_size('50G'), DockerExecutor.image_usage,
+    >>>     DockerExecutor.image_cache, log)
+    >>> collector.maybe_collect()  # After each job
+    """
+
+    # Seconds between the checks of the disk usage
+    INTERVAL = 60.
+
+    def __init__(self, docker, budget, usage, cache, log, interval=INTERVAL):
+        """
+        Args:
+          docker (DockerAPI): Client for the docker daemon.
+          budget (int): Bytes that the images may use.
+          usage (ImageUsage): When the images were used.
+          cache (ImageCache): Forget the images that are removed.
+          log: The logger of the worker.
+          interval (float): Check the disk usage at most this often.
+        """
+        self.docker = docker
+        self.budget = budget
+        self.usage = usage
+        self.cache = cache
+        self.log = log
+        self.interval = interval
+        self.last_run = None
+        self.lock = Lock()
+        # Called with each reference of a removed image
+        self.on_remove = None
+
+    def maybe_collect(self):
+        """Collect if the last check was more than `interval` seconds ago
+        and no other thread is collecting.
+
+        Returns:
+          list: Ids of the removed images.
+        """
+        if not self.lock.acquire(blocking=False):
+            return []
+        try:
+            if self.last_run and time() - self.last_run < self.interval:
+                return []
+            self.last_run = time()
+            return self.collect()
+        except DockerAPIError as e:
+            self.log.warning('Could not collect unused images: %s' % e)
+            return []
+        finally:
+            self.lock.release()
+
+    def collect(self):
+        """Remove least recently used images until the images are within
+        the budget.
+
+        Returns:
+          list: Ids of the removed images.
+        """
+        disk_usage = self.docker.disk_usage()
+        total = disk_usage.get('LayersSize') or 0
+        if total <= self.budget:
+            return []
+        self.log.info(
+            'Images use %d bytes, more than the budget of %d bytes' % (
+                total, self.budget))
+        used = set(
+            container['ImageID']
+            for container in self.docker.list_containers(all=True))
+        candidates = []
+        for image in disk_usage.get('Images') or []:
+            references = [
+                ref for ref in (image.get('RepoTags') or []) + (
+                    image.get('RepoDigests') or [])
+                if not ref.startswith('<none>')]
+            if image['Id'] in used or self.usage.in_use(references):
+                continue
+            last_use = self.usage.last_use(references)
+            if last_use is None:
+                last_use = image.get('Created', 0)
+            candidates.append((last_use, image))
+        candidates.sort(key=lambda candidate: candidate[0])
+
+        removed = []
+        for _, image in candidates:
+            if total <= self.budget:
+                break
+            try:
+                self.docker.remove_image(image['Id'], force=True)
+            except DockerAPIError as e:
+                self.log.warning('Could not remove image %s: %s' % (
+                    image['Id'], e))
+                continue
+            self.cache.invalidate(image_id=image['Id'])
+            if self.on_remove:
+                for reference in image.get('RepoTags') or []:
+                    self.on_remove(reference)
+            total -= image['Size'] - max(image.get('SharedSize', 0), 0)
+            removed.append(image['Id'])
+            self.log.info('Removed image %s %s' % (
+                image['Id'], ' '.join(image.get('RepoTags') or [])))
+        if total > self.budget:
+            self.log.warning(
+                'Images still use %d bytes, more than the budget of %d '
+                'bytes' % (total, self.budget))
+        return removed
+
+
+class ImagePrefetcher:
+    """Pull the images of upcoming jobs in the background.
+
+    The prefetcher learns which images each project uses from the jobs that
+    the worker processes, and keeps the `images_per_project` most recently
+    used images of each project on the host. At most `max_images` images
+    are kept over all projects, and images that no job has used for
+    `max_age` seconds are forgotten. Images of jobs that are claimed but not
+    started yet are pulled first. Only one image is pulled at a time
+    so that the pulls of the running jobs are not slowed down much.
+
+    Pulls of the prefetcher do not count as uses of the images, so an image
+    that no job has used since it was prefetched is the first to go when
+    the images take more disk than the budget, see `ImageCollector`. The
+    prefetcher is told to forget the images that are removed.
+
+    Example usage:
+
+    >>> prefetcher = ImagePrefetcher(
+    >>>     lambda image_url: DockerExecutor('Prefetch', image_url, log), log)
+    >>> prefetcher.start()
+    >>> prefetcher.learn(job.project, job.url_image)
+    >>> prefetcher.want(next_job.url_image)
+    >>> prefetcher.close()
+    """
+
+    # Seconds between the checks that the learned images still exist
+    INTERVAL = 300.
+    # Seconds to wait for a pull in progress when the prefetcher is closed
+    CLOSE_TIMEOUT = 5.
+    # Images to keep over all projects
+    MAX_IMAGES = 8
+    # Seconds after which an image that no job has used is forgotten
+    MAX_AGE = 24 * 3600.
+
+    def __init__(self, executor_factory, log, images_per_project=1,
+                 interval=INTERVAL, max_images=MAX_IMAGES, max_age=MAX_AGE):
+        """
+        Args:
+          executor_factory (function): Create a docker executor for an
+            image url.
+          log: The logger of the worker.
+          images_per_project (int): Number of images to keep per project,
+            0 only pulls the images of upcoming jobs.
+          interval (float): Seconds between the checks of the images.
+          max_images (int): Number of images to keep over all projects.
+          max_age (float): Forget images that no job has used for this
+            many seconds.
+        """
+        self.executor_factory = executor_factory
+        self.log = log
+        self.images_per_project = images_per_project
+        self.interval = interval
+        self.max_images = max_images
+        self.max_age = max_age
+        # Image url -> (project, last use), least recently used first
+        self.recent = OrderedDict()
+        self.wanted = []
+        self.lock = Lock()
+        self.wakeup = Event()
+        self.stopped = Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = Thread(target=self._run, name='image-prefetcher')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self):
+        self.stopped.set()
+        self.wakeup.set()
+        if self.thread:
+            self.thread.join(self.CLOSE_TIMEOUT)
+
+    def learn(self, project, image_url):
+        """Remember that a project used an image"""
+        if not image_url or self.images_per_project < 1:
+            return
+        with self.lock:
+            self.recent.pop(image_url, None)
+            self.recent[image_url] = (project, time())
+            images = [
+                url for url, (p, _) in self.recent.items() if p == project]
+            for url in images[:-self.images_per_project]:
+                del self.recent[url]
+            while len(self.recent) > self.max_images:
+                self.recent.popitem(last=False)
+
+    def forget(self, reference):
+        """Stop keeping an image, e.g. because it was removed to free disk"""
+        reference = _normalize(reference)
+        with self.lock:
+            for url in list(self.recent):
+                if _normalize(url) == reference:
+                    del self.recent[url]
+
+    def want(self, image_url):
+        """Pull an image as soon as possible"""
+        if not image_url:
+            return
+        with self.lock:
+            if image_url not in self.wanted:
+                self.wanted.append(image_url)
+        self.wakeup.set()
+
+    def pending(self):
+        """Return the images to check, in the order they should be pulled"""
+        with self.lock:
+            wanted, self.wanted = self.wanted, []
+            expired = time() - self.max_age
+            for url, (_, last_use) in list(self.recent.items()):
+                if last_use < expired:
+                    del self.recent[url]
+            recent = list(reversed(self.recent))
+        return wanted + [url for url in recent if url not in wanted]
+
+    def _run(self):
+        while not self.stopped.is_set():
+            self.wakeup.clear()
+            for image_url in self.pending():
+                if self.stopped.is_set():
+                    return
+                self._pull(image_url)
+            self.wakeup.wait(self.interval)
+
+    def _pull(self, image_url):
+        try:
+            executor = self.executor_factory(image_url)
+            if executor.image_exists():
+                return
+            self.log.info('Prefetching image %s' % image_url)
+            if executor.pull_image(None, touch=False) != 0:
+                self.log.warning('Could not prefetch image %s' % image_url)
+        except Exception:
+            self.log.exception('Exception when prefetching image %s:' % (
+                image_url))
@@ -0,0 +1,144 @@
+"""Jobs that the worker has claimed but not finished, kept on disk.
+
+Each job has a json file in the journal directory from when it is claimed
+until its final status has been sent, and a spool file with the latest
+output of the job. If the worker dies, the next worker that starts with the
+same journal finds the jobs that were left behind and reports them, see
+`UWorker.reconcile_journal`.
+
+Example usage:
+
+>>> journal = JobJournal('/var/lib/uworker/journal')
+>>> key = journal.add(job)
+>>> journal.update(key, started=time())
+>>> journal.remove(key)  # The final status has been sent
+"""
+import errno
+import hashlib
+import json
+import os
+from threading import Lock
+from time import time
+
+
+class JobJournal:
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.lock = Lock()
+
+    @staticmethod
+    def key(url_claim):
+        return hashlib.sha1(url_claim.encode('utf-8')).hexdigest()[:16]
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.json')
+
+    def spool_path(self, key):
+        """Path of the file with the latest output of a job"""
+        return os.path.join(self.directory, key + '.out')
+
+    def add(self, job):
+        """Record a claimed job.
+
+        Returns:
+          str: The key of the job in the journal.
+        """
+        key = self.key(job.url_claim)
+        entry = {
+            'key': key,
+            'url_claim': job.url_claim,
+            'url_status': job.url_status,
+            'url_output': job.url_output,
+            'url_source': job.url_source,
+            'project': job.project,
+            'claimed': time(),
+            # Set when the job is started and when its container is created
+            'started': None,
+            'container': None,
+            # The resources of the job, set when it is started
+            'resources': None,
+            'pid': os.getpid(),
+            # Pids are reused, the start time tells the processes apart
+            'pid_start': process_start_time(os.getpid()),
+        }
+        with self.lock:
+            self._write(key, entry)
+        return key
+
+    def update(self, key, **fields):
+        with self.lock:
+            entry = self._read(self.path(key))
+            if entry is None:
+                return
+            entry.update(fields)
+            self._write(key, entry)
+
+    def remove(self, key):
+        for path in (self.path(key), self.spool_path(key)):
+            try:
+                os.remove(path)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+
+    def entries(self):
+        """Return the recorded jobs, oldest claim first"""
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.json'):
+                entry = self._read(os.path.join(self.directory, name))
+                if entry:
+                    entries.append(entry)
+        return sorted(entries, key=lambda entry: entry['claimed'])
+
+    def read_spool(self, key):
+        """Return the spooled output of a job, b'' if there is none"""
+        try:
+            with open(self.spool_path(key), 'rb') as inp:
+                return inp.read()
+        except IOError:
+            return b''
+
+    def write_spool(self, key, data):
+        _write_file(self.spool_path(key), data)
+
+    def _write(self, key, entry):
+        _write_file(self.path(key), json.dumps(entry).encode('utf-8'))
+
+    @staticmethod
+    def _read(path):
+        try:
+            with open(path) as inp:
+                return json.load(inp)
+        except (IOError, ValueError):
+            return None
+
+
+def process_start_time(pid):
+    """Return when a process started, in clock ticks after boot, or None
+    if it is not known (there is no /proc, or no such process).
+    """
+    try:
+        with open('/proc/%d/stat' % pid) as inp:
+            stat = inp.read()
+    except IOError:
+        return None
+    # The name of the command in field 2 can contain spaces and parentheses,
+    # the start time is field 22
+    fields = stat.rpartition(')')[2].split()
+    try:
+        return int(fields[19])
+    except (IndexError, ValueError):
+        return None
+
+
+def _write_file(path, data):
+    """Replace the content of a file so that it survives a crash"""
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as out:
+        out.write(data)
+        out.flush()
+        os.fsync(out.fileno())
+    os.replace(tmp_path, path)
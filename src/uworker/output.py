@@ -0,0 +1,252 @@
+"""Handling of the output from the job processes."""
+from threading import Event, RLock, Thread
+from time import time
+
+from uclient.uclient import CircuitOpenError, UClientError
+from utils.metrics import REGISTRY
+from utils.tracing import TRACER
+
+OUTPUT_BYTES = REGISTRY.counter(
+    'uworker_output_uploaded_bytes_total',
+    'Bytes of job output sent to the job api')
+
+
+class OutputBuffer:
+    """Fixed memory store for the output of a job.
+
+    The first `head_size` and the last `tail_size` bytes are kept, the
+    output in between is replaced by a marker that tells how many bytes
+    were dropped. The buffer can be used from several threads, `lock` can
+    be held to do several operations atomically.
+
+    Example usage:
+
+    >>> output = OutputBuffer(head_size=4, tail_size=4)
+    >>> output.write(b'0123456789')
+    >>> output.getvalue()
+    b'0123\n[... 2 bytes of output dropped ...]\n6789'
+    """
+
+    def __init__(self, head_size, tail_size):
+        self.head_size = head_size
+        self.tail_size = tail_size
+        self.head = bytearray()
+        # The tail may grow to twice its size before it is trimmed, so that
+        # each write does not have to move the whole tail
+        self.tail = bytearray()
+        self.size = 0
+        self.lock = RLock()
+
+    def write(self, data):
+        length = len(data)
+        with self.lock:
+            self.size += length
+            room = self.head_size - len(self.head)
+            if room > 0:
+                self.head += data[:room]
+                data = data[room:]
+            if data:
+                self.tail += data
+                if len(self.tail) > 2 * self.tail_size:
+                    del self.tail[:len(self.tail) - self.tail_size]
+        return length
+
+    @property
+    def dropped(self):
+        """Number of bytes that have been dropped from the output"""
+        with self.lock:
+            return max(
+                0, self.size - len(self.head) - self.tail_size)
+
+    def getvalue(self):
+        with self.lock:
+            dropped = self.dropped
+            if not dropped:
+                return bytes(self.head + self.tail)
+            return b''.join([
+                self.head, self._marker(dropped),
+                self.tail[len(self.tail) - self.tail_size:]])
+
+    def read_since(self, offset):
+        """Return output that was written after `offset` bytes.
+
+        Returns:
+          (bytes, int): The new output and the offset of the end of it. The
+            output is None if some of it has been dropped.
+        """
+        with self.lock:
+            tail_start = self.size - len(self.tail)
+            if offset >= tail_start:
+                return bytes(self.tail[offset - tail_start:]), self.size
+            if tail_start == len(self.head):
+                return bytes(self.head[offset:] + self.tail), self.size
+            return None, self.size
+
+    @staticmethod
+    def _marker(dropped):
+        return '\n[... {} bytes of output dropped ...]\n'.format(
+            dropped).encode()
+
+
+class OutputUploader:
+    """Send the output of a job to the job api in the background.
+
+    The uploader runs in its own thread so that a slow or unavailable api
+    never keeps the executor from reading the output of the job process.
+    Output that is written while an upload is in progress is sent together
+    in the next upload. The time between the uploads adapts to how fast the
+    job writes output and to how long the uploads take.
+
+    In incremental mode only the output that was added since the last
+    successful upload is sent, together with the offset where it should be
+    appended. The uploader falls back to uploading the whole output if the
+    api does not support appending, if the api and the worker disagree about
+    the offset or if output was dropped from the output buffer. That the api
+    does not support appending is remembered by the api client.
+
+    Example usage:
+
+    >>> uploader = OutputUploader(api, job.url_output, log)
+    >>> uploader.start(executor.output)
+    >>> executor.execute(args, None)
+    >>> uploader.close()  # Sends the whole output
+
+    The uploader can also hand a copy of the output to a spool function on
+    each upload, so that the output survives a crash of the worker.
+    """
+
+    # Status codes that mean that the api cannot append output
+    APPEND_UNSUPPORTED = (400, 405, 501)
+    # Limits for the seconds between the uploads
+    MIN_INTERVAL = 5.
+    MAX_INTERVAL = 60.
+    # Aim for uploads of this many bytes when the job writes a lot
+    TARGET_UPLOAD_SIZE = 64 * 1024
+    # Spend at most 1/LATENCY_FACTOR of the time uploading
+    LATENCY_FACTOR = 10.
+
+    def __init__(self, api, url, log, incremental=True, spool=None):
+        self.api = api
+        self.url = url
+        self.log = log
+        self.incremental = incremental
+        # Function that stores the whole output, and the bytes it has got
+        self.spool = spool
+        self.spooled = 0
+        self.output = None
+        # Characters sent to the api and bytes read from the output
+        self.offset = 0
+        self.output_offset = 0
+        self.interval = self.MIN_INTERVAL
+        self.last_upload = None
+        # Span of the job, the parent of the spans of the uploads
+        self.span = None
+        self.stopped = Event()
+        self.thread = None
+
+    def start(self, output):
+        """Start uploading what is written to an OutputBuffer"""
+        self.output = output
+        self.last_upload = time()
+        self.span = TRACER.current()
+        if not (self.url or self.spool):
+            return
+        self.thread = Thread(target=self._run, name='output-uploader')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self):
+        """Stop the background uploads and send the whole output"""
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+        if self.url and self.output is not None:
+            try:
+                with TRACER.span('output_upload', parent=self.span,
+                                 final=True) as span:
+                    span.set(bytes=self._replace())
+            except Exception:
+                self.log.exception(
+                    'Exception when sending output to job api:')
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            if self.spool:
+                self._spool()
+            if not self.url:
+                continue
+            try:
+                self.upload()
+            except Exception:
+                self.log.exception(
+                    'Exception when sending output to job api:')
+
+    def _spool(self):
+        with self.output.lock:
+            if self.output.size == self.spooled:
+                return
+            data = self.output.getvalue()
+            self.spooled = self.output.size
+        try:
+            self.spool(data)
+        except Exception:
+            self.log.exception('Exception when spooling output:')
+
+    def upload(self):
+        """Send output that has not been sent yet"""
+        if self.output.size == self.output_offset:
+            self._update_interval(0, 0)
+            return
+        start = time()
+        with TRACER.span('output_upload', parent=self.span) as span:
+            if not (self.incremental and self.api.append_supported):
+                size = self._replace()
+            else:
+                size = self._append()
+            span.set(bytes=size)
+        self._update_interval(size, time() - start)
+
+    def _update_interval(self, size, latency):
+        now = time()
+        rate = size / max(now - self.last_upload, 1e-3)
+        self.last_upload = now
+        by_rate = (
+            self.TARGET_UPLOAD_SIZE / rate if rate else self.MAX_INTERVAL)
+        self.interval = min(self.MAX_INTERVAL, max(
+            self.MIN_INTERVAL, by_rate, self.LATENCY_FACTOR * latency))
+
+    def _append(self):
+        data, end = self.output.read_since(self.output_offset)
+        if data is None:
+            return self._replace()
+        chunk = data.decode(errors='replace')
+        try:
+            self.api.append_output(self.url, chunk, self.offset)
+        except CircuitOpenError:
+            # The api is down, the whole output is queued instead
+            return self._replace()
+        except UClientError as e:
+            if e.status_code in self.APPEND_UNSUPPORTED:
+                self.log.info(
+                    'Job api does not support appending output (%s), '
+                    'sending whole output instead' % e)
+                # Also for the later jobs of the worker
+                self.incremental = self.api.append_supported = False
+            elif e.status_code != 409:
+                raise
+            return self._replace()
+        OUTPUT_BYTES.inc(len(data))
+        self.offset += len(chunk)
+        self.output_offset = end
+        return len(data)
+
+    def _replace(self):
+        with self.output.lock:
+            data = self.output.getvalue()
+            end = self.output.size
+        output = data.decode(errors='replace')
+        self.api.update_output(self.url, output)
+        OUTPUT_BYTES.inc(len(data))
+        self.offset = len(output)
+        self.output_offset = end
+        return len(data)
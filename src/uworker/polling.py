@@ -0,0 +1,127 @@
+"""Pacing of the requests for new jobs when the job api has no work."""
+import random
+from threading import Lock
+from time import time
+
+
+class IdleBackoff:
+    """Jittered exponential idle delays.
+
+    The first delay is short so that jobs that arrive just after the worker
+    went idle are picked up quickly. The delay then grows up to `max_delay`.
+    The jitter keeps a fleet of idle workers from polling in lockstep.
+
+    Example usage:
+
+    >>> backoff = IdleBackoff(5, 600)
+    >>> sleep(backoff.next_delay())  # 2.5-5 seconds
+    >>> sleep(backoff.next_delay())  # 5-10 seconds
+    >>> backoff.reset()  # Got a job
+    """
+
+    def __init__(self, min_delay, max_delay, factor=2., jitter=.5):
+        self.min_delay = min(min_delay, max_delay)
+        self.max_delay = max_delay
+        self.factor = factor
+        self.jitter = jitter
+        self.attempts = 0
+
+    def next_delay(self):
+        delay = min(
+            self.max_delay, self.min_delay * self.factor ** self.attempts)
+        if delay < self.max_delay:
+            self.attempts += 1
+        return delay * (1 - self.jitter * random.random())
+
+    def reset(self):
+        self.attempts = 0
+
+
+class NegativeCache:
+    """Remember keys that recently had no jobs.
+
+    A key stays in the cache for an idle delay that grows each time the key
+    is added again without being discarded in between.
+    """
+
+    def __init__(self, min_delay, max_delay):
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.entries = {}
+        self.lock = Lock()
+
+    def add(self, key):
+        with self.lock:
+            _, backoff = self.entries.get(key, (None, None))
+            if backoff is None:
+                backoff = IdleBackoff(self.min_delay, self.max_delay)
+            self.entries[key] = (time() + backoff.next_delay(), backoff)
+
+    def discard(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def __contains__(self, key):
+        with self.lock:
+            expires, _ = self.entries.get(key, (0, None))
+        return expires > time()
+
+    def time_left(self, keys):
+        """Return seconds until the first of the keys expires"""
+        with self.lock:
+            expires = [self.entries.get(key, (0, None))[0] for key in keys]
+        return max(0, min(expires) - time()) if expires else 0
+
+
+class ClaimContention:
+    """Share of the claims that lose to other workers, per project.
+
+    The share is a moving average, so it follows changes in the size of the
+    fleet. Under contention the worker fetches several jobs and claims them
+    in random order instead of racing the other workers for the first job,
+    and it waits a random while after a lost round so that the workers fall
+    out of step.
+
+    Example usage:
+
+    >>> contention = ClaimContention()
+    >>> contention.record('project', conflict=True)
+    >>> contention.spread('project')  # Jobs to choose among
+    2
+    >>> sleep(contention.delay('project'))
+    """
+
+    def __init__(self, weight=.2, max_spread=8, max_delay=2.):
+        """
+        Args:
+          weight (float): Weight of the latest claim in the average.
+          max_spread (int): Most jobs to fetch to choose among.
+          max_delay (float): Longest wait after a lost round, in seconds.
+        """
+        self.weight = weight
+        self.max_spread = max_spread
+        self.max_delay = max_delay
+        # Project, None for all projects -> [conflict rate, claims]
+        self.stats = {}
+        self.lock = Lock()
+
+    def record(self, project, conflict):
+        """Record a claim of a job of a project"""
+        with self.lock:
+            for key in {project, None}:
+                stats = self.stats.setdefault(key, [0., 0])
+                stats[0] += self.weight * (float(conflict) - stats[0])
+                stats[1] += 1
+
+    def rate(self, project=None):
+        """Return the share of the claims that lost, 0 to 1"""
+        with self.lock:
+            return self.stats.get(project, [0., 0])[0]
+
+    def spread(self, project=None):
+        """Return the number of jobs to fetch to choose one among"""
+        return 1 + int(round(self.rate(project) * (self.max_spread - 1)))
+
+    def delay(self, project=None):
+        """Return a random wait after a round of lost claims"""
+        return self.rate(project) * self.max_delay * random.random()
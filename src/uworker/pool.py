@@ -0,0 +1,185 @@
+"""Long-lived containers that run many jobs of images that opt in."""
+from threading import Lock
+from time import time
+
+from utils.docker_api import DockerAPIError
+
+
+class PooledContainer:
+
+    def __init__(self, container_id, image_url, image_id, entrypoint,
+                 max_jobs, resources=None):
+        self.id = container_id
+        self.image_url = image_url
+        self.resources = resources
+        self.image_id = image_id
+        self.entrypoint = entrypoint
+        self.max_jobs = max_jobs
+        self.jobs = 0
+        self.last_used = time()
+
+
+class ContainerPool:
+    """Keep containers running between the jobs of an image.
+
+    Creating, starting and removing a container for each job takes long
+    compared to short jobs. Images can opt in to running their jobs with
+    `docker exec` in a long-lived container by setting the LABEL label,
+    either to 'true' or to the number of jobs to run in a container. The
+    container is replaced after that many jobs or when a job fails.
+
+    The container only runs a shell that waits, so the image must have
+    `sh` and `sleep`. Each container runs one job at a time, and files that
+    a job leaves in the container are seen by the next jobs.
+
+    Example usage:
+
+    >>> pool = ContainerPool(DockerAPI(), log)
+    >>> container = pool.acquire('registry.com/image:tag')
+    >>> if container:
+    >>>     exec_id = docker.exec_create(
+    >>>         container.id, container.entrypoint + args)
+    >>>     ...
+    >>>     pool.release(container, healthy=exit_code == 0)
+    >>> pool.close()
+    """
+
+    LABEL = 'uworker.reuse'
+    # Jobs per container for images that set the label to 'true'
+    DEFAULT_MAX_JOBS = 20
+    # Stops directly on TERM, unlike a plain sleep as pid 1
+    KEEP_ALIVE = ['sh', '-c',
+                  'trap "exit 0" TERM; while :; do sleep 3600 & wait; done']
+
+    def __init__(self, docker, log, max_idle=1, idle_timeout=600,
+                 network='host'):
+        """
+        Args:
+          docker (DockerAPI): Client for the docker daemon.
+          log: The logger of the worker.
+          max_idle (int): Idle containers to keep per image.
+          idle_timeout (float): Remove containers that have been idle for
+            this many seconds.
+          network (str): Network mode of the containers.
+        """
+        self.docker = docker
+        self.log = log
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self.network = network
+        # (image url, resources) -> idle containers, most recently used
+        # last
+        self.idle = {}
+        self.lock = Lock()
+
+    def max_jobs(self, image):
+        """Return the number of jobs that an image allows per container,
+        0 if the image does not opt in.
+
+        Args:
+          image (dict): Image details from DockerAPI.inspect_image.
+        """
+        labels = (image.get('Config') or {}).get('Labels') or {}
+        value = labels.get(self.LABEL, '').strip().lower()
+        if value == 'true':
+            return self.DEFAULT_MAX_JOBS
+        if value.isdigit():
+            return int(value)
+        return 0
+
+    def acquire(self, image_url, resources=None):
+        """Return a running container for the image, None if the image does
+        not opt in to reuse. Only containers with the same resource limits
+        are shared.
+
+        Raises:
+          DockerAPIError: If a container cannot be started.
+        """
+        self.prune()
+        image = self.docker.inspect_image(image_url)
+        if not image:
+            return None
+        max_jobs = self.max_jobs(image)
+        if not max_jobs:
+            return None
+        stale = []
+        container = None
+        with self.lock:
+            idle = self.idle.get((image_url, resources), [])
+            while idle and container is None:
+                candidate = idle.pop()
+                if candidate.image_id == image['Id']:
+                    container = candidate
+                else:
+                    stale.append(candidate)
+        for candidate in stale:
+            self._remove(candidate)
+        if container:
+            return container
+        config = image.get('Config') or {}
+        container_id = self.docker.create_container(
+            image_url, cmd=[], entrypoint=self.KEEP_ALIVE,
+            network_mode=self.network, labels={self.LABEL: 'pooled'},
+            host_config=resources.host_config() if resources else None)
+        container = PooledContainer(
+            container_id, image_url, image['Id'],
+            config.get('Entrypoint') or [], max_jobs, resources)
+        try:
+            self.docker.start_container(container_id)
+        except DockerAPIError:
+            self._remove(container)
+            raise
+        self.log.info('Started pooled container %s for %s' % (
+            container_id[:12], image_url))
+        return container
+
+    def release(self, container, healthy=True):
+        """Give back a container after a job.
+
+        The container is removed if the job failed, if it has run its
+        maximum number of jobs or if enough containers are idle.
+        """
+        container.jobs += 1
+        container.last_used = time()
+        if healthy and container.jobs < container.max_jobs:
+            with self.lock:
+                idle = self.idle.setdefault(
+                    (container.image_url, container.resources), [])
+                if len(idle) < self.max_idle:
+                    idle.append(container)
+                    return
+        self._remove(container)
+
+    def discard(self, container):
+        """Remove a container that is in use, stops the job in it"""
+        self._remove(container)
+
+    def prune(self):
+        """Remove containers that have been idle too long"""
+        expired = []
+        with self.lock:
+            for key, idle in self.idle.items():
+                keep = [c for c in idle
+                        if time() - c.last_used < self.idle_timeout]
+                expired.extend(c for c in idle if c not in keep)
+                self.idle[key] = keep
+        for container in expired:
+            self._remove(container)
+
+    def close(self):
+        """Remove all idle containers"""
+        with self.lock:
+            idle = [c for containers in self.idle.values()
+                    for c in containers]
+            self.idle.clear()
+        for container in idle:
+            self._remove(container)
+
+    def _remove(self, container):
+        try:
+            self.docker.remove_container(container.id, force=True)
+            self.log.info('Removed pooled container %s after %d jobs' % (
+                container.id[:12], container.jobs))
+        except DockerAPIError as e:
+            self.log.warning('Could not remove container %s: %s' % (
+                container.id[:12], e))
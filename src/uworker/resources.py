@@ -0,0 +1,366 @@
+"""CPU and memory requirements of jobs and admission of jobs to the host."""
+import os
+from threading import Event, Lock, Thread
+
+from uworker.images import parse_size
+from utils.docker_api import DockerAPIError
+
+# Keys in the environment of a job that tell what the job needs
+CPUS_KEY = 'UWORKER_JOB_CPUS'
+MEMORY_KEY = 'UWORKER_JOB_MEMORY'
+
+
+class Resources:
+    """CPUs and bytes of memory that a job needs, None if not limited.
+
+    Example usage:
+
+    >>> Resources.parse(cpus='1.5', memory='4G')
+    Resources(cpus=1.5, memory=4294967296)
+    """
+
+    def __init__(self, cpus=None, memory=None):
+        self.cpus = cpus
+        self.memory = memory
+
+    @classmethod
+    def parse(cls, cpus=None, memory=None):
+        """Create from config values.
+
+        Raises:
+          ValueError: If a value cannot be parsed or is not positive.
+        """
+        cpus = float(cpus) if cpus else None
+        memory = parse_size(memory) if memory else None
+        if (cpus is not None and cpus <= 0) or memory == 0:
+            raise ValueError(
+                'Resources must be positive, cpus=%r memory=%r' % (
+                    cpus, memory))
+        return cls(cpus, memory)
+
+    @classmethod
+    def from_environment(cls, environment):
+        """Create from the environment of a job, None if the job does not
+        tell what it needs.
+        """
+        environment = environment or {}
+        if not (environment.get(CPUS_KEY) or environment.get(MEMORY_KEY)):
+            return None
+        return cls.parse(
+            environment.get(CPUS_KEY), environment.get(MEMORY_KEY))
+
+    def __bool__(self):
+        return bool(self.cpus or self.memory)
+
+    def __eq__(self, other):
+        return isinstance(other, Resources) and (
+            (self.cpus, self.memory) == (other.cpus, other.memory))
+
+    def __hash__(self):
+        return hash((self.cpus, self.memory))
+
+    def __repr__(self):
+        return 'Resources(cpus=%r, memory=%r)' % (self.cpus, self.memory)
+
+    def as_dict(self):
+        return {'cpus': self.cpus, 'memory': self.memory}
+
+    def docker_args(self):
+        """Arguments for `docker run`"""
+        args = []
+        if self.cpus:
+            args.append('--cpus=%g' % self.cpus)
+        if self.memory:
+            args.append('--memory=%db' % self.memory)
+        return args
+
+    def host_config(self):
+        """HostConfig for the Docker Engine API"""
+        host_config = {}
+        if self.cpus:
+            host_config['NanoCpus'] = int(self.cpus * 1e9)
+        if self.memory:
+            host_config['Memory'] = self.memory
+        return host_config
+
+
+def parse_project_resources(value):
+    """Parse project defaults like 'project1:2:8G,project2::4G' into a dict
+    of project -> Resources.
+    """
+    defaults = {}
+    for item in (value or '').split(','):
+        if not item.strip():
+            continue
+        try:
+            project, cpus, memory = item.strip().split(':')
+        except ValueError:
+            raise ValueError('Bad project resources: %r' % item)
+        defaults[project] = Resources.parse(cpus, memory)
+    return defaults
+
+
+def host_memory():
+    """Return (total, available) bytes of memory on the host"""
+    info = {}
+    with open('/proc/meminfo') as inp:
+        for line in inp:
+            key, value = line.split(':', 1)
+            info[key] = int(value.split()[0]) * 1024
+    return info['MemTotal'], info.get('MemAvailable', info['MemFree'])
+
+
+class ResourceGovernor:
+    """Admit jobs only when the host has CPUs and memory for them.
+
+    The resources of admitted jobs are reserved until the jobs are done. A
+    job is admitted if its CPUs fit in the CPUs that are not reserved and
+    not used by other processes, judged by the load average, and its memory
+    fits in the memory that is neither reserved nor used. A job is always
+    admitted when no other job is running, so that jobs that need more than
+    the host has still run.
+
+    Example usage:
+
+    >>> governor = ResourceGovernor(log)
+    >>> if governor.reserve(job.url_claim, resources):
+    >>>     try:
+    >>>         run_job()
+    >>>     finally:
+    >>>         governor.release(job.url_claim)
+    """
+
+    def __init__(self, log, cpus=None, memory=None, load=os.getloadavg,
+                 memory_info=host_memory):
+        """
+        Args:
+          log: The logger of the worker.
+          cpus (float): CPUs of the host, all CPUs if not given.
+          memory (int): Bytes of memory of the host, all if not given.
+          load (function): Return the load averages of the host.
+          memory_info (function): Return (total, available) memory.
+        """
+        self.log = log
+        self.cpus = cpus or os.cpu_count()
+        self.memory = memory
+        self.load = load
+        self.memory_info = memory_info
+        # Job -> reserved resources
+        self.reservations = {}
+        self.lock = Lock()
+
+    @property
+    def reserved_cpus(self):
+        return sum(r.cpus or 0 for r in self.reservations.values() if r)
+
+    @property
+    def reserved_memory(self):
+        return sum(r.memory or 0 for r in self.reservations.values() if r)
+
+    def reserve(self, job, resources, force=False):
+        """Reserve resources for a job if the host has them.
+
+        Args:
+          job: Key of the job, e.g. its claim url.
+          resources (Resources): What the job needs, or None.
+          force (bool): Reserve the resources even if the host does not
+            have them, for jobs that already run.
+        Returns:
+          bool: True if the job was admitted.
+        """
+        with self.lock:
+            if (self.reservations and resources and not force
+                    and not self._fits(resources)):
+                return False
+            self.reservations[job] = resources
+            return True
+
+    def release(self, job):
+        """Release the resources of a job, if it has any"""
+        with self.lock:
+            self.reservations.pop(job, None)
+
+    def _fits(self, resources):
+        if resources.cpus:
+            idle_cpus = self.cpus - self.load()[0]
+            free_cpus = min(self.cpus - self.reserved_cpus, idle_cpus)
+            if resources.cpus > free_cpus:
+                self.log.info(
+                    'Not enough free CPUs (%.1f) for job that needs %g' % (
+                        free_cpus, resources.cpus))
+                return False
+        if resources.memory:
+            total, available = self.memory_info()
+            free_memory = min(
+                (self.memory or total) - self.reserved_memory, available)
+            if resources.memory > free_memory:
+                self.log.info(
+                    'Not enough free memory (%d bytes) for job that needs '
+                    '%d bytes' % (free_memory, resources.memory))
+                return False
+        return True
+
+
+class ResourceUsage:
+    """Resources that a job used.
+
+    CPU times are in seconds, memory and I/O in bytes. Values that could not
+    be measured are None.
+
+    Example usage:
+
+    >>> _, status, rusage = os.wait4(pid, 0)
+    >>> usage = ResourceUsage.from_rusage(rusage)
+    >>> usage.as_dict()
+    {'UserTime': 1.2, 'SystemTime': 0.1, 'MaxRss': 104857600, ...}
+    """
+
+    FIELDS = [
+        ('user_time', 'UserTime'),
+        ('system_time', 'SystemTime'),
+        ('max_rss', 'MaxRss'),
+        ('block_read', 'BlockRead'),
+        ('block_write', 'BlockWrite'),
+        ('output_bytes', 'OutputBytes'),
+    ]
+
+    def __init__(self, user_time=None, system_time=None, max_rss=None,
+                 block_read=None, block_write=None, output_bytes=None):
+        self.user_time = user_time
+        self.system_time = system_time
+        self.max_rss = max_rss
+        self.block_read = block_read
+        self.block_write = block_write
+        self.output_bytes = output_bytes
+
+    @classmethod
+    def from_rusage(cls, rusage):
+        """Create from the rusage of a process, on Linux ru_maxrss is in
+        kilobytes and the block counts are in 512 byte blocks.
+        """
+        return cls(
+            user_time=rusage.ru_utime, system_time=rusage.ru_stime,
+            max_rss=rusage.ru_maxrss * 1024,
+            block_read=rusage.ru_inblock * 512,
+            block_write=rusage.ru_oublock * 512)
+
+    def as_dict(self):
+        """Return the measured values with the key names of the job api"""
+        return {key: getattr(self, name) for name, key in self.FIELDS
+                if getattr(self, name) is not None}
+
+    def __str__(self):
+        return ', '.join(
+            '{}={}'.format(key, round(value, 3) if isinstance(
+                value, float) else value)
+            for key, value in self.as_dict().items())
+
+
+class ContainerStatsSampler:
+    """Follow the docker stats of a container while a job runs in it.
+
+    Docker samples the cgroup of the container about once a second. The CPU
+    and I/O counters of the container are cumulative, so the usage of a job
+    is the difference between the last sample and the sample before the job
+    (zero for a new container). The peak memory of a new container is the
+    peak that its cgroup reports, it is unknown with cgroup v2 which does
+    not report a peak. The peak memory of a job in a reused container is the
+    largest memory usage that was sampled while the job ran. Jobs that end
+    before the first sample report no usage, the sampler does not make them
+    wait for one.
+
+    Example usage:
+
+    >>> sampler = ContainerStatsSampler(docker, container, log)
+    >>> sampler.start()
+    >>> run_job()
+    >>> usage = sampler.stop()
+    """
+
+    def __init__(self, docker, container, log, new_container=True):
+        self.docker = docker
+        self.container = container
+        self.log = log
+        self.new_container = new_container
+        self.first = None
+        self.last = None
+        # Largest memory usage and largest peak of the cgroup that were
+        # sampled
+        self.peak_usage = None
+        self.peak_memory = None
+        self.lock = Lock()
+        self.stopped = Event()
+        self.thread = Thread(target=self._run, name='stats-sampler')
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        """Stop sampling and return the ResourceUsage of the job from the
+        samples so far"""
+        self.stopped.set()
+        with self.lock:
+            if self.last is None:
+                return ResourceUsage()
+            first = self.first if not self.new_container else {}
+            # The peak of a reused container may be from an earlier job
+            peak = self.peak_memory if self.new_container else self.peak_usage
+            return ResourceUsage(
+                user_time=self._diff(first, 'user_time') / 1e9,
+                system_time=self._diff(first, 'system_time') / 1e9,
+                max_rss=peak,
+                block_read=self._diff(first, 'block_read'),
+                block_write=self._diff(first, 'block_write'))
+
+    def _diff(self, first, key):
+        return max(0, self.last[key] - first.get(key, 0))
+
+    def _run(self):
+        try:
+            for stats in self.docker.container_stats(self.container):
+                if self.stopped.is_set():
+                    return
+                self._add(stats)
+        except DockerAPIError as e:
+            self.log.warning('Could not follow stats of container %s: %s' % (
+                self.container[:12], e))
+
+    def _add(self, stats):
+        sample = parse_container_stats(stats)
+        if sample is None:
+            return
+        with self.lock:
+            if self.first is None:
+                self.first = sample
+            self.last = sample
+            self.peak_usage = max(self.peak_usage or 0, sample['memory'])
+            if sample['max_memory'] is not None:
+                self.peak_memory = max(
+                    self.peak_memory or 0, sample['max_memory'])
+
+
+def parse_container_stats(stats):
+    """Return the counters of a docker stats sample as a dict, None if the
+    container is not running.
+    """
+    cpu = (stats.get('cpu_stats') or {}).get('cpu_usage') or {}
+    if not cpu.get('total_usage'):
+        return None
+    memory = stats.get('memory_stats') or {}
+    block_io = {'read': 0, 'write': 0}
+    io_stats = (stats.get('blkio_stats') or {}).get(
+        'io_service_bytes_recursive') or []
+    for entry in io_stats:
+        op = entry.get('op', '').lower()
+        if op in block_io:
+            block_io[op] += entry.get('value', 0)
+    return {
+        'user_time': cpu.get('usage_in_usermode', 0),
+        'system_time': cpu.get('usage_in_kernelmode', 0),
+        'memory': memory.get('usage', 0),
+        # Not reported by cgroup v2
+        'max_memory': memory.get('max_usage'),
+        'block_read': block_io['read'],
+        'block_write': block_io['write'],
+    }
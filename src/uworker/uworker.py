@@ -31,27 +31,62 @@ running a docker container.
 import argparse
 from datetime import datetime
 import errno
-from io import BytesIO
+from functools import partial
 import os
+import queue
+import random
 import re
+import selectors
 import signal
 import socket
+import sqlite3
 import subprocess
 import sys
-from time import sleep, time
-from threading import Thread, Lock
-
-from uclient.uclient import UClient, UClientError, Job
+from time import time
+from threading import BoundedSemaphore, Event, Thread, Timer, Lock
+
+from uclient.breaker import CircuitBreaker
+from uclient.outbox import Outbox
+from uclient.retry import RetryPolicy
+from uclient.token_cache import TokenCache
+from uclient.uclient import CircuitOpenError, UClient, UClientError, Job
+from uworker.images import (
+    ImageCache, ImageCollector, ImagePrefetcher, ImageUsage, parse_size)
+from uworker.journal import JobJournal, process_start_time
+from uworker.output import OutputBuffer, OutputUploader
+from uworker.polling import ClaimContention, IdleBackoff, NegativeCache
+from uworker.pool import ContainerPool
+from uworker.resources import (
+    ContainerStatsSampler, ResourceGovernor, Resources, ResourceUsage,
+    parse_project_resources)
 from utils import docker_util
+from utils.docker_api import DockerAPI, DockerAPIError
 from utils.defs import JOB_STATES
 from utils.logs import get_logger
+from utils.metrics import (
+    DURATION_BUCKETS, REGISTRY, MetricsServer, parse_address)
+from utils.tracing import TRACER, JsonlFileExporter
 
 GENERAL_CONFIG = {
     'api_root': ('UWORKER_JOB_API_ROOT', True),
     'api_username': ('UWORKER_JOB_API_USERNAME', True),
     'api_password': ('UWORKER_JOB_API_PASSWORD', True),
+    'api_timeout': ('UWORKER_JOB_API_TIMEOUT', False),
+    'api_deadline': ('UWORKER_JOB_API_DEADLINE', False),
+    'token_lifetime': ('UWORKER_JOB_API_TOKEN_LIFETIME', False),
+    'token_cache': ('UWORKER_TOKEN_CACHE', False),
+    'outbox': ('UWORKER_OUTBOX', False),
+    'journal': ('UWORKER_JOURNAL', False),
     'external_username': ('UWORKER_EXTERNAL_API_USERNAME', False),
-    'external_password': ('UWORKER_EXTERNAL_API_PASSWORD', False)
+    'external_password': ('UWORKER_EXTERNAL_API_PASSWORD', False),
+    'concurrency': ('UWORKER_CONCURRENCY', False),
+    'prefetch': ('UWORKER_PREFETCH', False),
+    'output_uploads': ('UWORKER_OUTPUT_UPLOADS', False),
+    'job_cpus': ('UWORKER_JOB_CPUS', False),
+    'job_memory': ('UWORKER_JOB_MEMORY', False),
+    'project_resources': ('UWORKER_PROJECT_RESOURCES', False),
+    'metrics_port': ('UWORKER_METRICS_PORT', False),
+    'trace_file': ('UWORKER_TRACE_FILE', False),
 }
 
 WITH_COMMAND_CONFIG = {
@@ -61,12 +96,50 @@ WITH_COMMAND_CONFIG = {
     'job_timeout': ('UWORKER_JOB_TIMEOUT', False),
 }
 
+WITHOUT_COMMAND_CONFIG = {
+    'api_projects': ('UWORKER_JOB_API_PROJECTS', False),
+    'job_types': ('UWORKER_JOB_TYPES', False),
+    'docker_backend': ('UWORKER_DOCKER_BACKEND', False),
+    'prefetch_images': ('UWORKER_PREFETCH_IMAGES', False),
+    'image_disk_budget': ('UWORKER_IMAGE_DISK_BUDGET', False),
+}
+
+# Seconds that the tokens of the job api are valid
+DEFAULT_TOKEN_LIFETIME = 600
+
+JOBS = REGISTRY.counter(
+    'uworker_jobs_total', 'Jobs processed by the worker', ['status'])
+JOB_DURATION = REGISTRY.histogram(
+    'uworker_job_duration_seconds', 'Processing time of jobs', ['status'],
+    buckets=DURATION_BUCKETS)
+API_LATENCY = REGISTRY.histogram(
+    'uworker_api_latency_seconds',
+    'Seconds that job api calls take, including retries', ['call'])
+CLAIM_CONFLICTS = REGISTRY.counter(
+    'uworker_claim_conflicts_total',
+    'Jobs that another worker claimed first')
+CLAIM_CONFLICT_RATE = REGISTRY.gauge(
+    'uworker_claim_conflict_rate',
+    'Moving average of the share of claims that lost to another worker',
+    ['project'])
+IDLE_SECONDS = REGISTRY.counter(
+    'uworker_idle_seconds_total',
+    'Seconds that job slots slept because there were no jobs')
+IMAGE_PULL_DURATION = REGISTRY.histogram(
+    'uworker_image_pull_seconds', 'Seconds that image pulls take',
+    buckets=DURATION_BUCKETS)
+SLOTS = REGISTRY.gauge('uworker_slots', 'Job slots of the worker')
+BUSY_SLOTS = REGISTRY.gauge(
+    'uworker_busy_slots', 'Job slots that are processing a job')
+
 
 def get_config(with_command):
     """Create config dict from environment variables"""
     conf = GENERAL_CONFIG.copy()
     if with_command:
         conf.update(WITH_COMMAND_CONFIG)
+    else:
+        conf.update(WITHOUT_COMMAND_CONFIG)
     loaded_conf = {}
     for key, (env, required) in conf.items():
         if required:
@@ -76,6 +149,12 @@ def get_config(with_command):
     return loaded_conf
 
 
+def _split_list(value):
+    """Split comma separated config value, [None] if value is empty"""
+    items = [item.strip() for item in (value or '').split(',')]
+    return [item for item in items if item] or [None]
+
+
 class UWorkerError(Exception):
     pass
 
@@ -108,9 +187,14 @@ class UWorker:
     failed or finished by looking at the exit code of the command.
     """
 
+    # Seconds before the first retry of a claim that failed, doubled for
+    # each retry
+    CLAIM_RETRY_DELAY = 1.
+
     def __init__(
         self, start_service=False, with_command=True, idle_sleep=600,
-        error_sleep=30, retries=200
+        error_sleep=30, retries=200, slots=None, prefetch=None,
+        min_idle_sleep=5
     ):
         if not with_command:
             if docker_util.in_docker():
@@ -124,17 +208,56 @@ class UWorker:
         except KeyError as e:
             raise UWorkerError('Missing config value: %s' % e)
 
-        # Sleep this many seconds when no jobs are available
+        # Sleep between min_idle_sleep and idle_sleep seconds when no jobs
+        # are available, the sleep grows while the worker stays idle
         self.idle_sleep = idle_sleep
+        self.min_idle_sleep = min_idle_sleep
+        self.idle_backoff = IdleBackoff(min_idle_sleep, idle_sleep)
+        # While the worker is idle one slot polls the api, the other slots
+        # wait until it has found jobs
+        self.idle_poll = Lock()
+        self.jobs_found = Event()
+        # Keeps the backoff and the event in step
+        self.idle_lock = Lock()
+        # Project and job type combinations that recently had no jobs
+        self.empty_targets = NegativeCache(min_idle_sleep, idle_sleep)
+        # Share of the claims that lose to other workers, paces the fetches
+        self.claim_contention = ClaimContention()
         # Sleep this many seconds if something unexpected goes wrong
         self.error_sleep = error_sleep
 
+        # Number of jobs that are processed concurrently by this worker
+        if slots is None:
+            slots = config['concurrency'] or 1
+        try:
+            self.slots = int(slots)
+        except ValueError:
+            raise UWorkerError('Bad number of job slots: %r' % slots)
+        if self.slots < 1:
+            raise UWorkerError(
+                'Number of job slots must be positive, slots=%r' % slots)
+        # Fetch and claim this many jobs in advance, 0 disables prefetching
+        if prefetch is None:
+            prefetch = config['prefetch'] or 0
+        try:
+            self.prefetch = int(prefetch)
+        except ValueError:
+            raise UWorkerError('Bad prefetch lookahead: %r' % prefetch)
+        if self.prefetch < 0:
+            raise UWorkerError(
+                'Prefetch lookahead must not be negative, prefetch=%r' % (
+                    prefetch))
+        self.prefetcher = None
+        # Set when the worker is stopped, wakes up sleeping slots
+        self.shutdown = Event()
+
         self.name = '{class_name}_{host}'.format(
             class_name=self.__class__.__name__,
             host=socket.gethostname())
         self.log = get_logger(
             self.name, to_file=False, to_stdout=True)
         self.job_count = 0
+        self.job_count_lock = Lock()
         self.log_config(config)
         self.project = self.job_type = self.job_timeout = self.cmd = None
 
@@ -145,13 +268,141 @@ class UWorker:
             self.job_timeout = config['job_timeout']
             if self.job_timeout:
                 self.job_timeout = int(self.job_timeout)
+            self.fetch_targets = [(self.project, self.job_type)]
+        else:
+            self.fetch_targets = [
+                (project, job_type)
+                for project in _split_list(config['api_projects'])
+                for job_type in _split_list(config['job_types'])]
+        # Run images through the Docker Engine API ('api') or the docker
+        # command line client ('cli')
+        self.docker_backend = None
+        if not with_command:
+            self.docker_backend = config['docker_backend'] or (
+                'api' if docker_util.docker_socket_available() else 'cli')
+            if self.docker_backend not in ('api', 'cli'):
+                raise UWorkerError(
+                    'Bad docker backend: %r' % self.docker_backend)
+        # Long-lived containers for images that opt in to container reuse
+        self.container_pool = None
+        if self.docker_backend == 'api':
+            self.container_pool = ContainerPool(
+                DockerAPI(), self.log, max_idle=self.slots)
+        # Keep this many recently used images per project pulled, 0 only
+        # pulls the images of prefetched jobs
+        self.prefetch_images = 0
+        self.image_prefetcher = None
+        if not with_command:
+            prefetch_images = config['prefetch_images'] or 0
+            try:
+                self.prefetch_images = int(prefetch_images)
+            except ValueError:
+                raise UWorkerError(
+                    'Bad number of images to prefetch: %r' % prefetch_images)
+        # Remove least recently used images when the images use more disk
+        # than the budget
+        self.image_collector = None
+        if not with_command and config['image_disk_budget']:
+            try:
+                budget = parse_size(config['image_disk_budget'])
+            except ValueError:
+                raise UWorkerError(
+                    'Bad image disk budget: %r' % config['image_disk_budget'])
+            if docker_util.docker_socket_available():
+                self.image_collector = ImageCollector(
+                    DockerAPI(), budget, DockerExecutor.image_usage,
+                    DockerExecutor.image_cache, self.log)
+            else:
+                self.log.warning(
+                    'The docker socket is not available, images will not be '
+                    'removed')
 
+        api_options = {}
+        if config['api_timeout']:
+            try:
+                api_options['timeout'] = float(config['api_timeout'])
+            except ValueError:
+                raise UWorkerError(
+                    'Bad api timeout: %r' % config['api_timeout'])
+        # Renew tokens before they expire, 0 renews them only when the api
+        # rejects them
+        try:
+            token_lifetime = float(
+                config['token_lifetime'] or DEFAULT_TOKEN_LIFETIME)
+        except ValueError:
+            raise UWorkerError(
+                'Bad token lifetime: %r' % config['token_lifetime'])
+        api_options['token_lifetime'] = token_lifetime or None
+        # Share the tokens with the other workers on the host
+        if config['token_cache']:
+            api_options['token_cache'] = TokenCache(config['token_cache'])
+        # Stop calling the api while it is down and queue the status and
+        # output updates in a file until it has recovered
+        if config['outbox']:
+            api_options['breaker'] = CircuitBreaker()
+            try:
+                api_options['outbox'] = Outbox(config['outbox'])
+            except sqlite3.Error as e:
+                raise UWorkerError('Bad outbox %r: %s' % (config['outbox'], e))
+        # Give up calls that have been retried for this many seconds
+        try:
+            deadline = (
+                float(config['api_deadline']) if config['api_deadline']
+                else None)
+        except ValueError:
+            raise UWorkerError(
+                'Bad api deadline: %r' % config['api_deadline'])
+        # One connection per slot and one for the prefetcher
         self.api = UClient(config['api_root'],
                            username=config['api_username'],
                            password=config['api_password'],
-                           retries=retries)
+                           retry_policy=RetryPolicy(
+                               retries, deadline=deadline),
+                           pool_size=self.slots + 1,
+                           **api_options)
         self.external_auth = (config['external_username'],
                               config['external_password'])
+        # Send only new output to the api, or the whole output each time
+        output_uploads = config['output_uploads'] or 'incremental'
+        if output_uploads not in ('incremental', 'full'):
+            raise UWorkerError(
+                'Bad output upload mode: %r' % output_uploads)
+        self.incremental_output = output_uploads == 'incremental'
+        # CPUs and memory for jobs that do not tell what they need, and
+        # admission of jobs when the host has the resources for them
+        try:
+            self.default_resources = Resources.parse(
+                config['job_cpus'], config['job_memory'])
+            self.project_resources = parse_project_resources(
+                config['project_resources'])
+        except ValueError as e:
+            raise UWorkerError('Bad job resources: %s' % e)
+        self.governor = ResourceGovernor(self.log)
+        # Jobs in flight, so that a restarted worker can report them
+        self.journal = None
+        if config['journal']:
+            try:
+                self.journal = JobJournal(config['journal'])
+            except OSError as e:
+                raise UWorkerError(
+                    'Bad journal %r: %s' % (config['journal'], e))
+        # Serve metrics on [host:]port, on localhost if no host is given
+        self.metrics_server = None
+        if config['metrics_port']:
+            try:
+                host, port = parse_address(config['metrics_port'])
+            except ValueError:
+                raise UWorkerError(
+                    'Bad metrics port: %r' % config['metrics_port'])
+            self.metrics_server = MetricsServer(REGISTRY, port, host)
+        # Write timing spans of the phases of the jobs to a file
+        self.trace_exporter = None
+        if config['trace_file']:
+            self.trace_exporter = JsonlFileExporter(config['trace_file'])
+            # The tracer is shared by the process, it is given back when
+            # the worker stops
+            self.saved_trace_exporter = TRACER.exporter
+            TRACER.exporter = self.trace_exporter
         if start_service:
             self.alive = True
             signal.signal(signal.SIGINT, self.stop)
@@ -164,88 +415,672 @@ class UWorker:
             self.log.info('%s = %s' % (k, v))
 
     def run(self, only_once=False):
+        """Process jobs in all job slots until the worker is stopped.
+
+        Each slot runs its own fetch -> claim -> execute -> status cycle in
+        a separate thread. The slots share the api client, the logger and
+        the shutdown handling of the worker.
+        """
         self.running = True
-        while self.alive:
+        SLOTS.set(self.slots)
+        if self.metrics_server:
+            self._start_metrics_server()
+        if self.journal:
+            self.reconcile_journal()
+        if self.image_collector:
+            self.image_collector.maybe_collect()
+        if not self.cmd and (self.prefetch_images > 0 or self.prefetch):
+            self.image_prefetcher = ImagePrefetcher(
+                lambda url_image: self.docker_executor(
+                    'Prefetch image', url_image),
+                self.log, images_per_project=self.prefetch_images)
+            if self.image_collector:
+                # Do not pull the removed images back
+                self.image_collector.on_remove = self.image_prefetcher.forget
+            self.image_prefetcher.start()
+        if self.prefetch:
+            self.prefetcher = JobPrefetcher(self, self.prefetch)
+            self.prefetcher.start()
+        try:
+            if self.slots == 1:
+                self._run_slot(0, only_once)
+            else:
+                threads = [
+                    Thread(target=self._run_slot, args=(slot, only_once),
+                           name='slot-%d' % slot)
+                    for slot in range(self.slots)]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+        finally:
             if only_once:
                 self.alive = False
+            if not self.alive:
+                self.shutdown.set()
+            if self.prefetcher:
+                self.prefetcher.close()
+                self.prefetcher = None
+            if self.image_prefetcher:
+                self.image_prefetcher.close()
+                self.image_prefetcher = None
+            if self.container_pool:
+                self.container_pool.close()
+            if self.metrics_server:
+                self.metrics_server.stop()
+            if self.trace_exporter:
+                if TRACER.exporter is self.trace_exporter:
+                    TRACER.exporter = self.saved_trace_exporter
+                self.trace_exporter.close()
+            self.running = False
+
+    def _start_metrics_server(self):
+        try:
+            self.metrics_server.start()
+        except OSError as e:
+            self.log.error('Could not serve metrics on %s:%d: %s' % (
+                self.metrics_server.host, self.metrics_server.port, e))
+            return
+        self.log.info('Serving metrics on http://%s:%d/metrics' % (
+            self.metrics_server.host, self.metrics_server.port))
+
+    def _run_slot(self, slot, only_once=False):
+        while self.alive:
             try:
-                job = Job.fetch(
-                    self.api, job_type=self.job_type, project=self.project)
-                if not job:
-                    self.log.info('Idle...')
-                    sleep(self.idle_sleep)
-                elif job.url_image and self.cmd:
-                    self.log.warning(
-                        'Got job with docker image (%r) but the worker is '
-                        'configured with a command!' % job.url_image)
-                    sleep(self.idle_sleep)
-                elif self.claim_job(job):
-                    job.send_status(JOB_STATES.started)
-                    exit_code, processing_time = self.do_job(
-                        job.url_source, job.url_target, job.url_output,
-                        job.url_image, job.environment)
-                    if exit_code == 0:
-                        job.send_status(JOB_STATES.finished, processing_time)
-                    else:
-                        job.send_status(JOB_STATES.failed, processing_time)
-                    self.job_count += 1
+                self._process_next_job(slot)
             except Exception as e:
                 self.log.exception('Unhandled exception: %s' % e)
-                sleep(self.error_sleep)
-        self.running = False
+                self._sleep(self.error_sleep)
+            if only_once:
+                break
+
+    def _process_next_job(self, slot):
+        if self.prefetcher:
+            job = self.prefetcher.get()
+        else:
+            job = self.next_job()
+        if job:
+            self._process_job(job, slot)
+
+    def next_job(self):
+        """Fetch and claim a job.
+
+        Sleeps if no job is available.
+
+        Returns:
+          Job: The claimed job or None if no job could be claimed.
+        """
+        jobs = self.next_jobs(1)
+        return jobs[0] if jobs else None
+
+    def next_jobs(self, count):
+        """Fetch up to `count` jobs in one call and claim them.
+
+        Sleeps if no job is available. While the worker is idle only one
+        caller at a time polls the api, the others sleep until it finds
+        jobs.
+
+        Args:
+          count (int): Number of jobs to fetch.
+        Returns:
+          list: The claimed jobs.
+        """
+        if not self.api.flush_outbox():
+            self._wait_for_api()
+            return []
+        polling = False
+        if self.idle_backoff.attempts:
+            polling = self.idle_poll.acquire(blocking=False)
+            if not polling:
+                self._wait_for_jobs()
+                return []
+        try:
+            try:
+                jobs = self.fetch_jobs(count)
+            except CircuitOpenError:
+                # Another call is trying whether the api has recovered
+                self._wait_for_api()
+                return []
+            if not jobs:
+                if not (polling or self.idle_poll.acquire(blocking=False)):
+                    self._wait_for_jobs()
+                    return []
+                polling = True
+                with self.idle_lock:
+                    delay = self.idle_backoff.next_delay()
+                    self.jobs_found.clear()
+                if len(self.fetch_targets) > 1:
+                    delay = min(delay, self.empty_targets.time_left(
+                        self.fetch_targets))
+                self.log.info('Idle, sleeping %.1f seconds...' % delay)
+                start = time()
+                self._sleep(delay)
+                IDLE_SECONDS.inc(time() - start)
+                return []
+            with self.idle_lock:
+                self.idle_backoff.reset()
+                self.jobs_found.set()
+        finally:
+            if polling:
+                self.idle_poll.release()
+        claimed = []
+        for job in jobs:
+            if len(claimed) == count:
+                break
+            if job.url_image and self.cmd:
+                self.log.warning(
+                    'Got job with docker image (%r) but the worker is '
+                    'configured with a command!' % job.url_image)
+                if not claimed:
+                    self._sleep(self.idle_sleep)
+                break
+            if not self.governor.reserve(
+                    job.url_claim, self.job_resources(job)):
+                self.log.info(
+                    'Not enough free resources for job %s, leaving it to '
+                    'other workers' % job.url_source)
+                if not claimed:
+                    self._sleep(self.min_idle_sleep)
+                break
+            if self.claim_job(job):
+                claimed.append(job)
+            else:
+                self.governor.release(job.url_claim)
+        else:
+            if not claimed:
+                # Lost all claims, fall out of step with the workers that won
+                delay = self.claim_contention.delay(jobs[0].project)
+                if delay:
+                    self._sleep(delay)
+        return claimed
+
+    def job_resources(self, job):
+        """Return the resources that a job needs, from the environment of
+        the job, the defaults of its project or the defaults of the worker.
+        """
+        try:
+            resources = Resources.from_environment(job.environment)
+        except ValueError as e:
+            self.log.warning('Bad resources for job %s: %s' % (
+                job.url_source, e))
+            resources = None
+        if resources is None:
+            resources = self.project_resources.get(
+                job.project, self.default_resources)
+        return resources
+
+    def fetch_job(self):
+        """Fetch a job from the first project and job type that has jobs.
+
+        Project and job type combinations that recently had no jobs are
+        skipped if the worker fetches from more than one combination.
+        """
+        jobs = self.fetch_jobs(1)
+        return jobs[0] if jobs else None
+
+    def fetch_jobs(self, count):
+        """Fetch up to `count` jobs from the first project and job type that
+        has jobs, see `fetch_job`.
+
+        When claims in a project often lose to other workers, more jobs are
+        fetched and returned in random order, so that the workers do not
+        all try to claim the first job.
+
+        Returns:
+          list: The jobs, fewer than `count` if the api has fewer jobs or
+            does not support fetching jobs in batches.
+        """
+        use_cache = len(self.fetch_targets) > 1
+        for target in self.fetch_targets:
+            if use_cache and target in self.empty_targets:
+                continue
+            project, job_type = target
+            fetch_count = max(count, self.claim_contention.spread(project))
+            with TRACER.span('fetch', project=project, job_type=job_type,
+                             count=fetch_count) as span, \
+                    API_LATENCY.time(call='fetch'):
+                if fetch_count == 1:
+                    job = Job.fetch(
+                        self.api, job_type=job_type, project=project)
+                    jobs = [job] if job else []
+                else:
+                    jobs = Job.fetch_jobs(
+                        self.api, fetch_count, job_type=job_type,
+                        project=project)
+                span.set(found=len(jobs))
+            if len(jobs) > count:
+                random.shuffle(jobs)
+            if jobs:
+                self.empty_targets.discard(target)
+                return jobs
+            if use_cache:
+                self.empty_targets.add(target)
+        return []
+
+    def _process_job(self, job, slot):
+        if self.slots > 1:
+            self.log.info('Slot %d processing job %s' % (
+                slot, job.url_source))
+        if self.image_prefetcher:
+            self.image_prefetcher.learn(job.project, job.url_image)
+        resources = self.job_resources(job)
+        journal_key = None
+        if self.journal:
+            journal_key = self.journal.key(job.url_claim)
+            self.journal.update(
+                journal_key, started=time(),
+                resources=resources.as_dict() if resources else None)
+        BUSY_SLOTS.inc()
+        try:
+            with TRACER.span('job', slot=slot, **_job_attributes(job)):
+                self.send_status(job, JOB_STATES.started)
+                exit_code, processing_time, usage = self.do_job(
+                    job.url_source, job.url_target, job.url_output,
+                    job.url_image, job.environment, resources,
+                    journal_key=journal_key)
+                resource_usage = usage.as_dict() if usage else None
+                if exit_code == 0:
+                    status = JOB_STATES.finished
+                else:
+                    status = JOB_STATES.failed
+                JOBS.inc(status=status.lower())
+                JOB_DURATION.observe(processing_time, status=status.lower())
+                self.send_status(job, status, processing_time, resource_usage)
+            if journal_key:
+                self.journal.remove(journal_key)
+        finally:
+            BUSY_SLOTS.dec()
+            self.governor.release(job.url_claim)
+        with self.job_count_lock:
+            self.job_count += 1
+        if self.image_collector:
+            self.image_collector.maybe_collect()
+
+    def send_status(self, job, status, processing_time=None,
+                    resource_usage=None):
+        with TRACER.span('status', status=status, **_job_attributes(job)), \
+                API_LATENCY.time(call='status'):
+            job.send_status(status, processing_time, resource_usage)
+
+    def _sleep(self, seconds):
+        """Sleep, but wake up directly if the worker is stopped"""
+        self.shutdown.wait(seconds)
+
+    def _wait_for_api(self):
+        """Only finish the claimed jobs until the api has recovered"""
+        delay = min(max(self.api.breaker.retry_in(), self.min_idle_sleep),
+                    self.idle_sleep)
+        self.log.info(
+            'Job api is down, not fetching jobs for %.1f seconds' % delay)
+        self._sleep(delay)
+
+    def _wait_for_jobs(self):
+        """Sleep until the polling slot has found jobs"""
+        start = time()
+        self.jobs_found.wait(self.idle_sleep)
+        IDLE_SECONDS.inc(time() - start)
 
     def stop(self, mysignal, frame):
         # TODO: Should kill job command and unclaim current job
         self.alive = False
+        self.shutdown.set()
+        # Wake up the slots that wait for jobs
+        self.jobs_found.set()
+
+    def claim_job(self, job, nr_trials=3):
+        """Claim a job, failed claims are retried after short random waits.
 
-    def claim_job(self, job, nr_trials=5):
-        for _ in range(nr_trials):
+        Returns:
+          bool: True if the job was claimed, False if another worker
+            claimed it first or if all trials failed.
+        """
+        for trial in range(nr_trials):
             try:
-                job.claim(worker=self.name)
+                with TRACER.span('claim', **_job_attributes(job)), \
+                        API_LATENCY.time(call='claim'):
+                    job.claim(worker=self.name)
+                self._record_claim(job, conflict=False)
+                if self.journal:
+                    self.journal.add(job)
                 return True
             except UClientError as e:
                 if e.status_code == 409:
+                    CLAIM_CONFLICTS.inc()
+                    self._record_claim(job, conflict=True)
                     return False
                 self.log.error('Failed job claim: %s' % e)
-                sleep(self.error_sleep)
+                if trial + 1 < nr_trials:
+                    self._sleep(self.CLAIM_RETRY_DELAY * 2 ** trial * (
+                        .5 + random.random() / 2))
         return False
 
+    def _record_claim(self, job, conflict):
+        self.claim_contention.record(job.project, conflict)
+        CLAIM_CONFLICT_RATE.set(
+            self.claim_contention.rate(job.project), project=job.project)
+
+    def release_job(self, job):
+        """Give back a claimed job that will not be processed.
+
+        The claim is removed so that another worker can take the job. If
+        that fails the job is marked as failed instead so that it is not
+        left claimed forever.
+        """
+        self.governor.release(job.url_claim)
+        released = self._release(
+            job.unclaim, partial(job.send_status, JOB_STATES.failed),
+            job.url_source)
+        if released and self.journal:
+            self.journal.remove(self.journal.key(job.url_claim))
+
+    def _release(self, unclaim, mark_failed, url_source):
+        """Return True if the job was released or marked as failed"""
+        try:
+            unclaim()
+            self.log.info('Released job %s' % url_source)
+            return True
+        except UClientError as e:
+            self.log.warning(
+                'Could not release job %s (%s), marking it as failed' % (
+                    url_source, e))
+        try:
+            mark_failed()
+            return True
+        except UClientError:
+            self.log.exception('Failed to mark job as failed:')
+        return False
+
+    def reconcile_journal(self):
+        """Report the jobs that an earlier worker left in the journal.
+
+        Jobs that were claimed but not started are released. Jobs with a
+        container that still exists are followed until the container has
+        exited and are then reported as usual, their resources are reserved
+        until then. Other jobs were interrupted and are reported as failed
+        with their spooled output. Jobs of workers that are still running
+        are left alone.
+        """
+        for entry in self.journal.entries():
+            if _worker_alive(entry):
+                continue
+            if not entry['started']:
+                self.log.info(
+                    'Releasing job %s from the journal' % entry['url_source'])
+                if self._release(
+                        partial(self.api.unclaim_job, entry['url_claim']),
+                        partial(self.api.update_status, entry['url_status'],
+                                JOB_STATES.failed),
+                        entry['url_source']):
+                    self.journal.remove(entry['key'])
+            elif entry['container'] and _container_exists(entry['container']):
+                resources = entry.get('resources')
+                self.governor.reserve(
+                    entry['url_claim'],
+                    Resources(**resources) if resources else None, force=True)
+                thread = Thread(
+                    target=self._follow_container, args=(entry,),
+                    name='reattach-%s' % entry['container'][:12])
+                thread.daemon = True
+                thread.start()
+            else:
+                self._report_interrupted(entry)
+
+    def _report_interrupted(self, entry):
+        self.log.warning(
+            'Job %s was interrupted, marking it as failed' % (
+                entry['url_source']))
+        output = self.journal.read_spool(entry['key'])
+        if output:
+            output += b'\nJob interrupted, the worker was restarted'
+        self._report_entry(
+            entry, JOB_STATES.failed, output, status_label='interrupted')
+
+    def _follow_container(self, entry):
+        """Wait for the container of a job of an earlier worker.
+
+        The job timeout is counted from when the job was started.
+        """
+        try:
+            self._follow_container_until_exit(entry)
+        finally:
+            self.governor.release(entry['url_claim'])
+
+    def _follow_container_until_exit(self, entry):
+        container = entry['container']
+        self.log.info('Reattached to container %s of job %s' % (
+            container[:12], entry['url_source']))
+        docker = DockerAPI()
+        output = OutputBuffer(
+            CommandExecutor.OUTPUT_HEAD_SIZE,
+            CommandExecutor.OUTPUT_TAIL_SIZE)
+        killed = Event()
+        killer = None
+        if self.job_timeout:
+            killer = Timer(
+                max(entry['started'] + self.job_timeout - time(), 0),
+                self._stop_reattached, args=(docker, container, killed))
+            killer.daemon = True
+            killer.start()
+        try:
+            for _, data in docker.container_logs(container):
+                output.write(data)
+            exit_code = docker.wait_container(container)
+        except DockerAPIError as e:
+            self.log.error('Lost contact with container %s: %s' % (
+                container[:12], e))
+            self._report_interrupted(entry)
+            return
+        finally:
+            if killer:
+                killer.cancel()
+        if killed.is_set():
+            msg = 'Killed job container after timeout of {} seconds'.format(
+                self.job_timeout)
+            output.write(('\n' + msg).encode())
+            self.log.warning(msg)
+        try:
+            docker.remove_container(container, force=True)
+        except DockerAPIError as e:
+            self.log.warning('Could not remove container %s: %s' % (
+                container[:12], e))
+        status = JOB_STATES.finished if exit_code == 0 else JOB_STATES.failed
+        self._report_entry(entry, status, output.getvalue())
+
+    def _stop_reattached(self, docker, container, killed, kill_after=5):
+        killed.set()
+        try:
+            docker.stop_container(container, timeout=kill_after)
+        except DockerAPIError as e:
+            self.log.warning('Could not stop container %s: %s' % (
+                container[:12], e))
+
+    def _report_entry(self, entry, status, output, status_label=None):
+        """Send the output and the final status of a job in the journal"""
+        processing_time = time() - entry['started']
+        try:
+            if output and entry['url_output']:
+                self.api.update_output(
+                    entry['url_output'], output.decode(errors='replace'))
+            self.api.update_status(
+                entry['url_status'], status, processing_time=processing_time)
+        except UClientError as e:
+            self.log.error('Could not report job %s: %s' % (
+                entry['url_source'], e))
+            return
+        JOBS.inc(status=status_label or status.lower())
+        self.journal.remove(entry['key'])
+
     def do_job(self, url_source, url_target=None, url_output=None,
-               url_image=None, environment=None):
+               url_image=None, environment=None, resources=None,
+               journal_key=None):
+        if resources is None:
+            resources = self.default_resources
         args = [url_source]
         if url_target:
             args.append(url_target)
             args.extend(cred for cred in self.external_auth if cred)
 
-        def output_callback(output):
-            if url_output:
-                try:
-                    # TODO: Limit size of output that can be sent
-                    self.api.update_output(url_output, output)
-                except:
-                    self.log.exception(
-                        'Exception when sending output to job api:')
+        spool = None
+        if journal_key:
+            spool = partial(self.journal.write_spool, journal_key)
+        uploader = OutputUploader(
+            self.api, url_output, self.log,
+            incremental=self.incremental_output, spool=spool)
 
         self.log.info('Creating job executor: %s' % args)
         # TODO: Add support for letting a job override the configured timeout
         if url_image:
             assert not self.cmd
-            executor = DockerExecutor(
-                'Job', url_image, self.log, environment=environment)
+            executor = self.docker_executor(
+                'Job', url_image, environment=environment,
+                resources=resources)
+            if journal_key:
+                executor.on_container = partial(
+                    self.journal.update, journal_key)
         else:
-            executor = CommandExecutor('Job', self.cmd, self.log)
+            executor = CommandExecutor(
+                'Job', self.cmd, self.log, resources=resources)
 
         executor.write_output('Starting execution')
 
-        exit_code, processing_time = executor.execute(
-            args, output_callback, timeout=self.job_timeout)
-        return exit_code, processing_time
+        uploader.start(executor.output)
+        try:
+            exit_code, processing_time = executor.execute(
+                args, None, timeout=self.job_timeout)
+        finally:
+            uploader.close()
+        if executor.usage:
+            self.log.info('Job resource usage: %s' % executor.usage)
+        return exit_code, processing_time, executor.usage
+
+    def docker_executor(self, name, url_image, environment=None,
+                        resources=None):
+        """Create an executor for an image with the docker backend of the
+        worker.
+        """
+        if self.docker_backend == 'api':
+            return DockerEngineExecutor(
+                name, url_image, self.log, environment=environment,
+                container_pool=self.container_pool, resources=resources)
+        return DockerExecutor(
+            name, url_image, self.log, environment=environment,
+            resources=resources)
+
+
+def _worker_alive(entry):
+    """Return True if the worker that wrote a journal entry still runs"""
+    pid = entry['pid']
+    if pid == os.getpid() or not _pid_alive(pid):
+        return False
+    # The pid may have been reused by another process since
+    start = entry.get('pid_start')
+    return start is None or process_start_time(pid) in (None, start)
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _container_exists(container):
+    if not docker_util.docker_socket_available():
+        return False
+    try:
+        DockerAPI().inspect_container(container)
+    except DockerAPIError:
+        return False
+    return True
+
+
+def _job_attributes(job):
+    """Span attributes that identify a job"""
+    return {'job': getattr(job, 'id', None) or job.url_claim,
+            'project': job.project, 'image': job.url_image}
+
+
+class JobPrefetcher:
+    """Fetch and claim jobs in the background while the slots are busy.
+
+    At most `lookahead` claimed jobs are waiting in the queue at any time.
+    The free places in the queue are filled with one fetch for a batch of
+    jobs, if the api supports it. The job slots of the worker take their
+    jobs from the queue and the jobs that are still waiting when the worker
+    stops are released.
+    """
+
+    GET_TIMEOUT = 1.
+
+    def __init__(self, worker, lookahead=1):
+        self.worker = worker
+        self.log = worker.log
+        self.lookahead = lookahead
+        self.jobs = queue.Queue()
+        self.free = BoundedSemaphore(lookahead)
+        self.thread = Thread(target=self._run, name='prefetcher')
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def get(self):
+        """Return the next prefetched job or None if there is no job yet"""
+        try:
+            job = self.jobs.get(timeout=self.GET_TIMEOUT)
+        except queue.Empty:
+            return None
+        self.free.release()
+        return job
+
+    def close(self):
+        """Stop prefetching and release the jobs that have not been
+        started.
+        """
+        self.thread.join()
+        while True:
+            try:
+                job = self.jobs.get_nowait()
+            except queue.Empty:
+                break
+            self.worker.release_job(job)
+
+    def _run(self):
+        while self.worker.alive:
+            if not self.free.acquire(timeout=self.GET_TIMEOUT):
+                continue
+            count = 1
+            while count < self.lookahead and self.free.acquire(False):
+                count += 1
+            jobs = []
+            try:
+                jobs = self.worker.next_jobs(count)
+            except Exception as e:
+                self.log.exception('Unhandled exception in prefetch: %s' % e)
+                self.worker._sleep(self.worker.error_sleep)
+            for job in jobs:
+                # Pull the image while the job waits for a slot
+                if self.worker.image_prefetcher:
+                    self.worker.image_prefetcher.want(job.url_image)
+                self.jobs.put(job)
+            for _ in range(count - len(jobs)):
+                self.free.release()
 
 
 class ExecutorError(Exception):
     pass
 
 
+def _exit_code(status):
+    """Decode a wait status like Popen.returncode does"""
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
 class CommandExecutor:
     """Class for execution of commands.
 
@@ -257,16 +1092,32 @@ class CommandExecutor:
     >>> c.execute(['packed.tar.gz', '/pack/this/dir'], callback_function)
     """
 
-    READLINES_IDLE_SLEEP = 5.
+    # Read at most this many bytes at a time from the process
+    READ_SIZE = 64 * 1024
+    # Keep at most this many bytes from the start and the end of the output
+    OUTPUT_HEAD_SIZE = 256 * 1024
+    OUTPUT_TAIL_SIZE = 768 * 1024
 
-    def __init__(self, name, cmd, log):
+    def __init__(self, name, cmd, log, output=None, resources=None):
         if isinstance(cmd, str):
             cmd = cmd.split()
         self.cmd = cmd
         self.process_name = name
         self.log = log
-        self.output = BytesIO()
-        self.output_lock = Lock()
+        # Memory limit of the process, processes cannot be limited to a
+        # number of CPUs without cgroups
+        self.resources = resources
+        # What the process used, set when it has exited
+        self.usage = None
+        if output is None:
+            output = OutputBuffer(
+                self.OUTPUT_HEAD_SIZE, self.OUTPUT_TAIL_SIZE)
+        self.output = output
+        self.output_lock = self.output.lock
+
+    # Processes started by all executors that have not been waited for
+    active_pids = set()
+    active_pids_lock = Lock()
 
     def execute(self, command_args, output_callback, timeout=None,
                 kill_after=5):
@@ -276,13 +1127,18 @@ class CommandExecutor:
         Args:
           commandd_args (list): List of arguments to provide to the command.
           output_callback (function): Call this function with stdout/stderr
-            output from the command as argument.
+            output from the command as argument. Can be None if the output
+            is read from the output buffer of the executor instead.
           timeout (int): Send TERM to the command if it has not finished
             after this many seconds.
           kill_after (int): Also send KILL (9) if it still is
             alive this many seconds after TERM was sent.
         """
         cmd = self.cmd + command_args
+        if self.resources and self.resources.memory:
+            # Set the limit with prlimit, since code that runs in the child
+            # between fork and exec can deadlock in a threaded process
+            cmd = ['prlimit', '--as=%d' % self.resources.memory, '--'] + cmd
         if timeout:
             if not isinstance(timeout, int) or timeout <= 0:
                 raise ExecutorError(
@@ -290,16 +1146,28 @@ class CommandExecutor:
             cmd = ['timeout', '--kill-after=%d' % kill_after,
                    str(int(timeout))] + cmd
         start_time = time()
-        proc = subprocess.Popen(
-            cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-            universal_newlines=True)
+        with TRACER.span('spawn', process=self.process_name):
+            proc = subprocess.Popen(
+                cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        with self.active_pids_lock:
+            self.active_pids.add(proc.pid)
         self.log.info('{} process started with pid {}: {}'.format(
             self.process_name, proc.pid, cmd))
 
-        threads = self._handle_output(proc, output_callback)
-        exit_code, killed = self._wait_for_exit(proc, threads)
+        try:
+            with TRACER.span('execution', process=self.process_name) as span:
+                self._handle_output(proc, output_callback)
+                exit_code, killed = self._wait_for_exit(proc)
+                span.set(exit_code=exit_code)
+        finally:
+            with self.active_pids_lock:
+                self.active_pids.discard(proc.pid)
         processing_time = time() - start_time
+        self._report_exit(exit_code, killed, timeout, output_callback)
+        self.usage.output_bytes = self.output.size
+        return exit_code, processing_time
 
+    def _report_exit(self, exit_code, killed, timeout, output_callback):
         if timeout and killed:
             msg = ('Killed {} process after timeout of {} seconds'
                    '').format(self.process_name, timeout)
@@ -309,49 +1177,76 @@ class CommandExecutor:
         msg = '{} process exited with code {}'.format(
             self.process_name, exit_code)
         self.write_output(msg)
-        output_callback(self.output.getvalue().decode())
+        if output_callback:
+            output_callback(self.get_output())
         if exit_code != 0:
             self.log.warning(msg)
         else:
             self.log.info(msg)
-        return exit_code, processing_time
 
     def _handle_output(self, proc, out_callback):
-        """Start threads that feed the stdout/stderr streams from the
-        subprocess to the callback function.
+        """Feed the stdout/stderr streams from the subprocess to the log and
+        the callback function until both streams are closed.
+
+        Both streams are read in the calling thread, whatever is available
+        is read as soon as it arrives.
         """
-        t_stdout = Thread(target=self._read_lines, args=(
-            'stdout', proc.stdout, out_callback))
-        t_stderr = Thread(target=self._read_lines, args=(
-            'stderr', proc.stderr, out_callback))
-        t_stdout.start()
-        t_stderr.start()
-        return t_stdout, t_stderr
-
-    def _read_lines(self, stream_name, proc_buffer, out_callback):
-        """Read stream from subprocess and feed to log and callback function"""
         callback_interval = 60.
         last_callback = time() - callback_interval * 9. / 10.
-        prev_output = None
-        for line in iter(proc_buffer.readline, ""):
-            with self.output_lock:
-                self._write_output(stream_name, line)
+        prev_size = None
+        partial_lines = {}
+        with selectors.DefaultSelector() as selector:
+            selector.register(proc.stdout, selectors.EVENT_READ, 'stdout')
+            selector.register(proc.stderr, selectors.EVENT_READ, 'stderr')
+            while selector.get_map():
+                timeout = last_callback + callback_interval - time()
+                for key, _ in selector.select(max(timeout, 0)):
+                    data = os.read(key.fd, self.READ_SIZE)
+                    if not data:
+                        selector.unregister(key.fileobj)
+                        key.fileobj.close()
+                    self._feed_output(key.data, data, partial_lines)
                 if time() - last_callback > callback_interval:
-                    output = self.output.getvalue().decode()
-                    if output != prev_output:
-                        out_callback(output)
-                    prev_output = output
+                    if out_callback and self.output.size != prev_size:
+                        prev_size = self.output.size
+                        out_callback(self.get_output())
                     last_callback = time()
-            if line.strip():
+
+    def _feed_output(self, stream_name, data, partial_lines):
+        """Split output from a stream into lines and write the complete
+        lines. Empty data means that the stream has been closed.
+
+        Args:
+          stream_name (str): stdout or stderr.
+          data (bytes): Output that was read from the stream.
+          partial_lines (dict): The incomplete last line of each stream.
+        """
+        if not data:
+            lines = [partial_lines.pop(stream_name, b'')]
+            if not lines[0]:
+                return
+        else:
+            lines = (partial_lines.get(stream_name, b'') + data).split(b'\n')
+            partial_lines[stream_name] = lines.pop()
+            if len(partial_lines[stream_name]) > self.READ_SIZE:
+                lines.append(partial_lines.pop(stream_name))
+        self._write_lines(stream_name, lines)
+
+    def _write_lines(self, stream_name, lines):
+        """Feed lines from the subprocess to the output and the log"""
+        with self.output_lock:
+            for line in lines:
+                line = line.decode(errors='replace')
+                self._write_output(stream_name, line + '\n')
+        for line in lines:
+            line = line.strip()
+            if line:
                 self.log.info(
                     '{process_name} process {stream}: {message}'.format(
                         process_name=self.process_name, stream=stream_name,
-                        message=line.strip()))
-            else:
-                sleep(self.READLINES_IDLE_SLEEP)
-        proc_buffer.close()
+                        message=line.decode(errors='replace')))
 
-    def _wait_for_exit(self, proc, threads):
+    def _wait_for_exit(self, proc):
         """Wait for the subprocess to exit.
 
         Args:
@@ -359,37 +1254,43 @@ class CommandExecutor:
         Return:
           (int, bool): Subprocess exit code, True if killed because of timeout.
         """
-        exit_code = proc.poll()
-        while exit_code is None:
-            sleep(1)
-            exit_code = proc.poll()
+        _, status, rusage = os.wait4(proc.pid, 0)
+        exit_code = _exit_code(status)
+        proc.returncode = exit_code
+        self.usage = ResourceUsage.from_rusage(rusage)
 
         killed = exit_code in (124, 128+9)
 
         if docker_util.in_docker():
-            self._reap_children(proc.pid)
-
-        for thread in threads:
-            thread.join()
+            self._reap_children()
 
         return exit_code, killed
 
-    def _reap_children(self, pid):
+    def _reap_children(self):
         """Docker does not reap orphaned children, see:
         https://blog.phusion.nl/2015/01/20/docker-and-the-pid-1-zombie-reaping-problem/
+
+        The processes of executors that are still running are left to their
+        executors.
         """
-        try:
-            this_pid, status = os.waitpid(-1, 0)
-            self.log.info('Reaped child %s, exit code: %s' % (
-                this_pid, status))
-            while this_pid != pid:
-                this_pid, status = os.waitpid(-1, 0)
+        for pid in docker_util.zombie_children():
+            with self.active_pids_lock:
+                if pid in self.active_pids:
+                    continue
+            try:
+                this_pid, status = os.waitpid(pid, 0)
                 self.log.info('Reaped child %s, exit code: %s' % (
                     this_pid, status))
-        except OSError as e:
-            if e.errno in (errno.ECHILD, errno.ESRCH):
-                return
-            raise
+            except OSError as e:
+                if e.errno in (errno.ECHILD, errno.ESRCH):
+                    continue
+                raise
+
+    def get_output(self):
+        """Return the output as text, output that is cut in the middle of
+        a character is replaced.
+        """
+        return self.output.getvalue().decode(errors='replace')
 
     def write_output(self, msg):
         self._write_output('executor', msg + '\n')
@@ -419,9 +1320,18 @@ class DockerExecutor(CommandExecutor):
     The image is pulled from the registyr if it does not exist on the host.
     """
 
+    # Images that are known to exist and when they were used, shared by
+    # all executors
+    image_cache = ImageCache()
+    image_usage = ImageUsage()
+    # One lock per image, so that an image is only pulled by one executor
+    # at a time and the others wait for that pull
+    pull_locks = {}
+    pull_locks_lock = Lock()
+
     def __init__(
         self, name, image_url, log, auto_remove=True, environment=None,
-        network='host'
+        network='host', resources=None
     ):
         if environment is None:
             environment = {}
@@ -436,47 +1346,303 @@ class DockerExecutor(CommandExecutor):
             cmd.append('--rm')
         if network:
             cmd.append('--network=%s' % network)
+        if resources:
+            cmd += resources.docker_args()
         cmd += env + [image_url]
         super(DockerExecutor, self).__init__(name, cmd, log)
+        # The limits apply to the container, not to the docker client
+        self.container_resources = resources
 
     def execute(self, command_args, output_callback, timeout=None):
-        pull_exit_code = self.pull_image(output_callback)
-        if pull_exit_code != 0:
-            return pull_exit_code, 0
-        return super(DockerExecutor, self).execute(
+        with self.image_usage.using(self.image_url):
+            pull_exit_code = self.pull_image(output_callback)
+            if pull_exit_code != 0:
+                return pull_exit_code, 0
+            return self._run_container(
+                command_args, output_callback, timeout)
+
+    def _run_container(self, command_args, output_callback, timeout):
+        result = super(DockerExecutor, self).execute(
             command_args, output_callback, timeout=timeout)
+        # The rusage is that of the docker client, not of the container
+        self.usage = ResourceUsage(output_bytes=self.output.size)
+        return result
 
-    def pull_image(self, output_callback):
-        if not self.image_exists():
-            executor = CommandExecutor(
-                'Pull image', ['docker', 'pull'], self.log)
-            code, _ = executor.execute([self.image_url], output_callback)
-            return code
-        return 0
+    def pull_image(self, output_callback, touch=True):
+        """Pull the image if it does not exist on the host.
 
-    def image_exists(self):
+        Args:
+          output_callback (function): See `execute`.
+          touch (bool): Count the pull as a use of the image, False for
+            pulls of images that no job is waiting for.
+        Returns:
+          int: 0 if the image exists, else the exit code of the pull.
+        """
+        with self.pull_locks_lock:
+            lock = self.pull_locks.setdefault(self.image_url, Lock())
+        with lock:
+            with TRACER.span('image_check', image=self.image_url) as span:
+                exists = self.image_exists()
+                span.set(exists=exists)
+            if exists:
+                return 0
+            if touch:
+                self.image_usage.touch(self.image_url)
+            with TRACER.span('image_pull', image=self.image_url), \
+                    IMAGE_PULL_DURATION.time():
+                return self._pull(output_callback)
+
+    def _pull(self, output_callback):
         executor = CommandExecutor(
-            'Image exists', ['docker', 'images', '-q'], self.log)
+            'Pull image', ['docker', 'pull'], self.log, output=self.output)
+        code, _ = executor.execute([self.image_url], output_callback)
+        if code == 0:
+            self.image_exists(refresh=True)
+        return code
 
-        executorline = re.compile(
-            r'\d{4}-\d{1,2}-\d{1,2}T\d{1,2}:\d{1,2}:[\d.]* - EXECUTOR'
-        )
+    def image_exists(self, refresh=False):
+        """Return True if the image exists on the host.
 
-        def output_callback(message):
-            match = executorline.search(message)
-            if match:
-                dockeroutput = message[: match.start()].strip()
-            else:
-                dockeroutput = message.strip()
-            output_callback.exists = bool(dockeroutput)
-        output_callback.exists = False
+        The answer is cached, use refresh to ask docker even if the image is
+        known to exist.
+        """
+        if not refresh and self.image_cache.get(self.image_url):
+            return True
+        image_id = self._image_id()
+        if image_id:
+            self.image_cache.add(self.image_url, image_id)
+        else:
+            self.image_cache.invalidate(self.image_url)
+        return bool(image_id)
 
-        code, _ = executor.execute([self.image_url], output_callback)
+    def _image_id(self):
+        """Ask docker for the id of the image, None if it does not exist"""
+        executor = CommandExecutor(
+            'Image exists', ['docker', 'images', '-q', '--no-trunc'],
+            self.log)
+        code, _ = executor.execute([self.image_url], None)
         if code != 0:
             raise ExecutorError(
                 'Could not check if docker image %s exists, exit code: %s' % (
                     self.image_url, code))
-        return output_callback.exists
+        image_ids = re.findall(r' - STDOUT: (\S+)', executor.get_output())
+        return image_ids[0] if image_ids else None
+
+
+class DockerEngineExecutor(DockerExecutor):
+    """Execute the entrypoint of a docker image through the Docker Engine
+    API on the unix socket of the daemon, instead of through the docker
+    command line client.
+
+    Example usage:
+
+    >>> def callback_function(message):
+    >>>     print(message)
+    >>> c = DockerEngineExecutor('Command in docker',
+                                 'my.registry.com/imagename:tag', log)
+    >>> c.execute(['argument1', 'arg2'], callback_function)
+
+    Checking if an image exists, pulling it and running the container does
+    not start any processes, and the output of the container is read
+    directly from the daemon.
+    """
+
+    # Exit code of `docker run` when the daemon cannot run the container
+    DOCKER_ERROR = 125
+
+    def __init__(
+        self, name, image_url, log, auto_remove=True, environment=None,
+        network='host', docker=None, container_pool=None, resources=None
+    ):
+        super(DockerEngineExecutor, self).__init__(
+            name, image_url, log, auto_remove=auto_remove,
+            environment=environment, network=network, resources=resources)
+        self.docker = docker or DockerAPI()
+        self.container_pool = container_pool
+        self.environment = environment or {}
+        self.network = network
+        self.auto_remove = auto_remove
+        self.container = None
+        # Called with container=<id> when a container has been started
+        self.on_container = None
+
+    def _run_container(self, command_args, output_callback, timeout,
+                       kill_after=5):
+        """
+        Run the image with args and monitor the progress.
+
+        Images that opt in to container reuse run in a container from the
+        container pool, if the executor has a pool.
+
+        Args:
+          commandd_args (list): List of arguments to provide to the image.
+          output_callback (function): Call this function with the output
+            when the container has exited. Can be None if the output is read
+            from the output buffer of the executor instead.
+          timeout (int): Stop the container if it has not finished after
+            this many seconds.
+          kill_after (int): Send KILL (9) if the container still is alive
+            this many seconds after TERM was sent.
+        """
+        if timeout and (not isinstance(timeout, int) or timeout <= 0):
+            raise ExecutorError(
+                'timeout must be a positive integer, timeout=%r' % timeout)
+        start_time = time()
+        pooled = None
+        try:
+            with TRACER.span('spawn', process=self.process_name):
+                if self.container_pool:
+                    pooled = self.container_pool.acquire(
+                        self.image_url, self.container_resources)
+                if pooled:
+                    self.container = pooled.id
+                    exec_id = self.docker.exec_create(
+                        pooled.id, pooled.entrypoint + command_args,
+                        env=self.environment)
+                    output = self.docker.exec_start(exec_id)
+                else:
+                    self.container = self._create_container(command_args)
+                    self.docker.start_container(self.container)
+                    if self.on_container:
+                        self.on_container(container=self.container)
+                    output = self.docker.container_logs(self.container)
+        except DockerAPIError as e:
+            self._docker_error('Could not start container', e)
+            if pooled:
+                self.container_pool.discard(pooled)
+            else:
+                self._remove_container()
+            self._report_exit(
+                self.DOCKER_ERROR, False, timeout, output_callback)
+            return self.DOCKER_ERROR, time() - start_time
+        self.log.info('{} {} started in container {}: {}'.format(
+            self.process_name, 'exec' if pooled else 'container',
+            self.container[:12], command_args))
+        sampler = ContainerStatsSampler(
+            self.docker, self.container, self.log,
+            new_container=not pooled)
+        sampler.start()
+
+        killed = Event()
+        killer = None
+        if timeout:
+            killer = Timer(
+                timeout, self._stop_container,
+                args=(killed, kill_after, pooled))
+            killer.daemon = True
+            killer.start()
+        exit_code = self.DOCKER_ERROR
+        try:
+            with TRACER.span('execution', process=self.process_name,
+                             pooled=bool(pooled)) as span:
+                partial_lines = {}
+                for stream_name, data in output:
+                    self._feed_output(stream_name, data, partial_lines)
+                for stream_name in list(partial_lines):
+                    self._feed_output(stream_name, b'', partial_lines)
+                if not pooled:
+                    exit_code = self.docker.wait_container(self.container)
+                elif killed.is_set():
+                    exit_code = 128 + 9
+                else:
+                    exit_code = self.docker.exec_inspect(
+                        exec_id)['ExitCode']
+                span.set(exit_code=exit_code)
+        except DockerAPIError as e:
+            self._docker_error('Lost contact with container', e)
+        finally:
+            if killer:
+                killer.cancel()
+            self.usage = sampler.stop()
+            if pooled:
+                if not killed.is_set():
+                    self.container_pool.release(
+                        pooled, healthy=exit_code == 0)
+            elif self.auto_remove:
+                self._remove_container()
+        processing_time = time() - start_time
+        self._report_exit(
+            exit_code, killed.is_set(), timeout, output_callback)
+        self.usage.output_bytes = self.output.size
+        return exit_code, processing_time
+
+    def _create_container(self, command_args):
+        """Create a container, pull the image again if it has been removed
+        since it was cached as existing."""
+        host_config = None
+        if self.container_resources:
+            host_config = self.container_resources.host_config()
+        for trial in range(2):
+            try:
+                return self.docker.create_container(
+                    self.image_url, cmd=command_args, env=self.environment,
+                    network_mode=self.network, host_config=host_config)
+            except DockerAPIError as e:
+                if e.status_code != 404 or trial:
+                    raise
+                self.log.warning('Image %s is gone, pulling it again' % (
+                    self.image_url))
+                self.image_cache.invalidate(self.image_url)
+                if self.pull_image(None) != 0:
+                    raise
+
+    def _stop_container(self, killed, kill_after, pooled=None):
+        killed.set()
+        if pooled:
+            # There is no way to stop only the exec, so the whole container
+            # goes
+            self.container_pool.discard(pooled)
+            return
+        try:
+            self.docker.stop_container(self.container, timeout=kill_after)
+        except DockerAPIError as e:
+            self.log.warning('Could not stop container %s: %s' % (
+                self.container[:12], e))
+
+    def _remove_container(self):
+        if not self.container:
+            return
+        try:
+            self.docker.remove_container(self.container, force=True)
+        except DockerAPIError as e:
+            self.log.warning('Could not remove container %s: %s' % (
+                self.container[:12], e))
+
+    def _docker_error(self, msg, error):
+        msg = '{}: {}'.format(msg, error)
+        self.write_output(msg)
+        self.log.error(msg)
+
+    def _pull(self, output_callback):
+        self.write_output('Pulling image %s' % self.image_url)
+        try:
+            self.docker.pull_image(self.image_url, self._pull_progress)
+        except DockerAPIError as e:
+            self._docker_error('Could not pull image %s' % self.image_url, e)
+            if output_callback:
+                output_callback(self.get_output())
+            return 1
+        self.image_exists(refresh=True)
+        return 0
+
+    def _pull_progress(self, message):
+        """Write pull status changes, but not the download progress bars"""
+        if message.get('progress'):
+            return
+        line = ' '.join(
+            message[key] for key in ('id', 'status') if message.get(key))
+        if line:
+            self._write_lines('pull', [line.encode()])
+
+    def _image_id(self):
+        """Ask docker for the id of the image, None if it does not exist"""
+        try:
+            image = self.docker.inspect_image(self.image_url)
+        except DockerAPIError as e:
+            raise ExecutorError(
+                'Could not check if docker image %s exists: %s' % (
+                    self.image_url, e))
+        return image['Id'] if image else None
 
 
 def get_argparser():
@@ -488,6 +1654,15 @@ def get_argparser():
     parser.add_argument(
         '--no-command', action='store_true',
         help="Start Uworker service in docker execution mode.")
+    parser.add_argument(
+        '--prefetch', type=int, default=None, metavar='N',
+        help='Fetch and claim up to N jobs in the background while jobs '
+             'are running, overrides the UWORKER_PREFETCH environment '
+             'variable (default: 0, no prefetching).')
+    parser.add_argument(
+        '--slots', type=int, default=None,
+        help='Number of jobs to process concurrently, overrides the '
+             'UWORKER_CONCURRENCY environment variable (default: 1).')
     return parser
 
 
@@ -501,10 +1676,12 @@ def main(args=None):
             print('Cannot run job without a command')
             return 1
         worker = UWorker(with_command=True)
-        return worker.do_job(args.INPUT_DATA_URL)
+        exit_code, _, _ = worker.do_job(args.INPUT_DATA_URL)
+        return exit_code
     else:
         print('Spawning worker')
-        UWorker(start_service=True, with_command=not args.no_command)
+        UWorker(start_service=True, with_command=not args.no_command,
+                slots=args.slots, prefetch=args.prefetch)
     return 0
 
 